@@ -0,0 +1,327 @@
+'''
+benchmark.py: Benchmarks for the watchme Analyzer.
+
+Generates a synthetic tree of daily "YYYY-MM-DD windows.csv" logs (or copies 
+the logs of an existing data directory, which is left untouched) and times 
+each phase of the analysis separately:
+
+  parse       parsing the CSV logs into the cached intervals
+  aggregate   reading back and dictionary encoding the intervals and
+              computing the rollups (and, with NumPy, computing them again 
+              with IntervalArrays)
+  export      writing alldata.js (chunks, columns and array formats), 
+              rollups.js and index.js
+  incremental re-analyzing after a few rows have been appended to the last
+              day's log
+
+For each phase it reports the rows processed, rows/sec and the peak RSS of
+the process so far, plus the size of the files written. Results can be saved
+as JSON and compared against a previous run:
+
+  > python benchmark.py --days 730 --output before.json
+  ... change things ...
+  > python benchmark.py --days 730 --output after.json --compare before.json
+
+Written by Jonathan Foote (jmfoote@andrew.cmu.edu).
+Original code is released under the MIT license; see LICENSE.md for details.
+'''
+
+import argparse
+import csv
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import watchme
+
+try:
+    import resource
+except ImportError:
+    resource = None # not available on Windows: no peak RSS figures
+
+
+def generate(directory, days=365, switches=400, titles=2000, exes=50,
+             idle=0.02, seed=0, start=datetime.date(2012, 1, 1)):
+    '''
+    Writes days of synthetic logs to directory, in the format Logger writes.
+    Each day has about switches window changes between titles distinct
+    window titles spread over exes exe names (a few of them get most of the
+    use, as in real logs), and after each change the user goes idle with
+    probability idle. Returns the number of rows written.
+    '''
+    rand = random.Random(seed)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    # Popularity follows a power law: weight of the i'th exe/title is 1/(i+1)
+    def chooser(n):
+        weights = [1.0 / (i + 1) for i in xrange(n)]
+        total = sum(weights)
+        cumulative = []
+        acc = 0
+        for w in weights:
+            acc += w / total
+            cumulative.append(acc)
+        def choose():
+            r = rand.random()
+            lo, hi = 0, n - 1
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if cumulative[mid] < r:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return lo
+        return choose
+    choose_exe = chooser(exes)
+    choose_title = chooser(titles)
+
+    rows = 0
+    for day in xrange(days):
+        date = start + datetime.timedelta(days=day)
+        t = time.mktime(date.timetuple()) + 8 * 3600 + rand.uniform(0, 3600)
+        fname = date.strftime("%Y-%m-%d windows.csv")
+        # A workday: the switches are spread over about ten hours
+        mean_dwell = 10 * 3600.0 / max(switches, 1)
+        with open(os.path.join(directory, fname), "wb") as fd:
+            writer = csv.writer(fd)
+            for i in xrange(switches):
+                exe = choose_exe()
+                title = choose_title()
+                writer.writerow(["window_info", "app%d.exe" % exe,
+                    "Document %d - App %d" % (title, exe), t])
+                rows += 1
+                t += rand.expovariate(1.0 / mean_dwell)
+                if rand.random() < idle:
+                    # Logger notices idle time 3 minutes after the last input
+                    away = 180 + rand.expovariate(1.0 / 900)
+                    writer.writerow(["idle_time", t + 180, t + away])
+                    rows += 1
+                    t += away
+    return rows
+
+
+def peak_rss_kb():
+    '''
+    Returns the peak resident set size of this process so far in KB, or None
+    if that can't be determined on this platform
+    '''
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        rss /= 1024 # bytes on OS X, KB elsewhere
+    return rss
+
+
+def timed(results, name, rows, func, *args, **kwargs):
+    '''
+    Runs func(*args, **kwargs), records its timing as phase name of results
+    and returns its result. rows is the number of rows the phase processes,
+    or a callable that computes it from the result.
+    '''
+    start = time.time()
+    result = func(*args, **kwargs)
+    seconds = time.time() - start
+    if callable(rows):
+        rows = rows(result)
+    results["phases"][name] = {
+        "seconds": seconds,
+        "rows": rows,
+        "rows_per_sec": rows / seconds if seconds else None,
+        "peak_rss_kb": peak_rss_kb(),
+    }
+    return result
+
+
+def directory_bytes(directory):
+    '''
+    Returns the total size of the files in directory
+    '''
+    return sum(os.path.getsize(os.path.join(directory, f))
+        for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f)))
+
+
+def is_log(fname):
+    '''
+    Returns whether fname is a daily log or a monthly archive of them
+    '''
+    return fname.endswith("windows.csv") or fname.endswith("windows.zip")
+    
+    
+def copy_logs(source, directory):
+    '''
+    Copies the logs (and log archives) in source to directory, leaving out 
+    everything the Analyzer writes
+    '''
+    for fname in os.listdir(source):
+        if is_log(fname) and os.path.isfile(os.path.join(source, fname)):
+            shutil.copy2(os.path.join(source, fname), os.path.join(directory, fname))
+            
+            
+def run(directory, workers=1):
+    '''
+    Benchmarks the analysis of the logs in directory and returns the results
+    as a dict. Any cached analysis in directory is thrown away first, and 
+    the outputs are written to it, so directory should be a scratch copy 
+    (see copy_logs).
+    '''
+    results = {"phases": {}, "output_bytes": {}}
+    analyzer = watchme.Analyzer(directory, workers=workers)
+    if os.path.exists(analyzer.cachedir):
+        shutil.rmtree(analyzer.cachedir)
+    os.makedirs(analyzer.cachedir)
+
+    # The logs are read as the Analyzer reads them, archived ones included
+    logs = watchme.log_files(directory)
+    log_rows = 0
+    for log in logs:
+        with watchme.open_log(log.path) as fd:
+            log_rows += sum(1 for line in fd)
+    results["log_rows"] = log_rows
+    results["output_bytes"]["logs"] = sum(os.path.getsize(os.path.join(directory, f))
+        for f in os.listdir(directory) if is_log(f))
+
+    # parse: CSV logs -> cached intervals
+    manifest = watchme.Manifest(analyzer.cachedir)
+    fnames, tail = timed(results, "parse", log_rows, analyzer.update, manifest)
+
+    # aggregate: cached intervals -> encoded intervals and rollups
+    def aggregate():
+        rollups = watchme.Rollups()
+        items = []
+        exe_names = analyzer.exe_names
+        for item in analyzer.encode(analyzer.cached_items(manifest, fnames)):
+            items.append(item)
+            rollups.add(exe_names[item[0]], item[2], item[3], item[4])
+        rollups.idle = manifest.idle()
+        return items, rollups
+    items, rollups = timed(results, "aggregate", lambda result: len(result[0]), aggregate)
+    
+    # aggregate (numpy): the same rollups, vectorized (see IntervalArrays)
+    if watchme.numpy is not None:
+        def aggregate_numpy():
+            stats = watchme.IntervalArrays(analyzer.exe_names, analyzer.window_titles)
+            for item in items:
+                stats.append(item)
+            stats.finish()
+            return stats.rollups()
+        timed(results, "aggregate (numpy)", len(items), aggregate_numpy)
+
+    # export: encoded intervals -> alldata.js, rollups.js and index.js
+    js_filename = os.path.join(directory, "alldata.js")
+    def export(js_class):
+        js_array = js_class(js_filename, analyzer.exe_names, analyzer.window_titles)
+        for item in items:
+            js_array.append(item)
+        js_array.finish()
+        return os.path.getsize(js_filename)
+    results["output_bytes"]["alldata.js (array)"] = timed(results, "export (array)",
+        len(items), export, watchme.JsArrayFile)
+    results["output_bytes"]["alldata.js (columns)"] = timed(results, "export (columns)",
+        len(items), export, watchme.ColumnarJsFile)
+    results["output_bytes"]["alldata.js (chunks)"] = timed(results, "export (chunks)",
+        len(items), export, watchme.ChunkedJsFile)
+    results["output_bytes"]["chunks"] = directory_bytes(os.path.join(directory, "chunks"))
+    def export_tables():
+        rollups.write(os.path.join(directory, "rollups.js"))
+        watchme.TokenIndex(analyzer.window_titles).write(os.path.join(directory, "index.js"))
+    timed(results, "export (rollups, index)", len(items), export_tables)
+    results["output_bytes"]["rollups.js"] = os.path.getsize(os.path.join(directory, "rollups.js"))
+    results["output_bytes"]["index.js"] = os.path.getsize(os.path.join(directory, "index.js"))
+    manifest.save()
+    results["output_bytes"]["cache"] = directory_bytes(analyzer.cachedir)
+
+    # incremental: append to the last day and parse again. If that day has 
+    # been archived, it is unpacked first: the Logger would have carried on
+    # writing the file, and a new file would hide the archived day instead
+    last = os.path.join(directory, fnames[-1])
+    if isinstance(logs[-1].path, watchme.ArchivedLog):
+        with watchme.open_log(logs[-1].path) as archived:
+            with open(last, "wb") as fd:
+                fd.write(archived.read())
+    with open(last, "ab") as fd:
+        t = watchme.Manifest(analyzer.cachedir).files[fnames[-1]]["state"][0]
+        writer = csv.writer(fd)
+        for i in xrange(10):
+            writer.writerow(["window_info", "bench.exe", "benchmark %d" % i, t + i + 1])
+    manifest = watchme.Manifest(analyzer.cachedir)
+    timed(results, "incremental", 10, analyzer.update, manifest)
+    return results
+
+
+def compare(old, new):
+    '''
+    Prints the phases of results new next to those of results old
+    '''
+    print "%-26s %12s %12s %8s" % ("phase", "old rows/s", "new rows/s", "change")
+    for name in sorted(set(old["phases"]) | set(new["phases"])):
+        a = old["phases"].get(name, {}).get("rows_per_sec")
+        b = new["phases"].get(name, {}).get("rows_per_sec")
+        change = "%+.1f%%" % (100.0 * (b - a) / a) if a and b else "-"
+        print "%-26s %12s %12s %8s" % (name, "%.0f" % a if a else "-",
+            "%.0f" % b if b else "-", change)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the watchme Analyzer.")
+    parser.add_argument("--data", help="log directory to use; generated if it "
+        "has no logs. Its logs are copied to a temporary directory, which is "
+        "what gets benchmarked, so it is never written to otherwise")
+    parser.add_argument("--days", type=int, default=365, help="days of logs to generate")
+    parser.add_argument("--switches", type=int, default=400, help="window switches per day")
+    parser.add_argument("--titles", type=int, default=2000, help="distinct window titles")
+    parser.add_argument("--exes", type=int, default=50, help="distinct exe names")
+    parser.add_argument("--idle", type=float, default=0.02,
+        help="probability of going idle after a window switch")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--workers", type=int, default=1, help="parser processes")
+    parser.add_argument("--output", help="file to save the results to (JSON)")
+    parser.add_argument("--compare", help="results file (JSON) to compare against")
+    args = parser.parse_args(argv)
+
+    # The benchmark writes a cache and outputs, and appends rows to the last 
+    # log, so it always runs on a scratch directory
+    directory = tempfile.mkdtemp(prefix="watchme-bench-")
+    try:
+        results = {"params": vars(args), "python": sys.version,
+            "platform": platform.platform(),
+            "timestamp": datetime.datetime.now().isoformat()}
+        source = args.data or directory
+        if not os.path.exists(source) or not any(is_log(f) for f in os.listdir(source)):
+            start = time.time()
+            generate(source, args.days, args.switches, args.titles, args.exes,
+                args.idle, args.seed)
+            print "generated %s in %.1fs" % (source, time.time() - start)
+        if source != directory:
+            copy_logs(source, directory)
+        results.update(run(directory, args.workers))
+    finally:
+        shutil.rmtree(directory)
+
+    print "%d log rows" % results["log_rows"]
+    print "%-26s %10s %10s %12s %12s" % ("phase", "seconds", "rows", "rows/s", "peak RSS KB")
+    for name in sorted(results["phases"]):
+        phase = results["phases"][name]
+        print "%-26s %10.3f %10d %12s %12s" % (name, phase["seconds"], phase["rows"],
+            "%.0f" % phase["rows_per_sec"] if phase["rows_per_sec"] else "-",
+            phase["peak_rss_kb"] or "-")
+    for name in sorted(results["output_bytes"]):
+        print "%-26s %10d bytes" % (name, results["output_bytes"][name])
+
+    if args.output:
+        with open(args.output, "wb") as fd:
+            json.dump(results, fd, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare, "rb") as fd:
+            compare(json.load(fd), results)
+
+
+if __name__=="__main__":
+    main(sys.argv[1:])
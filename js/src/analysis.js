@@ -1,3 +1,323 @@
+// True if the page was served by a QueryServer (see watchme.py), which 
+// answers queries over the data at api/; otherwise the data is read from the
+// generated data/*.js files.
+var server = location.protocol != 'file:';
+
+// Interval data in columnar form: start_time/end_time/exe_code/title_code 
+// arrays plus exe_names/window_titles dictionaries that the codes index into.
+// Built from whichever of watchme_chunks (ChunkedJsFile), watchme_columns 
+// (ColumnarJsFile) or watchme_data (JsArrayFile) data/alldata.js defines.
+// ranges lists the [first, end) rows that have been loaded.
+var watchme = server ? null : load_intervals();
+
+// Totals per day/exe, hour/exe and idle time per day written by the Analyzer
+// (data/rollups.js); null if the data was written by an older version.
+var rollups = (!server && typeof watchme_rollups != 'undefined') ? watchme_rollups : null;
+
+// Inverted index from window title tokens to title codes written by the 
+// Analyzer (data/index.js); null if missing or not written for this data.
+var index = server ? null : load_index();
+
+
+function base64_to_buffer(b64) {
+  var bin = atob(b64);
+  var bytes = new Uint8Array(bin.length);
+  for (var i = 0; i < bin.length; i++) {
+    bytes[i] = bin.charCodeAt(i);
+  }
+  return bytes.buffer;
+}
+
+
+function load_intervals() {
+  if (typeof watchme_chunks != 'undefined') {
+    return load_chunk_list();
+  }
+  if (typeof watchme_columns != 'undefined') {
+    // Blob layout: "WMC1", uint32 count, float64 start_time[count], 
+    // float64 end_time[count], uint32 exe_code[count], uint32 title_code[count]
+    var buf = base64_to_buffer(watchme_columns.data);
+    var view = new DataView(buf);
+    var magic = String.fromCharCode(view.getUint8(0), view.getUint8(1), view.getUint8(2), view.getUint8(3));
+    if (magic != 'WMC1') {
+      throw new Error('bad watchme_columns data: ' + magic);
+    }
+    var count = view.getUint32(4, true);
+    return {
+      count: count,
+      start_time: new Float64Array(buf, 8, count),
+      end_time: new Float64Array(buf, 8 + 8 * count, count),
+      exe_code: new Uint32Array(buf, 8 + 16 * count, count),
+      title_code: new Uint32Array(buf, 8 + 20 * count, count),
+      exe_names: watchme_columns.exe_names,
+      window_titles: watchme_columns.window_titles,
+      ranges: [[0, count]]
+    };
+  }
+
+  // Fallback: dictionary encode the watchme_data object array
+  var columns = {count: 0, start_time: [], end_time: [], exe_code: [], title_code: [],
+                 exe_names: [], window_titles: []};
+  var exe_codes = Object.create(null);
+  var title_codes = Object.create(null);
+  watchme_data.forEach(function(item) {
+    if (!(item.exe_name in exe_codes)) {
+      exe_codes[item.exe_name] = columns.exe_names.push(item.exe_name) - 1;
+    }
+    if (!(item.window_title in title_codes)) {
+      title_codes[item.window_title] = columns.window_titles.push(item.window_title) - 1;
+    }
+    columns.start_time.push(Number(item.start_time));
+    columns.end_time.push(Number(item.end_time));
+    columns.exe_code.push(exe_codes[item.exe_name]);
+    columns.title_code.push(title_codes[item.window_title]);
+    columns.count++;
+  });
+  columns.ranges = [[0, columns.count]];
+  return columns;
+}
+
+
+// Sets up the columns for the chunks listed by watchme_chunks, which are 
+// filled in as the chunks are loaded (see load_chunk): chunk i has the rows
+// from chunks[i].offset on, in chronological order.
+function load_chunk_list() {
+  var count = 0;
+  watchme_chunks.chunks.forEach(function(chunk) {
+    chunk.offset = count;
+    chunk.state = null; // 'loading', then 'loaded'
+    count += chunk.count;
+  });
+  return {
+    count: count,
+    start_time: new Float64Array(count),
+    end_time: new Float64Array(count),
+    exe_code: new Uint32Array(count),
+    title_code: new Uint32Array(count),
+    exe_names: watchme_chunks.exe_names,
+    window_titles: watchme_chunks.window_titles,
+    chunks: watchme_chunks.chunks,
+    ranges: []
+  };
+}
+
+
+// Loads the latest chunk that isn't loaded yet by adding its script to the
+// page, then calls callback. Returns false if every chunk is loaded already.
+// One chunk is loaded at a time; if a chunk is already on its way, callback
+// replaces the callback it was going to call.
+var chunk_callback = null;
+function load_chunk(callback) {
+  var pending = watchme.chunks.filter(function(chunk) { return chunk.state != 'loaded'; });
+  if (pending.length == 0) {
+    return false;
+  }
+  chunk_callback = callback;
+  var chunk = pending[pending.length - 1];
+  if (chunk.state != 'loading') {
+    chunk.state = 'loading';
+    var script = document.createElement('script');
+    script.src = 'data/' + chunk.file;
+    script.onload = function() {
+      var then = chunk_callback;
+      chunk_callback = null;
+      if (then) {
+        then();
+      }
+    };
+    document.getElementsByTagName('head')[0].appendChild(script);
+  }
+  return true;
+}
+
+
+// Loads every chunk that isn't loaded yet, one after the other, then calls
+// callback once
+function load_all_chunks(callback) {
+  if (!load_chunk(function() { load_all_chunks(callback); })) {
+    callback();
+  }
+}
+
+
+// True if there are chunks left to load
+function chunks_pending() {
+  return watchme.chunks.some(function(chunk) { return chunk.state != 'loaded'; });
+}
+
+
+// The chart can't be zoomed in further than this (ms)
+var chart_max_zoom = 14 * 24 * 3600000; // fourteen days
+
+
+// Called by the chart when it is zoomed (or the zoom is reset) to the 
+// range from e.min to e.max ms: once that range reaches back to within 
+// chart_max_zoom of the start of the chart, loads the month before the 
+// oldest one loaded and searches again, so older data comes in a month at 
+// a time as the chart is zoomed out to it rather than all of it after each
+// search. Resetting the zoom always does.
+function chart_zoomed(e) {
+  if (!watchme || !watchme.chunks || ($('#searchOptions').val() == 'exe_name' && rollups)) {
+    return; // every day is charted already
+  }
+  if (watchme.ranges.length == 0 || !chunks_pending()) {
+    return;
+  }
+  var extremes = e.target.getExtremes();
+  var min = (typeof e.min == 'number') ? e.min : extremes.dataMin;
+  if (min <= extremes.dataMin + chart_max_zoom) {
+    load_chunk(searchit_simple);
+  }
+}
+
+
+// Called by the script of each chunk: copies its columns (laid out as in 
+// watchme_columns) into place
+function watchme_chunk(month, data) {
+  var chunk = watchme.chunks.filter(function(chunk) { return chunk.month == month; })[0];
+  var buf = base64_to_buffer(data);
+  var count = new DataView(buf).getUint32(4, true);
+  watchme.start_time.set(new Float64Array(buf, 8, count), chunk.offset);
+  watchme.end_time.set(new Float64Array(buf, 8 + 8 * count, count), chunk.offset);
+  watchme.exe_code.set(new Uint32Array(buf, 8 + 16 * count, count), chunk.offset);
+  watchme.title_code.set(new Uint32Array(buf, 8 + 20 * count, count), chunk.offset);
+  chunk.state = 'loaded';
+  watchme.ranges.push([chunk.offset, chunk.offset + count]);
+  if (index) {
+    index.title_rows = null; // rows_by_title has to take the new rows in
+  }
+}
+
+
+function load_index() {
+  if (typeof watchme_index == 'undefined') {
+    return null;
+  }
+  // Blob layout: "WMI1", uint32 token_count, uint32 title_count,
+  // uint32 offsets[token_count + 1], uint32 postings[offsets[token_count]]
+  var buf = base64_to_buffer(watchme_index.data);
+  var view = new DataView(buf);
+  var magic = String.fromCharCode(view.getUint8(0), view.getUint8(1), view.getUint8(2), view.getUint8(3));
+  var token_count = view.getUint32(4, true);
+  var title_count = view.getUint32(8, true);
+  if (magic != 'WMI1' || title_count != watchme.window_titles.length) {
+    return null;
+  }
+  var offsets = new Uint32Array(buf, 12, token_count + 1);
+  return {
+    tokens: watchme_index.tokens,
+    offsets: offsets,
+    postings: new Uint32Array(buf, 12 + 4 * (token_count + 1), offsets[token_count]),
+    title_rows: null // see rows_by_title
+  };
+}
+
+
+// Groups the loaded rows by title code (a counting sort over title_code): 
+// the rows with title code c are rows.slice(starts[c], starts[c + 1]). Built
+// on the first indexed search, and again once more chunks have been loaded.
+function rows_by_title() {
+  if (!index.title_rows) {
+    var title_count = watchme.window_titles.length;
+    var starts = new Uint32Array(title_count + 1);
+    var loaded = 0;
+    watchme.ranges.forEach(function(range) {
+      for (var row = range[0]; row < range[1]; row++) {
+        starts[watchme.title_code[row] + 1]++;
+      }
+      loaded += range[1] - range[0];
+    });
+    for (var c = 0; c < title_count; c++) {
+      starts[c + 1] += starts[c];
+    }
+    var rows = new Uint32Array(loaded);
+    var next = starts.slice(0, title_count);
+    watchme.ranges.forEach(function(range) {
+      for (var row = range[0]; row < range[1]; row++) {
+        rows[next[watchme.title_code[row]]++] = row;
+      }
+    });
+    index.title_rows = {starts: starts, rows: rows};
+  }
+  return index.title_rows;
+}
+
+
+// Returns the ascending codes of the window titles containing tok, from the
+// index if tok is a single token, otherwise by scanning the titles
+function titles_containing(tok) {
+  var codes = [];
+  if (/^[a-z0-9]+$/.test(tok)) {
+    // union of the postings of every indexed token containing tok
+    index.tokens.forEach(function(token, i) {
+      if (token.indexOf(tok) != -1) {
+        for (var p = index.offsets[i]; p < index.offsets[i + 1]; p++) {
+          codes.push(index.postings[p]);
+        }
+      }
+    });
+    codes.sort(function(a, b) { return a - b; });
+    return codes.filter(function(code, i) { return i == 0 || code != codes[i - 1]; });
+  }
+  watchme.window_titles.forEach(function(title, code) {
+    if (title.toLowerCase().search(tok) != -1) {
+      codes.push(code);
+    }
+  });
+  return codes;
+}
+
+
+// Returns the intersection of ascending arrays a and b
+function intersect(a, b) {
+  var result = [];
+  for (var i = 0, j = 0; i < a.length && j < b.length; ) {
+    if (a[i] < b[j]) {
+      i++;
+    } else if (a[i] > b[j]) {
+      j++;
+    } else {
+      result.push(a[i]);
+      i++;
+      j++;
+    }
+  }
+  return result;
+}
+
+
+// Splits a query into groups of lower case tokens: tokens joined by AND 
+// form a group, and a string matches a group if it contains all of its 
+// tokens. Other tokens (optionally separated by OR) are groups of their own.
+function parse_query(query) {
+  var groups = [];
+  var and = false;
+  query.split(" ").forEach(function(tok) {
+    if (tok == "AND") {
+      and = groups.length > 0;
+    } else if (tok == "OR") {
+      and = false;
+    } else if (tok != "") {
+      if (and) {
+        groups[groups.length - 1].push(tok.toLowerCase());
+      } else {
+        groups.push([tok.toLowerCase()]);
+      }
+      and = false;
+    }
+  });
+  return groups;
+}
+
+
+// Returns the local midnight of the day that timestamp (in seconds) falls on
+function day_of(timestamp) {
+  var day = new Date(timestamp * 1000);
+  day.setHours(0, 0, 0, 0);
+  return day;
+}
+
+
 $(document).ready(function() {
 
   // Wire up the search button, so that when enter is hit that it executes
@@ -9,9 +329,33 @@ $(document).ready(function() {
 
 
   populate_list_of_executes();
+  if (server) {
+    check_status(false);
+  } else if (watchme.chunks) {
+    load_chunk(null); // the latest data, ready for the first search
+  }
 });
 
 
+// Polls the server while it refreshes its data in the background, saying so
+// on the page; once the refresh is done, shows the fresh data.
+function check_status(was_refreshing) {
+  $.getJSON('api/status', function(status) {
+    if (status.refreshing) {
+      $("#status").text("The data is stale and being refreshed; the latest activity will show up shortly.").show();
+      setTimeout(function() { check_status(true); }, 2000);
+    } else if (was_refreshing) {
+      $("#status").hide();
+      $("code ul").empty();
+      populate_list_of_executes();
+      if (document.getElementById('txt_name').value != "") {
+        searchit_simple();
+      }
+    }
+  });
+}
+
+
 
 
 function draw_chart(search_title, start_date_ms, data_list){
@@ -36,7 +380,10 @@ function draw_chart(search_title, start_date_ms, data_list){
             },
             xAxis: {
                 type: 'datetime',
-                maxZoom: 14 * 24 * 3600000, // fourteen days
+                maxZoom: chart_max_zoom,
+                events: {
+                    afterSetExtremes: chart_zoomed
+                },
                 title: {
                     text: null
                 }
@@ -127,18 +474,35 @@ function draw_pie_chart(data_list){
 
 
 function populate_list_of_executes(){
-  
-  var exeNames = [];
-  watchme_data.forEach(function(item) {
-    // Filter out redundant entries naturally
-    if(item.exe_name !== ""){
-      exeNames.push(item.exe_name.toLowerCase());
-    }
-  });
+  if (server) {
+    $.getJSON('api/exes', function(data) {
+      list_executes(data.exes.map(function(exe) { return exe[0]; }));
+    });
+    return;
+  }
+  var names = watchme.exe_names;
+  if (rollups) {
+    names = [];
+    $.each(rollups.days, function(date, totals) {
+      $.each(totals, function(exe_name) {
+        names.push(exe_name);
+      });
+    });
+  }
+  list_executes(names);
+};
+
 
+function list_executes(names){
+
+  // The exe names from the server, the rollups or the dictionary are 
+  // already free of duplicates, up to case
+  var exeNames = {};
   var uniqueNames = [];
-  $.each(exeNames, function(i, el){
-    if($.inArray(el, uniqueNames) === -1){
+  $.each(names, function(i, el){
+    el = el.toLowerCase();
+    if(el !== "" && !(el in exeNames)){
+      exeNames[el] = true;
       uniqueNames.push(el);
     }
   });
@@ -167,57 +531,149 @@ function populate_list_of_executes(){
 };
 
 
+// Returns, for each of strings, the number of query groups it matches
+function count_hits(strings, groups) {
+  return strings.map(function(s) {
+    s = s.toLowerCase();
+    return groups.filter(function(group) {
+      return group.every(function(tok) {
+        return s.search(tok) != -1;
+      });
+    }).length;
+  });
+}
+
+
 function searchit_simple() {
   query = document.getElementById('txt_name').value;
   // TODO: input validation!! maybe like this: window_title_tokd = JSON.stringify(item.window_title).replace(/\W/g, ' ')
   var matches = {}; // maps javascript date string to amount of time spent in matching windows on that date
   var start_date = 0; // first date in matches
   var end_date = 0; // last date in matches
-  var delta = 0;
-  watchme_data.forEach(function(item) {
-    query.toLowerCase().split(" ").forEach(function(tok) {
-      // if any search token is in the window title for this entry, add this entry to matches
-      if( item.window_title.toLowerCase().search(tok) != -1) {
-        jdate = new Date(item.date);
-        
-        // get start and end dates for this entry
-        if (start_date == 0) {
-          start_date = jdate;
-        }
-        end_date = jdate; // note: will end up being the date for the last entry that matches
-        
-        jdate_str = jdate.toString('yyyy-MM-dd');
-        
-        // cacluate time spent in window for this entry
-        delta = item.end_time - item.start_time;
-        
-        // add time for this entry to matches
-        if (jdate_str in matches) {
-          matches[jdate_str] = matches[jdate_str] + delta;
-        } else {
-          matches[jdate_str] = delta;
+  var groups = parse_query(query);
+  var by_exe = $('#searchOptions').val() == 'exe_name';
+
+  // add delta seconds spent in matching windows on jdate to matches
+  function add_match(jdate, delta) {
+    // get start and end dates for this entry
+    if (start_date == 0 || jdate < start_date) {
+      start_date = jdate;
+    }
+    if (end_date == 0 || jdate > end_date) {
+      end_date = jdate;
+    }
+
+    jdate_str = jdate.toString('yyyy-MM-dd');
+
+    // add time for this entry to matches
+    if (jdate_str in matches) {
+      matches[jdate_str] = matches[jdate_str] + delta;
+    } else {
+      matches[jdate_str] = delta;
+    }
+  }
+
+  if (server) {
+    // The server adds up the matches per day
+    $.getJSON('api/days', {field: by_exe ? 'exe_name' : 'window_title', q: query}, function(data) {
+      $.each(data.days, function(date, delta) {
+        add_match(new Date(date), delta);
+      });
+      draw_matches();
+    });
+    return;
+  } else if (by_exe && rollups) {
+    // Exe name searches only need the per-day totals
+    Object.keys(rollups.days).forEach(function(date) {
+      var totals = rollups.days[date];
+      var names = Object.keys(totals);
+      var hits = count_hits(names, groups);
+      var delta = 0;
+      names.forEach(function(exe_name, i) {
+        delta += totals[exe_name] * hits[i];
+      });
+      if (delta) {
+        add_match(new Date(date), delta);
+      }
+    });
+  } else if (!by_exe && index) {
+    // Intersect the titles matching each token of a group, then add up the
+    // rows with those titles (once per matching group)
+    var title_hits = {};
+    groups.forEach(function(group) {
+      var codes = titles_containing(group[0]);
+      for (var t = 1; t < group.length; t++) {
+        codes = intersect(codes, titles_containing(group[t]));
+      }
+      codes.forEach(function(code) {
+        title_hits[code] = (title_hits[code] || 0) + 1;
+      });
+    });
+
+    var title_rows = rows_by_title();
+    Object.keys(title_hits).forEach(function(code) {
+      code = Number(code);
+      for (var r = title_rows.starts[code]; r < title_rows.starts[code + 1]; r++) {
+        var row = title_rows.rows[r];
+        add_match(day_of(watchme.start_time[row]), 
+                  (watchme.end_time[row] - watchme.start_time[row]) * title_hits[code]);
+      }
+    });
+  } else {
+    // Match the query against each distinct window title (or exe name) 
+    // once: hits[code] is the number of query groups that string matches
+    var hits = by_exe ? count_hits(watchme.exe_names, groups) : count_hits(watchme.window_titles, groups);
+    var codes = by_exe ? watchme.exe_code : watchme.title_code;
+
+    watchme.ranges.forEach(function(range) {
+      for (var row = range[0]; row < range[1]; row++) {
+        var row_hits = hits[codes[row]];
+        // if any search token is in the window title for this entry, add this entry to matches
+        if (row_hits) {
+          // time spent in window for this entry, once per matching group
+          add_match(day_of(watchme.start_time[row]), 
+                    (watchme.end_time[row] - watchme.start_time[row]) * row_hits);
         }
       }
-    })
-  });
-  
-  var values = []
-  var i_str = ""
-  
-  // create a list of dates for HighChart
-  // iterate through dates -- for each date, if we have time for date in matches, use it, otherwise set time to zero
-  var i = new Date(start_date);
-  while(i <= end_date) {
-    i_str = i.toString('yyyy-MM-dd');
-    if (i_str in matches) {
-      values.push(matches[i_str]/60); // convert from seconds to minutes for display
-    } else {
-      values.push(0);
+    });
+  }
+  draw_matches();
+
+  // If the latest chunk is still on its way, search again once it is in.
+  // Older chunks are loaded as the chart is zoomed out (see chart_zoomed),
+  // unless the months loaded have too little to chart for it to be zoomed:
+  // then they are all loaded and searched once more.
+  if (watchme.chunks && !(by_exe && rollups) && chunks_pending()) {
+    if (watchme.ranges.length == 0) {
+      load_chunk(searchit_simple);
+    } else if (start_date == 0 || end_date - start_date < chart_max_zoom) {
+      load_all_chunks(searchit_simple);
     }
-    i.setDate(i.getDate() + 1)
   }
+
+  // chart the time per day in matches
+  function draw_matches() {
+    if (start_date == 0) {
+      return; // nothing matched
+    }
+    var values = []
+    var i_str = ""
   
-  // finally, draw the chart
-  var ms = Date.UTC(start_date.getUTCFullYear(), start_date.getUTCMonth(), start_date.getUTCDate());
-  draw_chart(query, ms, values);
+    // create a list of dates for HighChart
+    // iterate through dates -- for each date, if we have time for date in matches, use it, otherwise set time to zero
+    var i = new Date(start_date);
+    while(i <= end_date) {
+      i_str = i.toString('yyyy-MM-dd');
+      if (i_str in matches) {
+        values.push(matches[i_str]/60); // convert from seconds to minutes for display
+      } else {
+        values.push(0);
+      }
+      i.setDate(i.getDate() + 1)
+    }
+  
+    // finally, draw the chart
+    var ms = Date.UTC(start_date.getUTCFullYear(), start_date.getUTCMonth(), start_date.getUTCDate());
+    draw_chart(query, ms, values);
+  }
 }
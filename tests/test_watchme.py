@@ -0,0 +1,646 @@
+'''
+Tests for watchme.py. The logs are written by a Logger driven by a
+SimulatedSampler, so they run anywhere (not only on Windows) in a few
+seconds. Run them from the top directory with:
+
+  python -m unittest discover tests
+'''
+import os
+import sys
+import csv
+import datetime
+import httplib
+import json
+import random
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import watchme
+
+
+def simulate(directory, days=2, seed=1):
+    '''
+    Logs days of simulated activity (starting at 9 AM on March 1st, 2013) to
+    directory
+    '''
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    start = time.mktime((2013, 3, 1, 9, 0, 0, 0, 0, -1))
+    trace = watchme.random_trace(days * 24 * 3600, seed=seed, idle_chance=0.05)
+    watchme.Logger(directory, sampler=watchme.SimulatedSampler(trace, start=start)).run()
+
+
+def log_paths(directory):
+    return [log.path for log in watchme.log_files(directory)]
+
+
+def analyze(directory, js_format="chunks"):
+    '''
+    Runs analyze() on directory and returns the Analyzer and what it wrote, by
+    file name
+    '''
+    analyzer = watchme.Analyzer(directory, js_format=js_format)
+    popen = watchme.subprocess.Popen
+    watchme.subprocess.Popen = lambda *args, **kwargs: None # don't launch the page
+    try:
+        analyzer.analyze()
+    finally:
+        watchme.subprocess.Popen = popen
+    outputs = {}
+    fnames = ["alldata.js", "rollups.js", "index.js"]
+    if os.path.exists(os.path.join(directory, "chunks")):
+        fnames += [os.path.join("chunks", f) for f in os.listdir(os.path.join(directory, "chunks"))]
+    for fname in fnames:
+        with open(os.path.join(directory, fname), "rb") as fd:
+            outputs[fname] = fd.read()
+    return analyzer, outputs
+
+
+class SimulatedLogTest(unittest.TestCase):
+    '''
+    Base class for the tests that read the logs of a simulated run, which is
+    logged once for all of them; each test gets a copy it can change
+    '''
+    @classmethod
+    def setUpClass(cls):
+        cls.logs = tempfile.mkdtemp()
+        simulate(cls.logs)
+        cls.full = list(watchme.iter_intervals(cls.logs))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.logs)
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.directory = os.path.join(self.tmp, "data")
+        shutil.copytree(self.logs, self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def assertTotalsAlmostEqual(self, expected, got):
+        '''
+        Checks that the {key: {exe_name: seconds}} tables of two Rollups are
+        the same, up to rounding
+        '''
+        self.assertEqual(sorted(expected), sorted(got))
+        for key, totals in expected.iteritems():
+            self.assertEqual(sorted(totals), sorted(got[key]))
+            for exe_name, seconds in totals.iteritems():
+                self.assertAlmostEqual(seconds, got[key][exe_name], places=6)
+
+
+class ParseTest(SimulatedLogTest):
+
+    def test_logged(self):
+        self.assertEqual(len(watchme.log_files(self.directory)), 3)
+        self.assertTrue(len(self.full) > 1000)
+
+    def test_pool_matches_serial(self):
+        serial = watchme.Analyzer(self.directory)
+        copy = os.path.join(self.tmp, "copy")
+        shutil.copytree(self.directory, copy)
+        pool = watchme.Analyzer(copy, workers=3)
+        self.assertEqual(list(serial.host_items(serial.update_hosts())),
+            list(pool.host_items(pool.update_hosts())))
+        self.assertEqual([i for host, i in serial.host_items(serial.update_hosts())],
+            self.full)
+
+    def test_mapped_reader_matches_reader(self):
+        # Add rows with quoted titles and a corrupt one to the last log
+        path = log_paths(self.directory)[-1]
+        t = self.full[-1].end_time
+        with open(path, "ab") as fd:
+            writer = csv.writer(fd)
+            writer.writerow(["window_info", "a.exe", "comma, in title", t + 1])
+            writer.writerow(["window_info", "a.exe", "line\nbreak \"quoted\"", t + 2])
+            fd.write("window_info,b.exe,torn\0\0\0\n")
+            writer.writerow(["idle_time", t + 3, t + 10])
+            writer.writerow(["window_info", "b.exe", "last", t + 10])
+        state = None
+        for path in log_paths(self.directory):
+            reader = watchme.LogReader(path, 0, state)
+            mapped = watchme.MappedLogReader(path, 0, state)
+            self.assertEqual(list(reader), list(mapped))
+            for attr in ("offset", "state", "first_time", "idle", "errors"):
+                self.assertEqual(getattr(reader, attr), getattr(mapped, attr))
+            filtered = watchme.MappedLogReader(path, 0, state, exe_names=["app1.exe"])
+            self.assertEqual([i for i in watchme.LogReader(path, 0, state)
+                if i.exe_name == "app1.exe"], list(filtered))
+            state = reader.state
+        self.assertEqual(len(reader.errors), 1)
+
+
+class BoundaryTest(unittest.TestCase):
+    '''
+    The window left open at the end of one log file is closed by the first
+    row of the next day's, however the logs are read
+    '''
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def log(self, day, *rows):
+        fname = "2013-03-%02d windows.csv" % day
+        with open(os.path.join(self.directory, fname), "ab") as fd:
+            csv.writer(fd).writerows(rows)
+
+    def at(self, day, hour, minute=0):
+        return time.mktime((2013, 3, day, hour, minute, 0, 0, 0, -1))
+
+    def replays(self):
+        '''
+        Returns the intervals as iter_intervals, the Analyzer's cache,
+        Analyzer.intervals() and an ActivityDB read them
+        '''
+        analyzer = watchme.Analyzer(self.directory)
+        cached = [i for host, i in analyzer.host_items(analyzer.update_hosts())]
+        db = watchme.ActivityDB(os.path.join(self.directory, "watchme.db"))
+        try:
+            db.import_logs(self.directory)
+            imported = list(db.intervals())
+        finally:
+            db.close()
+        return [list(watchme.iter_intervals(self.directory)), cached,
+            analyzer.intervals(), imported]
+
+    def test_over_the_weekend(self):
+        # Friday evening, then the machine is off until Monday morning
+        self.log(1, ["window_info", "excel.exe", "budget", self.at(1, 17, 30)],
+            ["window_info", "outlook.exe", "Inbox", self.at(1, 17, 55)])
+        self.log(4, ["window_info", "excel.exe", "budget", self.at(4, 8)],
+            ["window_info", "outlook.exe", "Inbox", self.at(4, 9)])
+        for intervals in self.replays():
+            self.assertEqual([(i.exe_name, i.date) for i in intervals],
+                [("excel.exe", "2013/03/01"), ("excel.exe", "2013/03/04")])
+
+    def test_over_midnight(self):
+        self.log(1, ["window_info", "outlook.exe", "Inbox", self.at(1, 23, 30)])
+        self.log(2, ["window_info", "excel.exe", "budget", self.at(2, 0, 15)],
+            ["window_info", "outlook.exe", "Inbox", self.at(2, 1)])
+        for intervals in self.replays():
+            self.assertEqual([(i.exe_name, i.end_time - i.start_time) for i in intervals],
+                [("outlook.exe", 45 * 60), ("excel.exe", 45 * 60)])
+
+    def test_overnight_capped(self):
+        # Shut down in the evening, started again the next morning
+        self.log(1, ["window_info", "outlook.exe", "Inbox", self.at(1, 17, 55)])
+        self.log(2, ["window_info", "excel.exe", "budget", self.at(2, 8)],
+            ["window_info", "outlook.exe", "Inbox", self.at(2, 9)])
+        for intervals in self.replays():
+            self.assertEqual([(i.exe_name, i.end_time - i.start_time) for i in intervals],
+                [("outlook.exe", watchme.BRIDGE_LIMIT), ("excel.exe", 3600)])
+
+
+class RollupsTest(SimulatedLogTest):
+
+    @unittest.skipIf(watchme.numpy is None, "NumPy is not installed")
+    def test_numpy_matches_loop(self):
+        analyzer = watchme.Analyzer(self.directory)
+        loop = watchme.Rollups()
+        arrays = watchme.IntervalArrays(analyzer.exe_names, analyzer.window_titles)
+        for item in analyzer.encode(self.full):
+            loop.add(analyzer.exe_names[item[0]], item[2], item[3], item[4])
+            arrays.append(item)
+        arrays.finish()
+        vectorized = arrays.rollups()
+        for table in ("days", "hours"):
+            self.assertTotalsAlmostEqual(getattr(loop, table), getattr(vectorized, table))
+
+
+class IntervalsTest(SimulatedLogTest):
+
+    def replay(self, start, end, exe_names=None):
+        return [watchme.make_interval(i.exe_name, i.window_title,
+                max(i.start_time, start), min(i.end_time, end)) for i in self.full
+            if i.start_time < end and i.end_time > start and
+                (exe_names is None or i.exe_name in exe_names)]
+
+    def test_matches_replay(self):
+        analyzer = watchme.Analyzer(self.directory)
+        self.assertEqual(analyzer.intervals(), self.full)
+        rand = random.Random(0)
+        lo, hi = self.full[0].start_time - 3600, self.full[-1].end_time + 3600
+        for n in xrange(100):
+            start = rand.uniform(lo, hi)
+            end = start + rand.choice([60, 3600, 6 * 3600, 86400])
+            exe_names = ["app0.exe", "app3.exe"] if n % 3 == 0 else None
+            self.assertEqual(analyzer.intervals(start, end, exe_names),
+                self.replay(start, end, exe_names))
+
+
+class QueryDataTest(SimulatedLogTest):
+    '''
+    QueryData.appended() gives the same QueryData as building it afresh
+    '''
+    def setUp(self):
+        SimulatedLogTest.setUp(self)
+        self.other = os.path.join(self.directory, "hosts", "other-host")
+        simulate(self.other, days=1, seed=2)
+
+    def append(self, directory, day, t, count, exe_name="new.exe", title="new %d"):
+        '''
+        Appends count window changes, 10 seconds apart from t on, to the log
+        of day (in March 2013) in directory; returns the time of the last
+        '''
+        with open(os.path.join(directory, "2013-03-%02d windows.csv" % day), "ab") as fd:
+            writer = csv.writer(fd)
+            for i in xrange(count):
+                t += 10
+                writer.writerow(["window_info", exe_name, title % i, t])
+        return t
+
+    def columns(self, data):
+        return [(data.exe_names[data.exe_code[row]], data.window_titles[data.title_code[row]],
+            data.start_time[row], data.end_time[row], data.host_code[row])
+            for row in xrange(len(data))]
+
+    def check(self, title_rules=None):
+        analyzer = watchme.Analyzer(self.directory, title_rules=title_rules)
+        os.makedirs(analyzer.cachedir)
+        data = watchme.QueryData(analyzer)
+        def refresh(data):
+            appended = data.appended(analyzer, analyzer.update_hosts())
+            self.assertTrue(appended is not None)
+            return appended
+
+        # Ticking titles on the same day, then the next day's log, then the
+        # other host catching up, with rows from before our latest ones
+        t = self.append(self.directory, 3, max(data.end_time) + 5, 30,
+            "clock.exe", "Timer 0:%02d - Clock")
+        t = self.append(self.directory, 3, t, 5)
+        data = refresh(data)
+        t = self.append(self.directory, 4, time.mktime((2013, 3, 4, 0, 5, 0, 0, 0, -1)), 7)
+        data = refresh(data)
+        self.append(self.other, 4, t - 40, 4, "other.exe")
+        data = refresh(data)
+        self.append(self.other, 4, t - 600, 2, "late.exe")
+        data = refresh(data)
+
+        fresh = watchme.QueryData(analyzer)
+        self.assertEqual(self.columns(data), self.columns(fresh))
+        self.assertEqual(data.etag, fresh.etag)
+        for table in ("days", "hours"):
+            self.assertTotalsAlmostEqual(getattr(fresh.rollups, table),
+                getattr(data.rollups, table))
+        if watchme.numpy is not None:
+            self.assertEqual(data.stats.top_titles(20), fresh.stats.top_titles(20))
+
+        # A log that was rewritten has the QueryData built afresh
+        with open(os.path.join(self.directory, "2013-03-01 windows.csv"), "ab") as fd:
+            fd.truncate(100)
+        self.assertEqual(data.appended(analyzer, analyzer.update_hosts()), None)
+
+    def test_appended(self):
+        self.check()
+
+    def test_appended_with_title_rules(self):
+        self.check(watchme.TitleRules())
+
+    def test_appended_with_title_rules_gap(self):
+        self.check(watchme.TitleRules(gap=30))
+
+
+class ArchiveTest(SimulatedLogTest):
+    '''
+    Archived logs read back the same, whatever point archive_logs got to 
+    before a crash
+    '''
+    today = datetime.date(2013, 3, 3)
+    archive = "2013-03 windows.zip"
+
+    def archived(self):
+        self.assertEqual(watchme.archive_logs(self.directory, self.today), 2)
+        return os.path.join(self.directory, self.archive)
+
+    def member(self, fname):
+        archive = zipfile.ZipFile(os.path.join(self.directory, self.archive))
+        try:
+            return archive.read(fname)
+        finally:
+            archive.close()
+
+    def outputs(self):
+        return analyze(self.directory)[1]
+
+    def test_archive(self):
+        self.archived()
+        self.assertEqual(sorted(f for f in os.listdir(self.directory) if f.endswith("windows.csv")),
+            ["2013-03-03 windows.csv"])
+        self.assertEqual(list(watchme.iter_intervals(self.directory)), self.full)
+
+    def test_analyze_unchanged(self):
+        before = self.outputs()
+        self.archived()
+        self.assertEqual(self.outputs(), before) # from the cache
+        shutil.rmtree(os.path.join(self.directory, "cache"))
+        self.assertEqual(self.outputs(), before) # from the archive
+
+    def test_tmp_restored(self):
+        # A crash between removing the old archive and moving the new one in
+        path = self.archived()
+        os.rename(path, path + ".tmp")
+        self.assertEqual(watchme.archive_logs(self.directory, self.today), 0)
+        self.assertFalse(os.path.exists(path + ".tmp"))
+        self.assertEqual(list(watchme.iter_intervals(self.directory)), self.full)
+
+    def test_tmp_dropped(self):
+        # A crash while the archive was being written leaves the logs as 
+        # they were, and the half written archive is thrown away
+        with open(os.path.join(self.directory, self.archive + ".tmp"), "wb") as fd:
+            fd.write("PK\x03\x04 half written")
+        self.archived()
+        self.assertFalse(os.path.exists(os.path.join(self.directory, self.archive + ".tmp")))
+        self.assertEqual(list(watchme.iter_intervals(self.directory)), self.full)
+
+    def test_logged_again(self):
+        # A day logged to after it was archived (e.g. the clock went back)
+        fname = "2013-03-02 windows.csv"
+        self.archived()
+        archived = self.member(fname)
+        t = self.full[-1].end_time
+        with open(os.path.join(self.directory, fname), "wb") as fd:
+            csv.writer(fd).writerow(["window_info", "late.exe", "late", t + 1])
+        with open(os.path.join(self.directory, fname), "rb") as fd:
+            more = fd.read()
+        self.assertEqual(watchme.archive_logs(self.directory, self.today), 1)
+        self.assertEqual(self.member(fname), archived + more)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, fname)))
+
+    def test_csv_left_behind(self):
+        # A crash after the archive was moved into place, before the logs in
+        # it were deleted
+        self.archived()
+        for fname in ("2013-03-01 windows.csv", "2013-03-02 windows.csv"):
+            shutil.copy2(os.path.join(self.logs, fname), self.directory)
+        archived = self.member("2013-03-01 windows.csv")
+        self.assertEqual(watchme.archive_logs(self.directory, self.today), 2)
+        self.assertEqual(self.member("2013-03-01 windows.csv"), archived)
+        self.assertEqual(list(watchme.iter_intervals(self.directory)), self.full)
+
+
+class AnalyzeTest(SimulatedLogTest):
+    '''
+    analyze() appends new rows to what it wrote last time, and the result is
+    the same as analyzing the logs afresh
+    '''
+    def append(self, date, titles):
+        '''
+        Appends window changes to titles, 10 seconds apart, to the log of date
+        (starting at 9 AM if the log is new)
+        '''
+        path = os.path.join(self.directory, "%s windows.csv" % date)
+        t = self.t if os.path.exists(path) else time.mktime(date.timetuple()) + 9 * 3600
+        with open(path, "ab") as fd:
+            writer = csv.writer(fd)
+            for title in titles:
+                t += 10
+                writer.writerow(["window_info", "new.exe", title, t])
+        self.t = t
+
+    def fresh(self, js_format):
+        copy = os.path.join(self.tmp, "fresh")
+        if os.path.exists(copy):
+            shutil.rmtree(copy)
+        shutil.copytree(self.directory, copy, 
+            ignore=shutil.ignore_patterns("cache", "chunks", "*.js", "*.json"))
+        return analyze(copy, js_format)[1]
+
+    def check(self, js_format):
+        analyze(self.directory, js_format)
+        self.t = self.full[-1].end_time
+
+        # New rows on the last day, with a new title and one seen before
+        self.append(datetime.date(2013, 3, 3), ["new %d" % i for i in xrange(5)])
+        self.append(datetime.date(2013, 3, 3), [self.full[0].window_title])
+        analyzer, outputs = analyze(self.directory, js_format)
+        self.assertEqual(analyzer.stats.counters["exported_rows"], 6)
+        self.assertEqual(outputs, self.fresh(js_format))
+
+        # The next month's log, which leaves the earlier months alone
+        march = os.path.join(self.directory, "chunks", "2013-03.js")
+        if js_format == "chunks":
+            os.utime(march, (0, 0))
+        self.append(datetime.date(2013, 4, 1), ["april %d" % i for i in xrange(3)])
+        analyzer, outputs = analyze(self.directory, js_format)
+        self.assertEqual(analyzer.stats.counters["exported_rows"], 2) # the last is open
+        self.assertEqual(outputs, self.fresh(js_format))
+        if js_format == "chunks":
+            self.assertEqual(sorted(f for f in outputs if f.startswith("chunks")),
+                [os.path.join("chunks", "2013-03.js"), os.path.join("chunks", "2013-04.js")])
+            self.assertEqual(os.path.getmtime(march), 0)
+
+    def test_chunks_appended(self):
+        self.check("chunks")
+
+    def test_array_appended(self):
+        self.check("array")
+
+    def test_chunks_rebuilt(self):
+        # A last chunk left half written by a crash has them all rebuilt
+        analyze(self.directory)
+        self.t = self.full[-1].end_time
+        with open(os.path.join(self.directory, "chunks", "2013-03.js"), "ab") as fd:
+            fd.truncate(100)
+        self.append(datetime.date(2013, 3, 3), ["new %d" % i for i in xrange(5)])
+        analyzer, outputs = analyze(self.directory)
+        self.assertEqual(analyzer.stats.counters["exported_rows"], len(self.full) + 5)
+        self.assertEqual(outputs, self.fresh("chunks"))
+
+
+class QueryServerTest(SimulatedLogTest):
+    '''
+    The QueryServer only answers requests for its own address, and only 
+    serves the page's files, not the data next to them
+    '''
+    def setUp(self):
+        SimulatedLogTest.setUp(self)
+        for fname in ("chart.html", "js/analysis.js", "data/alldata.js", "data/manifest.json"):
+            if not os.path.exists(os.path.dirname(os.path.join(self.tmp, fname))):
+                os.makedirs(os.path.dirname(os.path.join(self.tmp, fname)))
+            with open(os.path.join(self.tmp, fname), "wb") as fd:
+                fd.write(fname)
+        self.server = watchme.QueryServer(watchme.Analyzer(self.directory), root=self.tmp)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.host = "127.0.0.1:%d" % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        SimulatedLogTest.tearDown(self)
+
+    def get(self, path, host=None, etag=None):
+        '''
+        Returns the response to a GET of path as (status, ETag, body)
+        '''
+        conn = httplib.HTTPConnection(self.host)
+        try:
+            conn.putrequest("GET", path, skip_host=True)
+            conn.putheader("Host", host or self.host)
+            if etag:
+                conn.putheader("If-None-Match", etag)
+            conn.endheaders()
+            response = conn.getresponse()
+            return response.status, response.getheader("ETag"), response.read()
+        finally:
+            conn.close()
+
+    def test_host(self):
+        self.assertEqual(self.get("/api/exes")[0], 200)
+        self.assertEqual(self.get("/api/exes", "localhost:%d" % self.server.server_address[1])[0], 200)
+        for path in ("/api/exes", "/chart.html"):
+            self.assertEqual(self.get(path, "evil.com")[0], 403)
+            self.assertEqual(self.get(path, "evil.com:%d" % self.server.server_address[1])[0], 403)
+
+    def test_static(self):
+        self.assertEqual(self.get("/"), (200, self.get("/")[1], "chart.html"))
+        self.assertEqual(self.get("/js/analysis.js")[2], "js/analysis.js")
+        for path in ("/data/alldata.js", "/js/../data/manifest.json", "/js/%2e%2e/data/manifest.json",
+                "/data/2013-03-01%20windows.csv", "/js/"):
+            self.assertEqual(self.get(path)[0], 404)
+
+    def test_etag(self):
+        for path in ("/api/exes", "/api/days?q=app1", "/chart.html"):
+            status, etag, body = self.get(path)
+            self.assertEqual(status, 200)
+            self.assertEqual(self.get(path, etag=etag)[:2], (304, etag))
+        status, etag, body = self.get("/api/exes")
+        self.assertAlmostEqual(sum(seconds for exe_name, seconds in json.loads(body)["exes"]),
+            sum(i.end_time - i.start_time for i in self.full), places=3)
+
+
+class ActivityDBTest(SimulatedLogTest):
+
+    def test_matches_replay(self):
+        db = watchme.ActivityDB(os.path.join(self.tmp, "watchme.db"))
+        try:
+            self.assertEqual(db.import_logs(self.directory), len(self.full))
+            self.assertEqual(list(db.intervals()), self.full)
+            start = self.full[len(self.full) // 2].start_time
+            end = start + 6 * 3600
+            self.assertEqual(list(db.intervals(start, end, "app0.exe")),
+                [i for i in self.full if i.exe_name == "app0.exe" and
+                    i.start_time < end and i.end_time > start])
+            self.assertAlmostEqual(db.exe_time("app0.exe", start, end),
+                sum(min(i.end_time, end) - max(i.start_time, start) for i in self.full
+                    if i.exe_name == "app0.exe" and i.start_time < end and i.end_time > start),
+                places=6)
+        finally:
+            db.close()
+
+    def test_logged_matches_import(self):
+        # The rows the Logger adds as it goes are the ones in the CSV files
+        directory = os.path.join(self.tmp, "logged")
+        os.makedirs(directory)
+        start = time.mktime((2013, 3, 1, 9, 0, 0, 0, 0, -1))
+        trace = watchme.random_trace(24 * 3600, seed=2, idle_chance=0.05)
+        watchme.Logger(directory, sampler=watchme.SimulatedSampler(trace, start=start),
+            db=os.path.join(self.tmp, "logged.db")).run()
+        logged = watchme.ActivityDB(os.path.join(self.tmp, "logged.db"))
+        imported = watchme.ActivityDB(os.path.join(self.tmp, "imported.db"))
+        try:
+            imported.import_logs(directory)
+            self.assertEqual(list(logged.intervals()), list(imported.intervals()))
+            self.assertEqual(list(logged.intervals()), list(watchme.iter_intervals(directory)))
+        finally:
+            logged.close()
+            imported.close()
+
+
+class LogWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.now = time.mktime((2013, 3, 1, 23, 59, 0, 0, 0, -1))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self, fname):
+        with open(os.path.join(self.directory, fname), "rb") as fd:
+            return list(csv.reader(fd))
+
+    def test_rotation(self):
+        rotated = []
+        writer = watchme.LogWriter(self.directory, clock=lambda: self.now,
+            on_rotate=rotated.append)
+        writer.writerow(["window_info", "a.exe", "before", "1"])
+        writer.flush()
+        self.now += 120 # past midnight
+        writer.writerow(["window_info", "a.exe", "after", "2"])
+        writer.tick()
+        self.assertEqual(rotated, []) # still buffered
+        writer.close()
+        self.assertEqual(rotated, ["2013-03-02 windows.csv"])
+        self.assertEqual(self.read("2013-03-01 windows.csv"), [["window_info", "a.exe", "before", "1"]])
+        self.assertEqual(self.read("2013-03-02 windows.csv"), [["window_info", "a.exe", "after", "2"]])
+
+    def test_rotation_in_buffer(self):
+        # Rows buffered on both sides of midnight go to their own day's file
+        writer = watchme.LogWriter(self.directory, clock=lambda: self.now, max_rows=10)
+        writer.writerow(["window_info", "a.exe", "before", "1"])
+        self.now += 120
+        writer.writerow(["window_info", "a.exe", "after", "2"])
+        writer.close()
+        self.assertEqual(sorted(os.listdir(self.directory)),
+            ["2013-03-01 windows.csv", "2013-03-02 windows.csv"])
+        self.assertEqual(len(self.read("2013-03-01 windows.csv")), 1)
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal = os.path.join(self.directory, watchme.Journal.FILENAME)
+        self.log = os.path.join(self.directory, "2013-03-01 windows.csv")
+        with open(self.log, "wb") as fd:
+            fd.write("window_info,a.exe,one,100.0\r\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_recover_torn_write(self):
+        size = os.path.getsize(self.log)
+        batch = "window_info,a.exe,two,200.0\r\nwindow_info,b.exe,three,300.0\r\n"
+        watchme.Journal(self.journal).write([(os.path.basename(self.log), size, batch)])
+        with open(self.log, "ab") as fd:
+            fd.write(batch[:40]) # the crash cut the write short
+        self.assertEqual(watchme.Journal(self.journal).recover(self.directory), 1)
+        with open(self.log, "rb") as fd:
+            self.assertEqual(fd.read(), "window_info,a.exe,one,100.0\r\n" + batch)
+        self.assertEqual(os.path.getsize(self.journal), 0)
+
+    def test_torn_record_dropped(self):
+        size = os.path.getsize(self.log)
+        journal = watchme.Journal(self.journal)
+        journal.write([(os.path.basename(self.log), size, "window_info,b.exe,two,200.0\r\n")])
+        with open(self.journal, "ab") as fd:
+            fd.write(watchme.Journal.HEADER.pack(100, 0) + "window_info")
+        self.assertEqual(len(journal.records()), 1)
+        self.assertEqual(journal.recover(self.directory), 1)
+        with open(self.log, "rb") as fd:
+            self.assertEqual(fd.read(),
+                "window_info,a.exe,one,100.0\r\nwindow_info,b.exe,two,200.0\r\n")
+        self.assertEqual(journal.records(), [])
+
+    def test_logger_leaves_journal_empty(self):
+        directory = os.path.join(self.directory, "logger")
+        os.makedirs(directory)
+        simulate(directory, days=1)
+        journal = watchme.Journal(os.path.join(directory, watchme.Journal.FILENAME))
+        self.assertEqual(journal.records(), [])
+        self.assertEqual(journal.recover(directory), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -12,18 +12,32 @@ __main__ creates a Watcher
 Watcher instantiates a Logger and an Analyzer and connects them to a system 
   tray widget (which it also creates).
 
-Logger polls every second, collecting window info and writing it to CSV files
-  on disk, which are named according to the date. Logger starts when this
-  script is launched.
+Logger polls every second or so (see AdaptiveSchedule), collecting window info (from a Sampler: the Win32
+  API, or a simulated desktop for testing) and writing it to CSV files
+  on disk, which are named according to the date (see LogWriter, which 
+  buffers rows for a few seconds). Logger starts when this script is 
+  launched, after the logs of past days have been compressed into monthly
+  archives (see archive_logs), which are read just like the CSV files.
 
 Analyzer aggregates data from all of the CSV files and writes them to a JS
   file, then launches a web page (with the default browser) that lets the
-  user analyze the data. Analyzer is invoked via the system tray widget
-  right click menu.
+  user analyze the data. Parsed intervals are cached per log file (see 
+  Manifest) so only log files that changed since the last run are parsed 
+  again. The logs of other machines (hosts) can be analyzed along with 
+  this one's; their intervals are merged by time (see merge_intervals).
+
+The system tray widget right click menu opens the same web page from a 
+  QueryServer instead, which answers the page's queries from the Analyzer's 
+  cache so the browser doesn't have to load all of the data. An 
+  AnalysisWorker keeps the server's data up to date in the background.
 '''
 
-from ctypes import windll, Structure, c_ulong, byref
+from ctypes import Structure, c_ulong, byref
 import ctypes
+try:
+    from ctypes import windll
+except ImportError:
+    windll = None # not on Windows: only simulated samplers can be used
 import threading
 import time
 import os
@@ -32,11 +46,43 @@ import datetime
 import sys
 import subprocess
 import re
-from collections import namedtuple
+from collections import namedtuple, Counter
 import csv
+import json
+import itertools
+import multiprocessing
+import array
+import struct
+import base64
 import logging
+import random
+import sqlite3
+import bisect
+import hashlib
+import mimetypes
+import webbrowser
+import urlparse
+import BaseHTTPServer
+import SocketServer
+import zipfile
+import io
+import mmap
+import contextlib
+import cProfile
+import heapq
+import platform
+import zlib
+import copy
+
+try:
+    import numpy
+except ImportError:
+    numpy = None # aggregation falls back to a Python loop (see Rollups)
 
-from systrayicon import SysTrayIcon
+try:
+    from systrayicon import SysTrayIcon
+except ImportError:
+    SysTrayIcon = object # no pywin32: Logger and Analyzer still work headless
 
 
 def pointer_size():
@@ -58,21 +104,644 @@ class LastInputInfo(Structure):
                 ("dwTime", c_ulong)] # tick count of last input event
 
 
+class Sampler(object):
+  '''
+  Source of the information Logger polls for: how long the user has been 
+  idle and which window is in the foreground. Also supplies the clock Logger
+  runs on, so that simulated samplers can run faster than real time. 
+  Subclasses count the (API) calls they make in calls, a Counter.
+  '''
+  def idle_ms(self):
+      '''
+      Returns the number of milliseconds since the last input event
+      '''
+      raise NotImplementedError
+      
+  def foreground(self):
+      '''
+      Returns (exe_name, window_title) for the foreground window, or None if 
+      it couldn't be determined
+      '''
+      raise NotImplementedError
+      
+  def time(self):
+      return time.time()
+      
+  def sleep(self, seconds, wake=None):
+      '''
+      Sleeps for seconds, or until the threading.Event wake is set
+      '''
+      if wake:
+          wake.wait(seconds)
+      else:
+          time.sleep(seconds)
+      
+  def done(self):
+      '''
+      Returns True once there is nothing more to sample (Logger then stops)
+      '''
+      return False
+
+
+class Win32Sampler(Sampler):
+  '''
+  Samples the real desktop through the Win32 API.
+  
+  Exe names are cached per (window handle, process id), so a process is only
+  opened (and its handle closed again) the first time one of its windows 
+  comes to the foreground, rather than on every poll.
+  '''
+  MAX_CACHED_EXES = 256
+  
+  def __init__(self):
+      if windll is None:
+          raise RuntimeError("Win32Sampler requires MS Windows")
+      self.exe_names = {} # (hwnd, pid) -> exe name
+      self.calls = Counter()
+          
+  def idle_ms(self):
+      # Get idle time
+      # see: http://msdn.microsoft.com/en-us/library/ms646302%28VS.85%29.aspx
+      # GetTickCount() returns the tick count for the current time 
+      #   (ms since system boot)
+      # GetLastInputInfo(..) returns the tick count for the last 
+      #   input event, with some caveats
+      # idle_ms = GetTickCount() - GetLastInputInfo(..)
+      info = LastInputInfo()
+      info.cbSize = pointer_size() * 2
+      self.calls["GetLastInputInfo"] += 1
+      if(windll.user32.GetLastInputInfo(byref(info)) != 0):
+          self.calls["GetTickCount"] += 1
+          return windll.kernel32.GetTickCount() - info.dwTime
+      logging.warning("GetLastInputInfo failed")
+      return 0
+      
+  def foreground(self):
+      # Get foreground window information
+      wh = windll.user32.GetForegroundWindow()
+      textlen = windll.user32.GetWindowTextLengthA(wh) + 1
+      window_title = " " * textlen
+      windll.user32.GetWindowTextA(wh, window_title, textlen)
+      # Drop the terminating NUL, which csv.writer would drop anyway (and 
+      # the ActivityDB wouldn't)
+      window_title = window_title.split("\0", 1)[0]
+      pid = ctypes.c_int()
+      self.calls["GetForegroundWindow"] += 1
+      self.calls["GetWindowTextLengthA"] += 1
+      self.calls["GetWindowTextA"] += 1
+      self.calls["GetWindowThreadProcessId"] += 1
+      if not windll.user32.GetWindowThreadProcessId(wh, ctypes.byref(pid)):
+          warnings.warn("GetWindowThreadId failed (NULL tid)")
+          return None
+          
+      key = (wh, pid.value)
+      exe_name = self.exe_names.get(key)
+      if exe_name is None:
+          exe_name = self._exe_name(pid)
+          if len(self.exe_names) >= self.MAX_CACHED_EXES:
+              self.exe_names.clear()
+          if exe_name:
+              self.exe_names[key] = exe_name
+      return exe_name, window_title
+      
+  def _exe_name(self, pid):
+      '''
+      Returns the exe name of process pid
+      '''
+      self.calls["OpenProcess"] += 1
+      ph = windll.kernel32.OpenProcess(0x410, False, pid) 
+      try:
+          in_len = 128
+          out_len = 129
+          while out_len > in_len:
+              exe_name = " "*in_len
+              self.calls["GetProcessImageFileNameA"] += 1
+              out_len = windll.psapi.GetProcessImageFileNameA(ph, exe_name, in_len)
+              in_len += out_len
+      finally:
+          if ph:
+              self.calls["CloseHandle"] += 1
+              windll.kernel32.CloseHandle(ph)
+      return os.path.basename(exe_name[:out_len])
+
+
+def random_trace(duration, seed=0, exe_count=10, title_count=50, 
+                 switch_mean=30.0, idle_chance=0.02, idle_mean=600.0):
+    '''
+    Generates a random (but, for a given seed, always the same) activity 
+    trace for SimulatedSampler that lasts duration seconds: the user switches
+    between title_count titles of exe_count exes every switch_mean seconds on
+    average, and after each switch goes idle for idle_mean seconds on average
+    with probability idle_chance.
+    '''
+    rand = random.Random(seed)
+    elapsed = 0
+    while elapsed < duration:
+        seconds = min(rand.expovariate(1.0 / switch_mean), duration - elapsed)
+        exe = rand.randrange(exe_count)
+        title = rand.randrange(title_count)
+        yield seconds, "app%d.exe" % exe, "window %d of app%d" % (title, exe)
+        elapsed += seconds
+        if elapsed < duration and rand.random() < idle_chance:
+            seconds = min(rand.expovariate(1.0 / idle_mean), duration - elapsed)
+            yield seconds, None, None
+            elapsed += seconds
+
+
+class SimulatedSampler(Sampler):
+  '''
+  Deterministic stand-in for Win32Sampler that replays an activity trace on a
+  simulated clock, so Logger can run (and be load tested) anywhere, and much
+  faster than real time. 
+  
+  trace is a sequence of (seconds, exe_name, window_title) segments (see 
+  random_trace); in a segment with exe_name None the user is away: there is
+  no input and the foreground window doesn't change. The clock starts at 
+  start (default: now) and is advanced by sleep(), which only really sleeps
+  (for seconds / speed) if speed is given. Once the trace is used up, done()
+  returns True.
+  
+  >>> sampler = SimulatedSampler(random_trace(7 * 24 * 3600))
+  >>> Logger("data", sampler=sampler).run()
+  '''
+  def __init__(self, trace, start=None, speed=None):
+      self.calls = Counter()
+      self.trace = iter(trace)
+      self.now = time.time() if start is None else start
+      self.speed = speed
+      self.window = ("", "")
+      self.segment_end = self.now
+      self.idle_since = None # start of the current idle segment
+      self.finished = False
+      
+  def _advance(self):
+      '''
+      Moves to the trace segment the clock is in
+      '''
+      while not self.finished and self.now >= self.segment_end:
+          try:
+              seconds, exe_name, window_title = next(self.trace)
+          except StopIteration:
+              self.finished = True
+              break
+          if exe_name is None:
+              if self.idle_since is None:
+                  self.idle_since = self.segment_end
+          else:
+              self.window = (exe_name, window_title)
+              self.idle_since = None
+          self.segment_end += seconds
+          
+  def idle_ms(self):
+      self.calls["idle_ms"] += 1
+      self._advance()
+      if self.idle_since is None:
+          return 0
+      return int((self.now - self.idle_since) * 1000)
+      
+  def foreground(self):
+      self.calls["foreground"] += 1
+      self._advance()
+      return self.window
+      
+  def time(self):
+      return self.now
+      
+  def sleep(self, seconds, wake=None):
+      if self.speed:
+          time.sleep(seconds / float(self.speed))
+      self.now += seconds
+      
+  def done(self):
+      self._advance()
+      return self.finished
+
+
+def replace_file(tmp, path):
+    '''
+    Moves the file tmp to path, replacing whatever is there. os.rename won't
+    replace files on Windows, so there path has to be removed first; if we 
+    crash in between, restore_file() puts tmp in its place.
+    '''
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        if not os.path.exists(path):
+            raise
+        os.remove(path)
+        os.rename(tmp, path)
+        
+        
+def restore_file(path, check=None):
+    '''
+    Finishes a replace_file(path + ".tmp", path) that a crash cut short: if
+    path is missing but the temporary file is there (and check(tmp), if 
+    given, says it is complete), moves it into place. Returns whether it did.
+    '''
+    tmp = path + ".tmp"
+    if os.path.exists(path) or not os.path.exists(tmp):
+        return False
+    if check and not check(tmp):
+        return False
+    os.rename(tmp, path)
+    logging.warning("restored %s from %s" % (path, tmp))
+    return True
+    
+    
+class Stats(object):
+  '''
+  Performance counters of one component (name, e.g. "logger"): timers, 
+  which keep the count, total, mean, max and last of the durations added 
+  to them, and plain counters. save() writes them to a JSON stats file, 
+  under name, next to those of the other components, so that how watchme 
+  performs can be tracked over time.
+  
+  >>> with stats.timed("parse"):
+  ...     parse()
+  '''
+  lock = threading.Lock() # for the stats files, which components share
+  
+  def __init__(self, name):
+      self.name = name
+      self.started = time.time()
+      self.timers = {}
+      self.counters = {}
+      
+  def add(self, timer, seconds):
+      '''
+      Adds a duration to timer
+      '''
+      t = self.timers.get(timer)
+      if t is None:
+          t = self.timers[timer] = {"count": 0, "total": 0.0, "max": 0.0}
+      t["count"] += 1
+      t["total"] += seconds
+      t["max"] = max(t["max"], seconds)
+      t["last"] = seconds
+      
+  def count(self, counter, n=1):
+      '''
+      Adds n to counter
+      '''
+      self.counters[counter] = self.counters.get(counter, 0) + n
+      
+  @contextlib.contextmanager
+  def timed(self, timer):
+      '''
+      Context manager that adds the time spent in it to timer
+      '''
+      start = time.time()
+      try:
+          yield
+      finally:
+          self.add(timer, time.time() - start)
+          
+  def to_dict(self):
+      timers = {}
+      for name, t in self.timers.iteritems():
+          timers[name] = dict(t, mean=t["total"] / t["count"])
+      return {"started": self.started, "saved": time.time(), 
+          "timers": timers, "counters": self.counters}
+          
+  def save(self, filename):
+      '''
+      Writes the stats to the JSON file filename, keeping the other 
+      components' stats in it. Failing to is logged, not raised.
+      '''
+      with Stats.lock:
+          try:
+              data = {}
+              restore_file(filename)
+              if os.path.exists(filename):
+                  try:
+                      with open(filename, "rb") as fd:
+                          data = json.load(fd)
+                  except ValueError:
+                      pass # start over
+              data[self.name] = self.to_dict()
+              tmp = filename + ".tmp"
+              with open(tmp, "wb") as fd:
+                  json.dump(data, fd, indent=2, sort_keys=True, encoding="latin-1")
+              replace_file(tmp, filename)
+          except (IOError, OSError) as e:
+              logging.error("writing stats failed: " + str(e))
+
+
+class Journal(object):
+  '''
+  Write-ahead journal that makes LogWriter's appends to the CSV files crash
+  safe. A batch of rows is first written here as framed records, one per 
+  log file: uint32 length and uint32 CRC-32 (little endian) of the payload,
+  which is the log file name, the file's size before the batch and the 
+  batch's CSV text, separated by newlines. The journal is synced to disk 
+  before the CSV files are written, and emptied once they are synced too, 
+  so it only ever holds the batch in flight. 
+  
+  recover() replays it: records up to the first torn or corrupt one are 
+  applied by truncating their log file to the recorded size (dropping 
+  whatever part of the batch made it there) and writing the batch again. 
+  That only takes as long as the last batch, however big the logs are.
+  '''
+  HEADER = struct.Struct("<II")
+  FILENAME = "journal.dat" # in the log directory
+  
+  def __init__(self, path):
+      self.path = path
+      
+  def write(self, records):
+      '''
+      Appends (fname, size, data) records and syncs them to disk
+      '''
+      with open(self.path, "ab") as fd:
+          for fname, size, data in records:
+              payload = "%s\n%d\n%s" % (fname, size, data)
+              fd.write(self.HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff))
+              fd.write(payload)
+          fd.flush()
+          os.fsync(fd.fileno())
+          
+  def clear(self):
+      '''
+      Empties the journal, once the batch in it is safely in the log files
+      '''
+      with open(self.path, "wb"):
+          pass
+          
+  def records(self):
+      '''
+      Returns the (fname, size, data) records in the journal, up to the 
+      first that is incomplete or fails its checksum
+      '''
+      records = []
+      if not os.path.exists(self.path):
+          return records
+      with open(self.path, "rb") as fd:
+          while True:
+              header = fd.read(self.HEADER.size)
+              if len(header) < self.HEADER.size:
+                  break
+              length, crc = self.HEADER.unpack(header)
+              payload = fd.read(length)
+              if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+                  logging.warning("dropping torn journal record at %d" % (fd.tell() - len(payload)))
+                  break
+              fname, size, data = payload.split("\n", 2)
+              records.append((fname, int(size), data))
+      return records
+      
+  def recover(self, logdir):
+      '''
+      Brings the log files in logdir in line with the records in the 
+      journal, then empties it. Returns the number of records replayed.
+      '''
+      records = self.records()
+      for fname, size, data in records:
+          path = os.path.join(logdir, fname)
+          with open(path, "ab") as fd:
+              if os.fstat(fd.fileno()).st_size >= size:
+                  fd.truncate(size)
+              else:
+                  logging.warning("%s is shorter than journaled; appending" % fname)
+              fd.write(data)
+              fd.flush()
+              os.fsync(fd.fileno())
+      if records:
+          logging.info("replayed %d journal records" % len(records))
+      self.clear()
+      return len(records)
+      
+      
+class LogWriter(object):
+  '''
+  Writes log rows to the day's CSV file ("YYYY-MM-DD windows.csv") in logdir.
+  Keeps the file open instead of reopening it for every row, switches to a 
+  new file at local midnight and buffers rows, writing them out when 
+  max_rows have piled up or the oldest has waited flush_interval seconds 
+  (see tick()) and when the writer is closed. clock is the time source used
+  for all of this. on_rotate, if given, is called with the name of the new 
+  file whenever the writer moves on from one day's file to the next.
+  
+  If journal (a path) is given, every flush goes through a Journal there, 
+  so a crash never leaves a torn row behind; the journal is recovered 
+  when the writer is created.
+  '''
+  def __init__(self, logdir, flush_interval=5, max_rows=100, clock=time.time,
+               on_rotate=None, journal=None):
+      self.logdir = logdir
+      self.clock = clock
+      self.on_rotate = on_rotate
+      self.journal = Journal(journal) if journal else None
+      self.journaled = 0 # buffered rows that are in the journal
+      if self.journal:
+          self.journal.recover(logdir)
+      self.flush_interval = flush_interval
+      self.max_rows = max_rows
+      self.rows = [] # (day file name, row) waiting to be written
+      self.first_buffered = None # time the oldest buffered row was added
+      self.fd = None
+      self.fname = None
+      self.day_end = 0 # local midnight at the end of the current day
+      self.day_fname = None
+      
+  def _current_fname(self, now):
+      '''
+      Returns the log file name for time now, recomputing it only once a day
+      '''
+      if now >= self.day_end:
+          today = datetime.datetime.fromtimestamp(now)
+          self.day_fname = today.strftime("%Y-%m-%d windows.csv")
+          tomorrow = today.date() + datetime.timedelta(days=1)
+          self.day_end = time.mktime(tomorrow.timetuple())
+      return self.day_fname
+      
+  def writerow(self, row):
+      '''
+      Buffers row for the current day's log file
+      '''
+      now = self.clock()
+      self.rows.append((self._current_fname(now), row))
+      if self.first_buffered is None:
+          self.first_buffered = now
+      if len(self.rows) >= self.max_rows:
+          self.flush()
+          
+  def tick(self):
+      '''
+      Flushes the buffered rows if the oldest has waited long enough; call 
+      this periodically
+      '''
+      if self.first_buffered is not None and \
+              self.clock() - self.first_buffered >= self.flush_interval:
+          self.flush()
+          
+  def flush(self):
+      '''
+      Writes the buffered rows to disk. If that fails the rows stay buffered
+      and are retried on the next flush.
+      '''
+      try:
+          if self.journal:
+              self._journal_rows()
+          while self.rows:
+              fname, row = self.rows[0]
+              if fname != self.fname:
+                  # Rotate: close yesterday's file and open today's
+                  rotated = self.fname is not None
+                  self._close_fd()
+                  self.fd = open(os.path.join(self.logdir, fname), "ab")
+                  self.writer = csv.writer(self.fd)
+                  self.fname = fname
+                  if rotated and self.on_rotate:
+                      self.on_rotate(fname)
+              self.writer.writerow(row)
+              self.rows.pop(0)
+              self.journaled = max(0, self.journaled - 1)
+          if self.fd:
+              self.fd.flush()
+              if self.journal:
+                  os.fsync(self.fd.fileno())
+          if self.journal:
+              self.journal.clear()
+              self.journaled = 0
+          self.first_buffered = None
+      except (IOError, OSError) as e:
+          logging.error("log writing failed: " + str(e))
+          self._close_fd()
+          
+  def _journal_rows(self):
+      '''
+      Writes the buffered rows to the journal, one record per log file. If
+      the last flush failed half way, the rows it journaled are replayed 
+      from the journal instead.
+      '''
+      if self.journaled:
+          self._close_fd()
+          self.journal.recover(self.logdir)
+          del self.rows[:self.journaled]
+          self.journaled = 0
+      records = []
+      sizes = {}
+      if self.fd:
+          self.fd.flush()
+      for fname, rows in itertools.groupby(self.rows, lambda (fname, row): fname):
+          path = os.path.join(self.logdir, fname)
+          if fname not in sizes:
+              sizes[fname] = os.path.getsize(path) if os.path.exists(path) else 0
+          data = io.BytesIO()
+          csv.writer(data).writerows(row for fname, row in rows)
+          records.append((fname, sizes[fname], data.getvalue()))
+          sizes[fname] += len(data.getvalue())
+      if records:
+          self.journal.write(records)
+          self.journaled = len(self.rows)
+          
+  def _close_fd(self):
+      if self.fd:
+          try:
+              if self.journal:
+                  self.fd.flush()
+                  os.fsync(self.fd.fileno())
+              self.fd.close()
+          except (IOError, OSError) as e:
+              logging.error("closing log file failed: " + str(e))
+      self.fd = None
+      self.fname = None
+      
+  def close(self):
+      '''
+      Flushes the buffered rows and closes the log file
+      '''
+      self.flush()
+      self._close_fd()
+
+
+class AdaptiveSchedule(object):
+  '''
+  Decides how long Logger sleeps between polls, so that it wakes up less 
+  often when little can change: every fast_period seconds for fast_window 
+  seconds after the foreground window changed (the user is likely switching
+  windows), every quiet_period seconds once there has been no input for
+  quiet_after seconds (windows rarely change without input), every 
+  idle_period seconds while the user is idle, and every period seconds 
+  otherwise.
+  '''
+  def __init__(self, period=1.0, fast_period=0.5, fast_window=3.0, 
+               quiet_period=2.0, quiet_after=30.0, idle_period=10.0):
+      self.period = period
+      self.fast_period = fast_period
+      self.fast_window = fast_window
+      self.quiet_period = quiet_period
+      self.quiet_after = quiet_after
+      self.idle_period = idle_period
+      
+  def next(self, idle_ms, idle_threshold_ms, since_change):
+      '''
+      Returns the number of seconds to sleep, given the time since the last 
+      input event (idle_ms), Logger's idle threshold and the number of 
+      seconds since the foreground window last changed
+      '''
+      if idle_ms > idle_threshold_ms:
+          return self.idle_period
+      if since_change < self.fast_window:
+          return self.fast_period
+      if idle_ms > self.quiet_after * 1000:
+          return self.quiet_period
+      return self.period
+
+
 class Logger(threading.Thread):
     '''
-    Logs information about the active window.
+    Logs information about the active window, as reported by sampler (by 
+    default a Win32Sampler), polling at the rate schedule (by default an
+    AdaptiveSchedule) calls for. wakeups counts the polls made. If db is 
+    given, the rows logged are also added to the ActivityDB at that path.
+    
+    The time each poll takes is recorded in stats: the sampler calls 
+    ("idle_ms", "foreground"), writing ("write"), the whole poll ("poll") 
+    and how much later than scheduled it woke up ("overrun"). If stats_file
+    is given the stats are saved to it every stats_interval seconds. If 
+    profile is given, the loop runs under cProfile and the profile is dumped
+    to that file along with the stats.
+    
+    on_rotate is called with the name of the new log file when logging 
+    moves on to the next day's (see LogWriter). If title_rules (a 
+    TitleRules) is given, window titles are logged canonicalized, so a 
+    title that only ticks doesn't start a new row. Rows are written through 
+    a Journal ("journal.dat" in logdir) unless journal is False.
     '''
-    def __init__(self, logdir, *args, **kwargs):
+    def __init__(self, logdir, sampler=None, schedule=None, db=None, 
+                 stats_file=None, stats_interval=60, profile=None, on_rotate=None,
+                 title_rules=None, journal=True, *args, **kwargs):
         self.windows = []
         self._run = True
+        self._wake = threading.Event()
+        self.wakeups = 0
+        self.stats = Stats("logger")
+        self.stats_file = stats_file
+        self.stats_interval = stats_interval
+        self.profile = profile
+        self.title_rules = title_rules
         self.logdir = logdir
+        self.sampler = sampler or Win32Sampler()
+        self.schedule = schedule or AdaptiveSchedule()
+        journal = os.path.join(logdir, Journal.FILENAME) if journal else None
+        if db:
+            self.writer = ActivityDBWriter(logdir, db, clock=self.sampler.time, 
+                on_rotate=on_rotate, journal=journal)
+        else:
+            self.writer = LogWriter(logdir, clock=self.sampler.time, 
+                on_rotate=on_rotate, journal=journal)
         threading.Thread.__init__(self, *args, **kwargs)
       
     def stop(self):
         '''
-        Sets a flag that causes the thread loop to exit
+        Sets a flag that causes the thread loop to exit, then waits for it to 
+        do so; once this returns every logged row is on disk
         '''
         self._run = False
+        self._wake.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
       
     def run(self):
         '''
@@ -81,28 +750,31 @@ class Logger(threading.Thread):
         last_title = ""
         last_exe_name = ""
         last_day = None
+        last_change = 0
         idle_start = 0
-        while(self._run):
+        stats = self.stats
+        profiler = None
+        if self.profile:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        last_save = time.time()
+        wake_at = None # when the current poll was due (wall clock)
+        while(self._run and not self.sampler.done()):
+            self.wakeups += 1
+            poll_start = time.time()
+            if wake_at is not None:
+                stats.add("overrun", max(0, poll_start - wake_at))
+            if self.stats_file and poll_start - last_save >= self.stats_interval:
+                self.save_stats(profiler)
+                last_save = poll_start
             try:
                 # Log idle time info
                 #
                 # Detail: Check idle time; if it has exceeded 3 minutes, log 
                 # elasped idle time when window activity resumes
                 
-                # Get idle time
-                # see: http://msdn.microsoft.com/en-us/library/ms646302%28VS.85%29.aspx
-                # GetTickCount() returns the tick count for the current time 
-                #   (ms since system boot)
-                # GetLastInputInfo(..) returns the tick count for the last 
-                #   input event, with some caveats
-                # idle_ms = GetTickCount() - GetLastInputInfo(..)
-                info = LastInputInfo()
-                info.cbSize = pointer_size() * 2
-                if(windll.user32.GetLastInputInfo(byref(info)) != 0):
-                    idle_ms = windll.kernel32.GetTickCount() - info.dwTime
-                else:
-                    idle_ms = 0
-                    logging.warning("GetLastInputInfo failed")
+                with stats.timed("idle_ms"):
+                    idle_ms = self.sampler.idle_ms()
                   
                 # If no activity for more than than 3 min, log an idle time 
                 # event.
@@ -111,58 +783,161 @@ class Logger(threading.Thread):
                 # idle_start; If idle_start is set and less than 3 mins have 
                 # passed since last input event (i.e. window activity has 
                 # resumed), log an idle time event and clear idle_start.
+                #
+                # Both times are worked out from idle_ms, so they don't 
+                # depend on how often we poll.
                 threshold = 1000 * 60 * 3 # min
+                now = self.sampler.time()
+                resumed = None
                 if idle_ms > threshold and not idle_start:
-                    idle_start = time.time()  
+                    idle_start = now - (idle_ms - threshold) / 1000.0
                 elif idle_ms < threshold and idle_start:
-                  try:
-                      fname = datetime.datetime.now().strftime("%Y-%m-%d windows.csv")
-                      with open(os.path.join(self.logdir, fname), "ab") as csvfile:
-                          csv.writer(csvfile).writerow(["idle_time", idle_start, time.time()])
-                      idle_start = 0
-                  except IOError as e:
-                      logging.error("idle time logging failed: " + str(e))
+                  resumed = now - idle_ms / 1000.0
+                  self.writer.writerow(["idle_time", idle_start, resumed])
+                  idle_start = 0
                       
                 # Log foreground window info
                 #
                 # Detail: Get the foreground window info; if has changed, log 
                 # it
                 
-                # Get foreground window information
-                wh = windll.user32.GetForegroundWindow()
-                textlen = windll.user32.GetWindowTextLengthA(wh) + 1
-                window_title = " " * textlen
-                windll.user32.GetWindowTextA(wh, window_title, textlen)
-                pid = ctypes.c_int()
-                if not windll.user32.GetWindowThreadProcessId(wh, ctypes.byref(pid)):
-                    warnings.warn("GetWindowThreadId failed (NULL tid)")
+                with stats.timed("foreground"):
+                    window = self.sampler.foreground()
+                if window is None:
+                    # e.g. the desktop is locked; try again in a bit
+                    stats.count("no_foreground")
+                    wake_at = None
+                    self.sampler.sleep(self.schedule.period, self._wake)
                     continue
-                ph = windll.kernel32.OpenProcess(0x410, False, pid) 
-                in_len = 128
-                out_len = 129
-                while out_len > in_len:
-                    exe_name = " "*in_len
-                    out_len = windll.psapi.GetProcessImageFileNameA(ph, exe_name, in_len)
-                    in_len += out_len
-                exe_name = os.path.basename(exe_name[:out_len])
+                exe_name, window_title = window
+                if self.title_rules:
+                    window_title = self.title_rules.canonical(window_title)
                   
                 # If foreground info has changed, log it
+                #
+                # Detail: We poll slowly while idle, so a window that came
+                # up as the user got back started when the idle time ended
+                write_start = time.time()
                 if (exe_name, window_title) != (last_exe_name, last_title):
-                  start_time = time.time()
+                  start_time = resumed or now
+                  last_change = now
                   last_exe_name = exe_name
                   last_title = window_title
-                  try:
-                      fname = datetime.datetime.now().strftime("%Y-%m-%d windows.csv")
-                      with open(os.path.join(self.logdir, fname), "ab") as csvfile:
-                          csv.writer(csvfile).writerow(["window_info", exe_name, window_title, start_time])
-                  except IOError as e:
-                      logging.error("window info logging failed: " + str(e))
+                  self.writer.writerow(["window_info", exe_name, window_title, start_time])
+                  stats.count("windows")
                   
-                time.sleep(1) 
+                self.writer.tick()
+                stats.add("write", time.time() - write_start)
+                
+                period = self.schedule.next(idle_ms, threshold, now - last_change)
+                poll_end = time.time()
+                stats.add("poll", poll_end - poll_start)
+                wake_at = poll_end + period
+                self.sampler.sleep(period, self._wake)
             except Exception as e:
                 logging.exception("exception in run loop:" + str(e))
                 logging.error("failure, run exiting")
+        self.writer.close()
+        self.save_stats(profiler)
+        if profiler:
+            profiler.disable()
         logging.debug("stopping")
+        
+    def save_stats(self, profiler=None):
+        '''
+        Saves the stats to stats_file (if there is one) and dumps profiler's 
+        profile, if any, to the profile file
+        '''
+        stats = self.stats
+        stats.counters["wakeups"] = self.wakeups
+        calls = getattr(self.sampler, "calls", None)
+        if calls:
+            stats.counters["sampler_calls"] = dict(calls)
+        if self.stats_file:
+            stats.save(self.stats_file)
+        if profiler:
+            profiler.dump_stats(self.profile) # this disables it
+            profiler.enable()
+
+
+def js_escape(s):
+    '''
+    Escapes s for use in a double quoted Javascript string literal
+    '''
+    return s.replace("\\", "\\\\").replace("\"", "\\\"") # escape \'s to appease JS rules, TODO: are there more to add?
+
+
+def js_literal(obj):
+    '''
+    Returns obj (nested dicts/lists of strings and numbers) as a Javascript 
+    literal. Unlike json.dumps, strings are written byte for byte (escaped 
+    with js_escape), just like the strings in alldata.js.
+    '''
+    if isinstance(obj, dict):
+        return "{%s}" % ", ".join("\"%s\": %s" % (js_escape(str(k)), js_literal(v)) 
+            for k, v in sorted(obj.items()))
+    if isinstance(obj, (list, tuple)):
+        return "[%s]" % ", ".join(js_literal(v) for v in obj)
+    if isinstance(obj, basestring):
+        return "\"%s\"" % js_escape(obj)
+    return repr(obj)
+
+
+def latin1(obj):
+    '''
+    Converts the unicode strings in obj (as returned by json.load) back to 
+    byte strings. Log data is stored in whatever code page the window titles 
+    came in, so it is round tripped through JSON as latin-1, which maps every
+    byte to a character and back.
+    '''
+    if isinstance(obj, dict):
+        return dict((latin1(k), latin1(v)) for k, v in obj.iteritems())
+    if isinstance(obj, list):
+        return [latin1(v) for v in obj]
+    if isinstance(obj, unicode):
+        return obj.encode("latin-1")
+    return obj
+
+
+class StringTable(object):
+  '''
+  Dictionary encoder for the strings that repeat throughout the log data (exe 
+  names and window titles). Each distinct string is stored, and escaped for 
+  Javascript, only once; intervals refer to it by its integer code, so memory
+  use grows with the number of distinct strings rather than with rows.
+  '''
+  def __init__(self, strings=()):
+      self.codes = {}
+      self.strings = []
+      self._escaped = []
+      for s in strings:
+          self.code(s)
+      
+  def __len__(self):
+      return len(self.strings)
+      
+  def __getitem__(self, code):
+      return self.strings[code]
+      
+  def code(self, s):
+      '''
+      Returns the code for s, adding s to the table if it is new
+      '''
+      code = self.codes.get(s)
+      if code is None:
+          code = self.codes[s] = len(self.strings)
+          self.strings.append(s)
+          self._escaped.append(None)
+      return code
+      
+  def escaped(self, code):
+      '''
+      Returns the string for code, escaped with js_escape
+      '''
+      s = self._escaped[code]
+      if s is None:
+          s = self._escaped[code] = js_escape(self.strings[code])
+      return s
 
 
 class JsArrayFile(object):
@@ -170,29 +945,37 @@ class JsArrayFile(object):
   Represents a Javascript array file that gets written to disk.
   Used by Analyzer; part of a hack to give javascript in chart.html access to
   the log data on disk. There is probably a better way to do this : )
+  
+  Items are dictionary encoded: exe names and window titles are codes into 
+  the exe_names and window_titles StringTables.
   '''
-  def __init__(self, filename):
+  def __init__(self, filename, exe_names, window_titles, start=0):
       '''
-      Opens a file descriptor and writes a Javascript Array declaration.
+      Opens a file descriptor and writes a Javascript Array declaration. If 
+      start is given, the file is assumed to already hold that many elements
+      and new elements are appended after them.
       '''
-      self.out_fd = file(filename, "wt")
-      self.out_fd.write("var watchme_data = new Array(); \n") # beginning of array def'n
-      self.i = 0
+      if start:
+          self.out_fd = file(filename, "at")
+      else:
+          self.out_fd = file(filename, "wt")
+          self.out_fd.write("var watchme_data = new Array(); \n") # beginning of array def'n
+      self.exe_names = exe_names
+      self.window_titles = window_titles
+      self.i = start
       
   def append(self, item):
       '''
       Writes item to self.out_fd as a Javascript Array element
       '''
       if not getattr(self, "out_fd", None):
-          raise RuntimeException("out_fd not available, was finish() called already?")
-      try:
-          item = [i.replace("\\", "\\\\").replace("\"", "\\\"") for i in item] # escape \'s to appease JS rules, TODO: are there more to add?
-      except Exception as e:
-          logger.error("error processing item=%s: %s" % (str(item), str(e)))
+          raise RuntimeError("out_fd not available, was finish() called already?")
           
-      # [exe_name, window_title, start_time, end_time, date]
-      self.out_fd.write("watchme_data[%d] = {\n\tid: %d,\n\texe_name: \"%s\",\n\twindow_title: \"%s\",\n\tstart_time: %s,\n\tend_time:%s, \n\tdate:\"%s\"};\n" %\
-          ((self.i, self.i, ) + tuple(item)))
+      # [exe_code, window_title_code, start_time, end_time, date]
+      exe_code, title_code, start_time, end_time, date = item
+      self.out_fd.write("watchme_data[%d] = {\n\tid: %d,\n\texe_name: \"%s\",\n\twindow_title: \"%s\",\n\tstart_time: %r,\n\tend_time:%r, \n\tdate:\"%s\"};\n" %\
+          (self.i, self.i, self.exe_names.escaped(exe_code), 
+           self.window_titles.escaped(title_code), start_time, end_time, date))
       self.i += 1
       
   def finish(self):
@@ -204,125 +987,2714 @@ class JsArrayFile(object):
       self.i = 0
 
 
-# >python -i -c "from watchme import Analyzer; import os; a = Analyzer(os.getcwd() + \"\\data\"); a.analyze()"
-class Analyzer(object):
+class ColumnarJsFile(object):
   '''
-  Used to Analyze log data. Aggregates log data from CSV files on disk, writes 
-  them to a javascript file, then launches an HTML file with the default 
-  browser that reads the javascript file and supplies a GUI for the user to 
-  analyze the data.
+  Columnar alternative to JsArrayFile: same append()/finish() interface, but
+  instead of one Javascript object per interval it writes the intervals as a
+  binary blob of typed arrays (base64 encoded, so chart.html can still load it 
+  with a script tag) plus the exe_names and window_titles StringTables as 
+  dictionaries.
+  
+  Blob layout (little endian):
+    "WMC1", uint32 count,
+    float64 start_time[count], float64 end_time[count],
+    uint32 exe_code[count], uint32 title_code[count]
+  where the codes index into the exe_names/window_titles dictionaries.
   '''
-  def __init__(self, directory):
-    self.directory = directory
-    
-  def analyze(self):
-    '''
-    Parses CSV files created by logger and writes result to an HTML file as 
-    a javascript array (as a workaround to same-origin-policy security). 
-    There might be a better way...
-    '''
-    logging.info("Analyzer.analyze called, self.directory=%s" % self.directory)
-    data = []
-    
-    # Create a Javascript file for aggregated log data
-    try:
-        js_array = JsArrayFile(os.path.join(self.directory, "alldata.js"))
-    except Exception as e:
-        logging.error("error while creating JsArrayFile: %s" % str(e))
-        raise e
-        
-    # Loop over log files and store data to Javascript array files
-    try:
-        for fname in os.listdir(self.directory):
-            try:
-                if re.match(".*windows.csv$", fname):
-                    start_time = None
-                    
-                    # Process a log file
-                    with open(os.path.join(self.directory, fname), "rt") as csvfile:
-                      
-                        for row in csv.reader(csvfile):
-                            # If this is a window_info row: if we've already 
-                            # seen a window_info row, calculate inter-window 
-                            # time and log it. Otherwise we don't know when 
-                            # this window started, so store this window info
-                            # to memory and log it later.
-                            if row[0] == "window_info": 
-                                # Row format: row_type,proc_name,window_title,start_time
-                                if start_time != None: 
-                                    # Get end_time for previous row and dump to file
-                                    end_time = row[3] 
-                                    date = datetime.datetime.fromtimestamp(float(start_time)).strftime("%Y/%m/%d")
-                                    js_array.append([exe_name, window_title, start_time, end_time, date])
-                                    
-                                # Get data for current row
-                                exe_name, window_title, start_time = row[1:]
-                                
-                            else: # this is a idle_time row
-                                # Since this is an idle_time row, we just have 
-                                # to log the info for the preceding window_info
-                                # (since we know know the end_time) and move on.
-                                
-                                if not start_time: 
-                                    # If we haven't seen a start time, this 
-                                    # log file started with an idle_time row: 
-                                    # no window activity to log; move on. 
-                                    continue
-                                    
-                                # Get end_time for previous row and dump to DB
-                                end_time = row[1] # row[1] = start of idle time
-                                if end_time < start_time:
-                                    # This is a workaround for a bug in 
-                                    # previous versions of this script that
-                                    # has corrupted some data: 
-                                    # Due to the bug, now idle_time rows are 
-                                    # not in chronological order in some of my 
-                                    # old log files. 
-                                    # So for now, we skip these rows.
-                                    # TODO: correct the old log files and delete
-                                    # this workaround. Also, add versioning to 
-                                    # this script and log files : )
-                                    continue
-                                date = datetime.datetime.fromtimestamp(float(start_time)).strftime("%Y/%m/%d")
-                                js_array.append([exe_name, window_title, start_time, end_time, date])
-            except Exception as e:
-                logging.error("error while processing file: %s" % csvfile.name)
-                raise e
+  MAGIC = "WMC1"
+  
+  def __init__(self, filename, exe_names, window_titles):
+      '''
+      Opens a file descriptor; the data itself is written by finish().
+      '''
+      self.out_fd = file(filename, "wt")
+      self.start_times = array.array("d")
+      self.end_times = array.array("d")
+      self.exe_codes = array.array("I")
+      self.title_codes = array.array("I")
+      self.exe_names = exe_names
+      self.window_titles = window_titles
+      self.i = 0
+      
+  def append(self, item):
+      '''
+      Adds item ([exe_code, window_title_code, start_time, end_time, date]) to
+      the columns. The date is not stored; it is derived from start_time.
+      '''
+      if not getattr(self, "out_fd", None):
+          raise RuntimeError("out_fd not available, was finish() called already?")
+      exe_code, title_code, start_time, end_time = item[:4]
+      self.start_times.append(float(start_time))
+      self.end_times.append(float(end_time))
+      self.exe_codes.append(exe_code)
+      self.title_codes.append(title_code)
+      self.i += 1
+      
+  def _write_dictionary(self, name, table):
+      '''
+      Writes table as a Javascript array of strings ordered by code
+      '''
+      self.out_fd.write("\t%s: [\n" % name)
+      for code in xrange(len(table)):
+          self.out_fd.write("\t\t\"%s\",\n" % table.escaped(code))
+      self.out_fd.write("\t],\n")
+      
+  def finish(self):
+      '''
+      Writes the dictionaries and the base64 encoded columns, then closes the 
+      file descriptor
+      '''
+      self.out_fd.write("var watchme_columns = {\n")
+      self._write_dictionary("exe_names", self.exe_names)
+      self._write_dictionary("window_titles", self.window_titles)
+      self.out_fd.write("\tdata: \"")
+      self.out_fd.write(self._blob())
+      self.out_fd.write("\"\n};\n")
+      
+      self.out_fd.close()
+      self.out_fd = None
+      self.i = 0
+      
+  def _blob(self):
+      '''
+      Returns the columns as a base64 encoded blob
+      '''
+      # Columns are written in native byte order by array, so swap them on 
+      # big endian machines
+      blob = [self.MAGIC, struct.pack("<I", len(self.start_times))]
+      for column in (self.start_times, self.end_times, self.exe_codes, self.title_codes):
+          if sys.byteorder == "big":
+              column.byteswap()
+          blob.append(column.tostring())
+      return base64.b64encode("".join(blob))
+
+
+class ChunkedJsFile(ColumnarJsFile):
+  '''
+  ColumnarJsFile split into time ordered chunks, one per month, so that 
+  chart.html can show the latest data without loading all of it first. 
+  Each chunk is written to its own script in the "chunks" directory next to 
+  filename, "YYYY-MM.js", which calls watchme_chunk(month, data) with the 
+  chunk's columns as a ColumnarJsFile blob. filename gets the dictionaries,
+  which the codes of every chunk index into, and the list of chunks:
+  
+    var watchme_chunks = {exe_names: [...], window_titles: [...], 
+      chunks: [{month: "YYYY-MM", file: "chunks/YYYY-MM.js", count: n, 
+                start_time: t, end_time: t}, ...]};
                 
-    except Exception as e:
-        logging.error("error while gathering data: %s" % str(e))
-        raise e
+  Items should be appended in chronological order; only the current chunk 
+  is held in memory. The odd item that goes back to an earlier month (such
+  as a window left open across the end of the month) stays in the current
+  chunk; start_time and end_time are the bounds of a chunk's items.
+  
+  If chunks (the list of chunks of an earlier export to filename) is given,
+  the items are appended to them: the last chunk is read back and written
+  again if any new items go into it, and the chunks before it are left as 
+  they are. The codes of the items must then be those of the earlier export.
+  '''
+  def __init__(self, filename, exe_names, window_titles, chunks=None):
+      self.chunkdir = os.path.join(os.path.dirname(filename), "chunks")
+      if not os.path.exists(self.chunkdir):
+          os.makedirs(self.chunkdir)
+      columns = self._read_chunk(chunks[-1]) if chunks else None
+      ColumnarJsFile.__init__(self, filename, exe_names, window_titles)
+      self.chunks = []
+      self.month = None # of the current chunk
+      self.unchanged = None # the current chunk, while it is as it was read
+      if chunks:
+          self.chunks = chunks[:-1]
+          self.month = chunks[-1]["month"]
+          self.unchanged = chunks[-1]
+          self.start_times, self.end_times, self.exe_codes, self.title_codes = columns
+          
+  def _read_chunk(self, chunk):
+      '''
+      Returns the start_time, end_time, exe_code and title_code columns of 
+      chunk, read back from its file
+      '''
+      with open(os.path.join(self.chunkdir, os.path.basename(chunk["file"])), "rb") as fd:
+          try:
+              blob = base64.b64decode(fd.read().split("\"")[3])
+              count = struct.unpack("<I", blob[4:8])[0]
+          except (IndexError, TypeError, struct.error):
+              count = None
+      if count is None or blob[:4] != self.MAGIC or count != chunk["count"] or \
+              len(blob) != 8 + 24 * count:
+          raise ValueError("chunk %s doesn't match alldata.js" % chunk["file"])
+      columns = [array.array("d"), array.array("d"), array.array("I"), array.array("I")]
+      offset = 8
+      for column in columns:
+          column.fromstring(blob[offset:offset + column.itemsize * count])
+          if sys.byteorder == "big":
+              column.byteswap()
+          offset += column.itemsize * count
+      return columns
       
-    # Close the Javascript Array file, which now contains all activity data.
-    try:  
-        js_array.finish()
-    except Exception as e:
-        logging.error("error while writing chart postlude: %s" % str(e))
-        raise e
+  def append(self, item):
+      month = item[4][:7].replace("/", "-")
+      if self.month is None or month > self.month:
+          self._write_chunk()
+          self.month = month
+      self.unchanged = None
+      ColumnarJsFile.append(self, item)
       
-    # Launch the analyzer page (which reads the Javascript array file) with the
-    # default browser.
-    try:
-        subprocess.Popen("chart.html", shell=True)
-    except Exception as e:
-        logging.error("error while launching chart viewer: %s" % str(e))
-        raise e
- 
+  def _write_chunk(self):
+      '''
+      Writes out the current chunk, if it has any items, and starts a new one
+      '''
+      if not self.start_times:
+          return
+      if self.unchanged is not None:
+          self.chunks.append(self.unchanged)
+          self.unchanged = None
+      else:
+          fname = "%s.js" % self.month
+          with open(os.path.join(self.chunkdir, fname), "wt") as fd:
+              fd.write("watchme_chunk(\"%s\", \"%s\");\n" % (self.month, self._blob()))
+          self.chunks.append({"month": self.month, "file": "chunks/" + fname, 
+              "count": len(self.start_times), "start_time": min(self.start_times),
+              "end_time": max(self.end_times)})
+      self.start_times = array.array("d")
+      self.end_times = array.array("d")
+      self.exe_codes = array.array("I")
+      self.title_codes = array.array("I")
+      
+  def finish(self):
+      '''
+      Writes out the last chunk, then the dictionaries and the list of 
+      chunks, and closes the file descriptor. Chunks left over from earlier
+      exports are removed.
+      '''
+      self._write_chunk()
+      written = set(chunk["file"][len("chunks/"):] for chunk in self.chunks)
+      for fname in os.listdir(self.chunkdir):
+          if fname.endswith(".js") and fname not in written:
+              os.remove(os.path.join(self.chunkdir, fname))
+              
+      self.out_fd.write("var watchme_chunks = {\n")
+      self._write_dictionary("exe_names", self.exe_names)
+      self._write_dictionary("window_titles", self.window_titles)
+      self.out_fd.write("\tchunks: %s\n};\n" % js_literal(self.chunks))
+      
+      self.out_fd.close()
+      self.out_fd = None
+      self.i = 0
 
-class Watcher(SysTrayIcon):
+
+TOKEN_RE = re.compile("[^\x00-\x2f\x3a-\x40\x5b-\x60\x7b-\x7f]+") # runs of letters, digits and non-ASCII bytes
+
+
+def tokenize(s):
     '''
-    Watches window activity and supplies a UI to the user via a system tray
-    widget.
+    Splits s into lower case search tokens
     '''
-    def __init__(self, path):
-        '''
-        Starts the logger and sets up the system tray widget.
-        '''
-        if not os.path.exists(path):
-          os.makedirs(path)
-          
-        self.analyzer = Analyzer(path)
-        self.logger = Logger(path)
+    return TOKEN_RE.findall(s.lower())
+
+
+class TokenIndex(object):
+  '''
+  Inverted index from the tokens in window titles to the codes of the titles 
+  that contain them, written to index.js for the search in chart.html. 
+  Posting lists refer to titles rather than intervals since titles repeat 
+  so much; the page maps title codes to intervals with one pass over the 
+  title_code column.
+  
+  Blob layout (little endian):
+    "WMI1", uint32 token_count, uint32 title_count,
+    uint32 offsets[token_count + 1], uint32 postings[offsets[token_count]]
+  where the (ascending) title codes containing tokens[i] are 
+  postings[offsets[i]:offsets[i + 1]].
+  '''
+  MAGIC = "WMI1"
+  
+  def __init__(self, window_titles):
+      '''
+      Indexes the titles in the window_titles StringTable
+      '''
+      self.title_count = len(window_titles)
+      self.postings = {}
+      for code in xrange(self.title_count):
+          for token in set(tokenize(window_titles[code])):
+              self.postings.setdefault(token, []).append(code)
+              
+  def write(self, filename):
+      '''
+      Writes the index to filename as the Javascript variable watchme_index
+      '''
+      tokens = sorted(self.postings)
+      offsets = array.array("I", [0])
+      postings = array.array("I")
+      for token in tokens:
+          postings.extend(self.postings[token])
+          offsets.append(len(postings))
+          
+      blob = [self.MAGIC, struct.pack("<II", len(tokens), self.title_count)]
+      for column in (offsets, postings):
+          if sys.byteorder == "big":
+              column.byteswap()
+          blob.append(column.tostring())
+      with open(filename, "wt") as fd:
+          fd.write("var watchme_index = {\n\ttokens: %s,\n\tdata: \"%s\"\n};\n" % 
+              (js_literal(tokens), base64.b64encode("".join(blob))))
+
+
+class Rollups(object):
+  '''
+  Pre-aggregated totals over the intervals in alldata.js, written to 
+  rollups.js so that chart.html can draw charts and list exe names without
+  scanning every interval:
+    days: seconds per exe name per day ("YYYY/MM/DD", the interval's date)
+    hours: seconds per exe name per hour of the day (0-23, local time); 
+      intervals are split at hour boundaries
+    idle: idle seconds per day
+    hosts: if the logs of more than one host were analyzed, the totals of 
+      each host (days, hours and idle, as above) by host name
+  '''
+  def __init__(self, data=None):
+      data = data or {}
+      self.days = data.get("days", {})
+      self.hours = data.get("hours", {})
+      self.idle = data.get("idle", {})
+      self.hosts = data.get("hosts", {})
+      
+  def add(self, exe_name, start_time, end_time, date):
+      '''
+      Adds an interval to the totals
+      '''
+      day = self.days.setdefault(date, {})
+      day[exe_name] = day.get(exe_name, 0) + end_time - start_time
+      
+      t = start_time
+      while t < end_time:
+          lt = time.localtime(t)
+          next_hour = min(end_time, t - (lt.tm_min * 60 + lt.tm_sec + t % 1) + 3600)
+          hour = self.hours.setdefault(str(lt.tm_hour), {})
+          hour[exe_name] = hour.get(exe_name, 0) + next_hour - t
+          t = next_hour
+          
+  def merge(self, other):
+      '''
+      Adds the totals of Rollups other to these
+      '''
+      for mine, theirs in ((self.days, other.days), (self.hours, other.hours)):
+          for key, totals in theirs.iteritems():
+              table = mine.setdefault(key, {})
+              for exe_name, seconds in totals.iteritems():
+                  table[exe_name] = table.get(exe_name, 0) + seconds
+      for date, seconds in other.idle.iteritems():
+          self.idle[date] = self.idle.get(date, 0) + seconds
+          
+  def to_dict(self):
+      '''
+      Returns the totals as a dict, which Rollups(data) accepts
+      '''
+      data = {"days": self.days, "hours": self.hours, "idle": self.idle}
+      if self.hosts:
+          data["hosts"] = self.hosts
+      return data
+      
+  def write(self, filename):
+      '''
+      Writes the totals to filename as the Javascript variable watchme_rollups
+      '''
+      with open(filename, "wt") as fd:
+          fd.write("var watchme_rollups = %s;\n" % js_literal(self.to_dict()))
+
+
+class IntervalArrays(object):
+  '''
+  Vectorized statistics over encoded intervals (see Analyzer.encode), using
+  NumPy: items are appended like to a JsArrayFile and, after finish(), are 
+  held as start_time, end_time, exe_code, title_code and date_code arrays 
+  (dates are coded in the dates StringTable), so that totals can be worked 
+  out as group-bys (numpy.bincount) instead of a Python loop per interval.
+  Items should be appended in chronological order. host_code holds the 
+  index of the host each item came from (see Analyzer.hosts).
+  '''
+  def __init__(self, exe_names, window_titles):
+      if numpy is None:
+          raise RuntimeError("IntervalArrays requires NumPy")
+      self.exe_names = exe_names
+      self.window_titles = window_titles
+      self.dates = StringTable()
+      self.columns = [array.array("d"), array.array("d"), 
+          array.array("I"), array.array("I"), array.array("I"), array.array("I")]
+      
+  def append(self, item, host=0):
+      '''
+      Adds an [exe_code, title_code, start_time, end_time, date] item of 
+      host (an index)
+      '''
+      start_time, end_time, exe_code, title_code, date_code, host_code = self.columns
+      exe_code.append(item[0])
+      title_code.append(item[1])
+      start_time.append(item[2])
+      end_time.append(item[3])
+      date_code.append(self.dates.code(item[4]))
+      host_code.append(host)
+      
+  def finish(self):
+      '''
+      Turns the appended items into NumPy arrays
+      '''
+      self.start_time, self.end_time, self.exe_code, self.title_code, \
+          self.date_code, self.host_code = \
+          [numpy.frombuffer(column, dtype=column.typecode) if column else 
+              numpy.zeros(0, dtype=column.typecode) for column in self.columns]
+      self.columns = None # the arrays share their memory: no more appending
+      
+  def spliced(self, rows, items):
+      '''
+      Returns a finished IntervalArrays of the first rows items of this one
+      followed by items, (host, item) pairs, sharing this one's StringTables.
+      The arrays are copied, which is still much cheaper than appending 
+      everything again.
+      '''
+      more = IntervalArrays(self.exe_names, self.window_titles)
+      more.dates = self.dates
+      for host, item in items:
+          more.append(item, host)
+      more.finish()
+      for name in ("start_time", "end_time", "exe_code", "title_code", 
+                   "date_code", "host_code"):
+          setattr(more, name, numpy.concatenate((getattr(self, name)[:rows], getattr(more, name))))
+      return more
+      
+  def select(self, rows):
+      '''
+      Returns an IntervalArrays of the items at rows (an index or boolean 
+      array), e.g. select(arrays.host_code == 1) for the items of one host
+      '''
+      subset = IntervalArrays(self.exe_names, self.window_titles)
+      subset.dates = self.dates
+      subset.columns = None
+      for name in ("start_time", "end_time", "exe_code", "title_code", 
+                   "date_code", "host_code"):
+          setattr(subset, name, getattr(self, name)[rows])
+      return subset
+      
+  def __len__(self):
+      return len(self.start_time)
+      
+  def _totals(self, codes, size, weights):
+      '''
+      Returns (totals, present): the sum of weights and whether there were 
+      any, for each of size codes
+      '''
+      totals = numpy.bincount(codes, weights=weights, minlength=size)
+      present = numpy.bincount(codes, minlength=size) > 0
+      return totals, present
+      
+  def _table(self, labels, totals, present):
+      '''
+      Returns a {label: {exe_name: seconds}} dict from a rows by exe names 
+      array of totals, leaving out the cells nothing was added to
+      '''
+      exe_count = len(self.exe_names)
+      table = {}
+      for cell in numpy.flatnonzero(present):
+          row, exe = divmod(int(cell), exe_count)
+          table.setdefault(labels[row], {})[self.exe_names[exe]] = float(totals[cell])
+      return table
+      
+  def rollups(self, rollups=None):
+      '''
+      Adds the items to rollups (a new Rollups by default) and returns it. 
+      Gives the same totals as calling Rollups.add for every item, but 
+      computes them per day and exe name, and per hour of the day and exe 
+      name, in one pass each.
+      '''
+      rollups = rollups or Rollups()
+      exe_count = len(self.exe_names)
+      if not len(self):
+          return rollups
+          
+      # Per day: the whole interval counts towards the day it starts on
+      duration = self.end_time - self.start_time
+      totals, present = self._totals(self.date_code.astype(numpy.int64) * exe_count + self.exe_code, 
+          len(self.dates) * exe_count, duration)
+      days = self._table(self.dates.strings, totals, present)
+      
+      # Per hour of the day: split the intervals at (local) hour boundaries, 
+      # which are whole hours after the first one, t0. Most intervals don't 
+      # cross one, so only the rest are split up.
+      hours = {}
+      positive = numpy.flatnonzero(self.end_time > self.start_time)
+      if len(positive):
+          start_time, end_time = self.start_time[positive], self.end_time[positive]
+          exe_code = self.exe_code[positive]
+          lt = time.localtime(start_time.min())
+          t0 = start_time.min() - (lt.tm_min * 60 + lt.tm_sec + start_time.min() % 1)
+          first = numpy.floor((start_time - t0) / 3600).astype(numpy.int64)
+          last = numpy.ceil((end_time - t0) / 3600).astype(numpy.int64) - 1
+          split = numpy.flatnonzero(last > first)
+          pieces = last[split] - first[split] + 1
+          interval = numpy.repeat(split, pieces)
+          slot = first[interval] + numpy.arange(len(interval)) - \
+              numpy.repeat(numpy.cumsum(pieces) - pieces, pieces)
+          whole = numpy.flatnonzero(last == first)
+          slot = numpy.concatenate((first[whole], slot))
+          piece = numpy.concatenate((end_time[whole] - start_time[whole], 
+              numpy.minimum(end_time[interval], t0 + (slot[len(whole):] + 1) * 3600.0) - 
+              numpy.maximum(start_time[interval], t0 + slot[len(whole):] * 3600.0)))
+          exe_code = numpy.concatenate((exe_code[whole], exe_code[interval]))
+          
+          # Look up the hour of the day of each slot once
+          lo = slot.min()
+          if slot.max() - lo < len(slot):
+              slots, slot_index = numpy.arange(lo, slot.max() + 1), slot - lo
+          else:
+              slots, slot_index = numpy.unique(slot, return_inverse=True)
+          hour_of_slot = numpy.array([time.localtime(t0 + s * 3600.0).tm_hour for s in slots], 
+              dtype=numpy.int64)
+          codes = hour_of_slot[slot_index] * exe_count + exe_code
+          totals, present = self._totals(codes, 24 * exe_count, piece)
+          hours = self._table([str(h) for h in xrange(24)], totals, present)
+          
+      for table, new in ((rollups.days, days), (rollups.hours, hours)):
+          for key, exes in new.iteritems():
+              old = table.setdefault(key, {})
+              for exe_name, seconds in exes.iteritems():
+                  old[exe_name] = old.get(exe_name, 0) + seconds
+      return rollups
+      
+  def top_titles(self, n=10):
+      '''
+      Returns the [window_title, seconds] of the n window titles the most 
+      time was spent in, most first
+      '''
+      totals = numpy.bincount(self.title_code, weights=self.end_time - self.start_time,
+          minlength=len(self.window_titles))
+      used = numpy.flatnonzero(numpy.bincount(self.title_code, minlength=len(self.window_titles)))
+      top = used[numpy.argsort(-totals[used], kind="mergesort")[:n]]
+      return [[self.window_titles[int(code)], float(totals[code])] for code in top]
+      
+  def switch_rates(self):
+      '''
+      Returns the number of focus switches (intervals whose window differs 
+      from the one before) per hour spent in windows, for each day 
+      ("YYYY/MM/DD")
+      '''
+      switch = numpy.ones(len(self), dtype=bool)
+      switch[1:] = (self.exe_code[1:] != self.exe_code[:-1]) | \
+          (self.title_code[1:] != self.title_code[:-1])
+      switches = numpy.bincount(self.date_code[switch], minlength=len(self.dates))
+      seconds = numpy.bincount(self.date_code, weights=self.end_time - self.start_time,
+          minlength=len(self.dates))
+      return dict((self.dates[code], 3600.0 * switches[code] / seconds[code])
+          for code in numpy.flatnonzero(seconds > 0))
+          
+  def sessions(self, gap=300):
+      '''
+      Returns (starts, ends): arrays of the start and end times of the 
+      sessions of use, runs of intervals with no more than gap seconds 
+      between one and the next
+      '''
+      if not len(self):
+          return numpy.zeros(0), numpy.zeros(0)
+      ends = numpy.maximum.accumulate(self.end_time)
+      breaks = numpy.flatnonzero(self.start_time[1:] - ends[:-1] > gap)
+      starts = numpy.concatenate(([self.start_time[0]], self.start_time[breaks + 1]))
+      return starts, numpy.concatenate((ends[breaks], [ends[-1]]))
+
+
+class Manifest(object):
+  '''
+  Persistent record of how much of each log file Analyzer has already parsed.
+  For every log file it stores the file's size and mtime, the byte offset of 
+  the end of the last complete row and the window that was still open at that 
+  offset (start_time, exe_name, window_title), so that an unchanged file can
+  be skipped and a file that has grown can be parsed from where we left off.
+  The intervals parsed so far are kept in per-file CSV files next to the
+  manifest (the "cached intermediate"); idle seconds per day are kept in the
+  manifest itself, as are the Rollups, window titles, exe names and chunks 
+  (see ChunkedJsFile) matching alldata.js and the corrupt byte ranges of 
+  each log file that were skipped.
+  '''
+  VERSION = 6 # bump whenever the cached data changes meaning
+  
+  def __init__(self, directory):
+      self.directory = directory
+      self.filename = os.path.join(directory, "manifest.json")
+      self.files = {}
+      self.js_count = None # number of items in alldata.js, if it is current
+      self.rollups = None # Rollups.to_dict() matching alldata.js
+      self.titles = [] # window titles in alldata.js, in order of their codes
+      self.exes = [] # exe names in alldata.js, in order of their codes
+      self.chunks = None # the chunks listed in alldata.js, if it has any
+      restore_file(self.filename)
+      if os.path.exists(self.filename):
+          try:
+              with open(self.filename, "rb") as fd:
+                  data = latin1(json.load(fd))
+              if data.get("version") == self.VERSION:
+                  self.files = data["files"]
+                  self.js_count = data["js_count"]
+                  self.rollups = data["rollups"]
+                  self.titles = data["titles"]
+                  self.exes = data["exes"]
+                  self.chunks = data["chunks"]
+          except Exception as e:
+              # A corrupt manifest just costs us a full reparse
+              logging.warning("ignoring unreadable manifest %s: %s" % (self.filename, str(e)))
+              self.files = {}
+              self.js_count = None
+              self.rollups = None
+              self.titles = []
+              self.exes = []
+              self.chunks = None
+      
+  def idle(self):
+      '''
+      Returns the total idle seconds per day ("YYYY/MM/DD") over all log files
+      '''
+      idle = {}
+      for entry in self.files.itervalues():
+          for date, seconds in entry["idle"].iteritems():
+              idle[date] = idle.get(date, 0) + seconds
+      return idle
+      
+  def cache_path(self, fname):
+      '''
+      Returns the path of the cached intervals for log file fname
+      '''
+      return os.path.join(self.directory, fname.replace("windows.csv", "intervals.csv"))
+      
+  def save(self):
+      '''
+      Writes the manifest to disk. Writes to a temporary file first so that a 
+      crash mid-write doesn't leave a truncated manifest behind.
+      '''
+      tmp = self.filename + ".tmp"
+      with open(tmp, "wb") as fd:
+          json.dump({"version": self.VERSION, "files": self.files, 
+              "js_count": self.js_count, "rollups": self.rollups, 
+              "titles": self.titles, "exes": self.exes, "chunks": self.chunks}, fd, 
+              encoding="latin-1")
+      replace_file(tmp, self.filename)
+
+
+class _RowOffsets(object):
+  '''
+  Line iterator for csv.reader that only hands out complete (newline 
+  terminated) lines and remembers the byte offset just past the last line 
+  handed out. A row that the Logger is still in the middle of writing is 
+  left for the next run.
+  '''
+  def __init__(self, fd):
+      self.fd = fd
+      self.offset = fd.tell()
+      
+  def __iter__(self):
+      return self
+      
+  def next(self):
+      line = self.fd.readline()
+      if not line.endswith("\n"):
+          raise StopIteration
+      self.offset = self.fd.tell()
+      return line
+  __next__ = next
+
+
+def _valid_row(row):
+    '''
+    Returns whether row (a list of fields) is a window_info or idle_time row
+    as the Logger writes them
+    '''
+    try:
+        if row[0] == "window_info" and len(row) == 4:
+            float(row[3])
+        elif row[0] == "idle_time" and len(row) == 3:
+            float(row[1]), float(row[2])
+        else:
+            return False
+    except (IndexError, ValueError):
+        return False
+    return True
+    
+    
+def _add_error(errors, start, end):
+    '''
+    Records the corrupt byte range [start, end) in errors, merging it with 
+    the last range if they touch
+    '''
+    if errors and errors[-1][1] == start:
+        errors[-1][1] = end
+    else:
+        errors.append([start, end])
+        
+
+def read_rows(fd, errors=None):
+    '''
+    Yields (offset, row) for the complete rows of the log open in fd from its
+    current position on, where offset is the byte offset just past the row.
+    Rows that aren't well formed (garbage or NUL bytes left behind by a 
+    crash, say) are skipped. A bad row only takes its first line with it, 
+    so a stray quote can't swallow the rows after it; the [start, end) byte 
+    ranges skipped are added to errors, if given.
+    '''
+    while True:
+        lines = _RowOffsets(fd)
+        reader = csv.reader(lines)
+        while True:
+            start = lines.offset
+            try:
+                row = next(reader)
+            except StopIteration:
+                return
+            except csv.Error:
+                row = None
+            if row is None or not _valid_row(row):
+                break
+            yield lines.offset, row
+            
+        # Skip the first line of the bad row and start over after it
+        fd.seek(start)
+        line = fd.readline()
+        if not line:
+            return
+        if errors is not None:
+            _add_error(errors, start, start + len(line))
+
+
+# A log file that has been moved into a monthly archive by archive_logs
+ArchivedLog = namedtuple("ArchivedLog", ["archive", "member"])
+
+LogFile = namedtuple("LogFile", ["fname", "path", "size", "mtime"])
+
+
+def open_log(path):
+    '''
+    Opens a log file for reading; path is a file name or an ArchivedLog, 
+    which is decompressed into memory (a day's log is small)
+    '''
+    if isinstance(path, ArchivedLog):
+        archive = zipfile.ZipFile(path.archive)
+        try:
+            return io.BytesIO(archive.read(path.member))
+        finally:
+            archive.close()
+    return open(path, "rb")
+    
+    
+def log_files(directory):
+    '''
+    Returns LogFiles (fname, path, size, mtime) for the daily logs in 
+    directory, sorted by name: the "YYYY-MM-DD windows.csv" files and the 
+    logs in the "YYYY-MM windows.zip" archives written by archive_logs, 
+    whose path is an ArchivedLog (see open_log). Archived logs keep the 
+    size and mtime they had as files. If a day is in both places the file
+    is used.
+    '''
+    logs = {}
+    for fname in os.listdir(directory):
+        path = os.path.join(directory, fname)
+        if re.match(".*windows.csv$", fname):
+            st = os.stat(path)
+            logs[fname] = LogFile(fname, path, st.st_size, st.st_mtime)
+        elif re.match("^\d{4}-\d{2} windows.zip$", fname):
+            archive = zipfile.ZipFile(path)
+            try:
+                for info in archive.infolist():
+                    if info.filename not in logs:
+                        mtime = float(info.comment) if info.comment else \
+                            time.mktime(info.date_time + (0, 0, -1))
+                        logs[info.filename] = LogFile(info.filename, 
+                            ArchivedLog(path, info.filename), info.file_size, mtime)
+            finally:
+                archive.close()
+    return [logs[fname] for fname in sorted(logs)]
+    
+    
+def _complete_zip(path):
+    '''
+    Returns whether path is a zip file that was written to the end
+    '''
+    try:
+        archive = zipfile.ZipFile(path)
+        try:
+            return archive.testzip() is None
+        finally:
+            archive.close()
+    except (zipfile.BadZipfile, IOError):
+        return False
+        
+        
+def archive_logs(directory, today=None):
+    '''
+    Compacts the logs of the days before today (default: the local date) 
+    into one deflated zip archive per month ("YYYY-MM windows.zip", one 
+    member per day), which the Analyzer reads just like the CSV files, and
+    deletes the CSV files. Today's log, which the Logger is still writing, 
+    is left alone, as are logs that have a batch of rows waiting in the 
+    Logger's Journal (they are archived once it has been recovered). 
+    Returns the number of log files archived.
+    '''
+    today = (today or datetime.date.today()).strftime("%Y-%m-%d")
+    
+    # An archive written by a run that crashed before it could be moved into
+    # place is the only copy of the days archived before it
+    for fname in os.listdir(directory):
+        if re.match("^\d{4}-\d{2} windows.zip.tmp$", fname):
+            path = os.path.join(directory, fname[:-4])
+            if not restore_file(path, _complete_zip):
+                os.remove(os.path.join(directory, fname)) # half written
+                
+    journaled = set(fname for fname, size, data in 
+        Journal(os.path.join(directory, Journal.FILENAME)).records())
+    months = {}
+    for fname in sorted(os.listdir(directory)):
+        if re.match("^\d{4}-\d{2}-\d{2} windows.csv$", fname) and fname[:10] < today:
+            if fname in journaled:
+                logging.warning("not archiving %s: it has journaled rows" % fname)
+                continue
+            months.setdefault(fname[:7], []).append(fname)
+            
+    for month, fnames in sorted(months.iteritems()):
+        pending = list(fnames)
+        path = os.path.join(directory, "%s windows.zip" % month)
+        tmp = path + ".tmp"
+        # Write the month's archive afresh, with whatever it held already, 
+        # so that a crash never leaves a half written archive behind
+        new = zipfile.ZipFile(tmp, "w", zipfile.ZIP_DEFLATED)
+        try:
+            if os.path.exists(path):
+                old = zipfile.ZipFile(path)
+                try:
+                    for info in old.infolist():
+                        data = old.read(info)
+                        if info.filename in pending:
+                            # The day was logged to again after it was 
+                            # archived: keep both parts, in order. (Unless
+                            # the file is the one archived, left behind by
+                            # a crash before it could be deleted.)
+                            with open(os.path.join(directory, info.filename), "rb") as fd:
+                                more = fd.read()
+                            data = more if more.startswith(data) else data + more
+                            pending.remove(info.filename)
+                            info.comment = repr(os.stat(os.path.join(directory, info.filename)).st_mtime)
+                        new.writestr(info, data)
+                finally:
+                    old.close()
+            for fname in pending:
+                st = os.stat(os.path.join(directory, fname))
+                info = zipfile.ZipInfo(fname, time.localtime(st.st_mtime)[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                info.comment = repr(st.st_mtime) # for the Manifest
+                with open(os.path.join(directory, fname), "rb") as fd:
+                    new.writestr(info, fd.read())
+        finally:
+            new.close()
+        replace_file(tmp, path)
+        for fname in fnames:
+            os.remove(os.path.join(directory, fname))
+        logging.info("archived %d log files to %s" % (len(fnames), path))
+    return sum(len(fnames) for fnames in months.itervalues())
+    
+    
+Interval = namedtuple("Interval", ["exe_name", "window_title", "start_time", "end_time", "date"])
+
+
+def make_interval(exe_name, window_title, start_time, end_time):
+    '''
+    Returns an Interval, filling in its date ("YYYY/MM/DD", local time) from
+    start_time
+    '''
+    date = datetime.datetime.fromtimestamp(start_time).strftime("%Y/%m/%d")
+    return Interval(exe_name, window_title, start_time, end_time, date)
+    
+    
+BRIDGE_LIMIT = 4 * 3600 # seconds a window left open at midnight can count for
+
+
+def boundary_interval(state, first_time):
+    '''
+    Returns the Interval for the window that was still open (state) at the 
+    end of one log file, closed by the first row (first_time) of the next 
+    one, or None if there isn't one. The window is only carried over into 
+    the next day, and for at most BRIDGE_LIMIT seconds: if the next log is 
+    of a later day, or its first row comes much later, the machine was most
+    likely off in between (the Logger would have logged the user going 
+    idle otherwise), so there is no telling when the window was left.
+    '''
+    if not state or first_time is None:
+        return None
+    start_time, exe_name, window_title = state
+    if first_time < start_time:
+        return None
+    next_day = datetime.date.fromtimestamp(start_time) + datetime.timedelta(days=1)
+    if datetime.date.fromtimestamp(first_time) > next_day:
+        return None
+    return make_interval(exe_name, window_title, start_time, 
+        min(first_time, start_time + BRIDGE_LIMIT))
+
+
+class LogReader(object):
+  '''
+  Replays the rows of the log file at path (a file name or an ArchivedLog) 
+  as Intervals. Iterating over a LogReader 
+  yields the intervals lazily; as it goes, offset, state and first_time are 
+  updated to the byte offset just past the last complete row, the 
+  [start_time, exe_name, window_title] of the window still open there (or 
+  None) and the timestamp of the first row read (or None), so that a later
+  LogReader can carry on where this one stopped. idle maps days 
+  ("YYYY/MM/DD") to the idle seconds that started on them. Corrupt rows 
+  are skipped (see read_rows), and the [start, end) byte ranges they took
+  up are listed in errors.
+  '''
+  def __init__(self, path, offset=0, state=None):
+      self.path = path
+      self.offset = offset
+      self.state = state
+      self.first_time = None
+      self.idle = {}
+      self.errors = []
+      
+  def __iter__(self):
+      if self.state:
+          start_time, exe_name, window_title = self.state
+      else:
+          start_time = None
+          
+      with open_log(self.path) as csvfile:
+          csvfile.seek(self.offset)
+          for offset, row in read_rows(csvfile, self.errors):
+              self.offset = offset
+              if self.first_time is None:
+                  self.first_time = float(row[3] if row[0] == "window_info" else row[1])
+                  
+              # If this is a window_info row: if we've already 
+              # seen a window_info row, calculate inter-window 
+              # time and log it. Otherwise we don't know when 
+              # this window started, so store this window info
+              # to memory and log it later.
+              if row[0] == "window_info": 
+                  # Row format: row_type,proc_name,window_title,start_time
+                  if start_time != None: 
+                      # Get end_time for previous row and dump to file
+                      end_time = float(row[3])
+                      yield make_interval(exe_name, window_title, start_time, end_time)
+                      
+                  # Get data for current row
+                  exe_name, window_title, start_time = row[1:]
+                  start_time = float(start_time)
+                  self.state = [start_time, exe_name, window_title]
+                  
+              else: # this is a idle_time row
+                  # Since this is an idle_time row, we just have 
+                  # to log the info for the preceding window_info
+                  # (since we know know the end_time) and move on.
+                  
+                  # Row format: row_type,idle_start,idle_end
+                  idle_start, idle_end = float(row[1]), float(row[2])
+                  if idle_end > idle_start:
+                      date = datetime.datetime.fromtimestamp(idle_start).strftime("%Y/%m/%d")
+                      self.idle[date] = self.idle.get(date, 0) + idle_end - idle_start
+                      
+                  if not start_time: 
+                      # If we haven't seen a start time, this 
+                      # log file started with an idle_time row: 
+                      # no window activity to log; move on. 
+                      continue
+                      
+                  # Get end_time for previous row and dump to DB
+                  end_time = idle_start
+                  if end_time < start_time:
+                      # This is a workaround for a bug in 
+                      # previous versions of this script that
+                      # has corrupted some data: 
+                      # Due to the bug, now idle_time rows are 
+                      # not in chronological order in some of my 
+                      # old log files. 
+                      # So for now, we skip these rows.
+                      # TODO: correct the old log files and delete
+                      # this workaround. Also, add versioning to 
+                      # this script and log files : )
+                      continue
+                  yield make_interval(exe_name, window_title, start_time, end_time)
+                  
+          if self.errors:
+              self.offset = max(self.offset, self.errors[-1][1])
+                  
+                  
+class MappedLogReader(LogReader):
+  '''
+  LogReader that scans the raw bytes of the log file (memory mapped, or 
+  in memory for an ArchivedLog) instead of going through csv.reader: rows 
+  are found by searching for line ends, and their fields are only sliced 
+  out as they are needed. If exe_names is given only the Intervals of 
+  those exes are yielded, and the window titles of the other rows are 
+  never read at all, which makes scanning for a few exes much cheaper. 
+  offset, state, first_time and idle are kept up to date as by LogReader
+  (state once iteration stops), and the Intervals yielded are the same.
+  
+  Rows with quoted fields (titles with commas, quotes or line breaks) are 
+  parsed with csv.reader. Corrupt rows are skipped and listed in errors, 
+  as by LogReader.
+  '''
+  def __init__(self, path, offset=0, state=None, exe_names=None):
+      LogReader.__init__(self, path, offset, state)
+      self.exe_names = set(exe_names) if exe_names is not None else None
+      
+  def __iter__(self):
+      if isinstance(self.path, ArchivedLog):
+          fd = None
+          buf = open_log(self.path).getvalue()
+      else:
+          fd = open(self.path, "rb")
+          size = os.fstat(fd.fileno()).st_size
+          buf = mmap.mmap(fd.fileno(), size, access=mmap.ACCESS_READ) if size else ""
+          
+      # The open window: its title is left in the buffer (at title_at) 
+      # until it is needed
+      if self.state:
+          start_time, exe_name, window_title = self.state
+      else:
+          start_time = exe_name = window_title = None
+      title_at = None
+      exe_names = self.exe_names
+      pos = self.offset
+      try:
+          while True:
+              eol = buf.find("\n", pos)
+              if eol == -1:
+                  break # the Logger is still writing this row
+              try:
+                  if buf.find("\0", pos, eol) != -1:
+                      raise ValueError("NUL byte")
+                  if buf.find("\"", pos, eol) == -1:
+                      # Unquoted: the fields are between the commas
+                      fields = None
+                      c1 = buf.find(",", pos, eol)
+                      c2 = buf.find(",", c1 + 1, eol)
+                      if c1 == -1 or c2 == -1:
+                          raise ValueError("too few fields")
+                      window = c1 - pos == 11 and buf.find("window_info", pos, c1) == pos
+                      if window:
+                          c3 = buf.find(",", c2 + 1, eol)
+                          if c3 == -1 or buf.find(",", c3 + 1, eol) != -1:
+                              raise ValueError("bad window_info row")
+                          t = float(buf[c3 + 1:eol])
+                      elif c1 - pos == 9 and buf.find("idle_time", pos, c1) == pos and \
+                              buf.find(",", c2 + 1, eol) == -1:
+                          t, idle_end = float(buf[c1 + 1:c2]), float(buf[c2 + 1:eol])
+                      else:
+                          raise ValueError("bad row")
+                      end = eol + 1
+                  else:
+                      # Quoted fields can contain line breaks: find the line the 
+                      # row ends on (where the quotes balance), then use csv
+                      end = eol + 1
+                      chunk = buf[pos:end]
+                      while chunk.count("\"") % 2 and end:
+                          end = buf.find("\n", end) + 1
+                          chunk = buf[pos:end]
+                      if not end or "\0" in chunk:
+                          raise ValueError("unbalanced quotes or NUL byte")
+                      fields = next(csv.reader(line + "\n" for line in chunk.split("\n")[:-1]))
+                      if not _valid_row(fields):
+                          raise ValueError("bad row")
+                      window = fields[0] == "window_info"
+                      if window:
+                          t = float(fields[3])
+                      else:
+                          t, idle_end = float(fields[1]), float(fields[2])
+              except (ValueError, csv.Error, StopIteration):
+                  # Skip the first line of the bad row, as read_rows does
+                  pos = eol + 1
+                  _add_error(self.errors, self.offset, pos)
+                  self.offset = pos
+                  continue
+              pos = end
+              self.offset = pos
+              if self.first_time is None:
+                  self.first_time = t
+                  
+              if window:
+                  # Close the previous window and open this one
+                  if start_time != None and (exe_names is None or exe_name in exe_names):
+                      if title_at:
+                          window_title = buf[title_at[0]:title_at[1]]
+                          title_at = None
+                      yield make_interval(exe_name, window_title, start_time, t)
+                  start_time = t
+                  if fields is None:
+                      exe_name, title_at = buf[c1 + 1:c2], (c2 + 1, c3)
+                  else:
+                      exe_name, window_title, title_at = fields[1], fields[2], None
+                      
+              else: # idle_time, handled as in LogReader
+                  idle_start = t
+                  if idle_end > idle_start:
+                      date = datetime.datetime.fromtimestamp(idle_start).strftime("%Y/%m/%d")
+                      self.idle[date] = self.idle.get(date, 0) + idle_end - idle_start
+                  if start_time and idle_start >= start_time and \
+                          (exe_names is None or exe_name in exe_names):
+                      if title_at:
+                          window_title = buf[title_at[0]:title_at[1]]
+                          title_at = None
+                      yield make_interval(exe_name, window_title, start_time, idle_start)
+      finally:
+          if title_at:
+              window_title = buf[title_at[0]:title_at[1]]
+          if start_time is not None:
+              self.state = [start_time, exe_name, window_title]
+          if fd:
+              if size:
+                  buf.close()
+              fd.close()
+
+
+def iter_intervals(directory, start=None, end=None, exe_names=None):
+    '''
+    Yields the Intervals logged to directory in chronological order. Log 
+    files are read lazily, one row at a time, so memory use doesn't depend 
+    on how much history there is. start and end are optional dates 
+    (inclusive); log files whose names ("YYYY-MM-DD windows.csv") fall 
+    outside that range aren't read at all. If exe_names is given, only the
+    intervals of those exes are yielded, and the logs are scanned with a 
+    MappedLogReader, which skips over the rest without parsing them.
+    
+    >>> for i in iter_intervals("data", datetime.date(2013, 9, 1), exe_names=["chrome.exe"]):
+    ...     print i.window_title
+    '''
+    if isinstance(start, datetime.datetime):
+        start = start.date()
+    if isinstance(end, datetime.datetime):
+        end = end.date()
+        
+    last = None # window left open by the last log file that had any rows
+    for log in log_files(directory):
+        fname = log.fname
+        if start or end:
+            try:
+                day = datetime.datetime.strptime(fname[:10], "%Y-%m-%d").date()
+            except ValueError:
+                continue
+            if (start and day < start) or (end and day > end):
+                continue
+                
+        # The first row of a log file never completes an interval of its 
+        # own, so once the first interval (if any) is read we know whether 
+        # the file closes the window left open by the previous one
+        if exe_names is None:
+            reader = LogReader(log.path)
+        else:
+            reader = MappedLogReader(log.path, exe_names=exe_names)
+        intervals = iter(reader)
+        first = next(intervals, None)
+        if reader.first_time is not None:
+            boundary = boundary_interval(last, reader.first_time)
+            if boundary and (exe_names is None or boundary.exe_name in exe_names):
+                yield boundary
+        if first is not None:
+            yield first
+            for interval in intervals:
+                yield interval
+        if reader.first_time is not None:
+            last = reader.state
+            
+            
+class LogIndex(object):
+  '''
+  Sparse index of the log files of one host, kept in "index.json" in 
+  directory (the host's cache directory). For every log file it stores a 
+  point for every few (every) window_info rows: the row's timestamp, its 
+  byte offset and the window that was open before it, i.e. the state a 
+  LogReader would have there. A LogReader started at that offset with that
+  state yields the same intervals as one that read the file from the top, 
+  so a query for a time range can start at the last point before the range
+  instead of replaying the whole day. The first_time of each file and the 
+  state at its end are kept too, which is all the next file needs for the 
+  interval that spans the two (see boundary_interval).
+  
+  A file's points are worked out the first time it is queried, and after 
+  that only when it changes: since the Logger only appends, a file that 
+  has grown is indexed from where we left off, as with the Manifest.
+  '''
+  VERSION = 1 # bump whenever the index changes meaning
+  
+  def __init__(self, directory, every=64):
+      self.directory = directory
+      self.filename = os.path.join(directory, "index.json")
+      self.every = every
+      self.files = {}
+      self.dirty = False
+      restore_file(self.filename)
+      if os.path.exists(self.filename):
+          try:
+              with open(self.filename, "rb") as fd:
+                  data = latin1(json.load(fd))
+              if (data.get("version"), data.get("every")) == (self.VERSION, every):
+                  self.files = data["files"]
+          except Exception as e:
+              # Just costs us indexing the files again
+              logging.warning("ignoring unreadable index %s: %s" % (self.filename, str(e)))
+              self.files = {}
+              
+  def entry(self, log):
+      '''
+      Returns the index of LogFile log: a dict of its size and mtime when it
+      was indexed, points ([timestamp, offset, state] lists, in order), the 
+      number of window_info rows, the offset and state at the end of the 
+      last complete row, and first_time
+      '''
+      entry = self.files.get(log.fname)
+      if entry and (entry["size"], entry["mtime"]) == (log.size, log.mtime):
+          return entry
+      if not entry or log.size <= entry["size"]:
+          entry = {"points": [], "rows": 0, "offset": 0, "state": None, 
+              "first_time": None}
+      with open_log(log.path) as fd:
+          fd.seek(entry["offset"])
+          offset = entry["offset"]
+          errors = []
+          for end, row in read_rows(fd, errors):
+              if row[0] == "window_info":
+                  t = float(row[3])
+                  if entry["rows"] % self.every == 0:
+                      entry["points"].append([t, offset, entry["state"]])
+                  entry["rows"] += 1
+                  entry["state"] = [t, row[1], row[2]]
+              else:
+                  t = float(row[1])
+              if entry["first_time"] is None:
+                  entry["first_time"] = t
+              offset = end
+          if errors:
+              offset = max(offset, errors[-1][1])
+      entry.update(size=log.size, mtime=log.mtime, offset=offset)
+      self.files[log.fname] = entry
+      self.dirty = True
+      return entry
+      
+  def seek(self, log, t):
+      '''
+      Returns the (offset, state) of the last point at or before time t in 
+      LogFile log, or None if the file has none
+      '''
+      points = self.entry(log)["points"]
+      i = bisect.bisect_right(points, [t, float("inf")]) - 1
+      if i < 0:
+          return None
+      return points[i][1], points[i][2]
+      
+  def save(self):
+      '''
+      Writes the index to disk (if it changed), via a temporary file as 
+      Manifest.save() does
+      '''
+      if not self.dirty:
+          return
+      if not os.path.exists(self.directory):
+          os.makedirs(self.directory)
+      tmp = self.filename + ".tmp"
+      with open(tmp, "wb") as fd:
+          json.dump({"version": self.VERSION, "every": self.every, 
+              "files": self.files}, fd, encoding="latin-1")
+      replace_file(tmp, self.filename)
+      self.dirty = False
+      
+      
+class TitleRules(object):
+  '''
+  Canonicalizes window titles and coalesces the intervals of titles that 
+  only differ in things like unread counts, clocks or "modified" markers, 
+  which would otherwise split time spent in one window into a flood of 
+  near-identical intervals. rules is a list of (pattern, replacement) 
+  regular expression substitutions applied to titles in order (by default 
+  COMMON_RULES); coalesce() merges consecutive intervals with the same exe 
+  name and canonical title that are at most gap seconds apart. The time 
+  between merged intervals counts as time in the window, even if the user 
+  was idle then: with the default gap of 0 only intervals that touch are 
+  merged and the totals stay as they were, while a larger gap can add up to
+  gap seconds to them per merge.
+  
+  The rules can be kept in a JSON file (see load()), in which "log": true 
+  asks for titles to be canonicalized as they are logged, too:
+  
+    {"rules": [["^\\(\\d+\\) ", ""]], "gap": 5, "log": false}
+  '''
+  COMMON_RULES = [
+      (r"^\(\d+\)\s*", ""), # unread counts: "(3) Inbox - Mail"
+      (r"^\*\s*|\s*\*(?= - )", ""), # modified markers: "*notes.txt - Notepad"
+      (r"\b\d{1,2}:\d{2}(:\d{2})?\b", "#:##"), # clocks and timers
+  ]
+  
+  def __init__(self, rules=None, gap=0, log=False):
+      self.rules = [(re.compile(pattern), replacement) for pattern, replacement in 
+          (self.COMMON_RULES if rules is None else rules)]
+      self.gap = gap
+      self.log = log
+      self._canonical = {} # titles repeat a lot
+      
+  @classmethod
+  def load(cls, filename):
+      '''
+      Returns the TitleRules in JSON file filename
+      '''
+      with open(filename, "rb") as fd:
+          data = latin1(json.load(fd))
+      return cls(data.get("rules"), data.get("gap", 0), data.get("log", False))
+      
+  def canonical(self, title):
+      '''
+      Returns title with the rules applied
+      '''
+      canonical = self._canonical.get(title)
+      if canonical is None:
+          canonical = title
+          for pattern, replacement in self.rules:
+              canonical = pattern.sub(replacement, canonical)
+          if len(self._canonical) > 100000:
+              self._canonical.clear()
+          self._canonical[title] = canonical
+      return canonical
+      
+  def coalesce(self, intervals):
+      '''
+      Yields intervals (in chronological order, from one host) with their 
+      titles canonicalized, merging runs of intervals that have the same exe
+      name and title and follow each other within gap seconds. A merged 
+      interval spans the gaps between them too (see TitleRules) and counts 
+      towards the date of its first one.
+      '''
+      last = None
+      for interval in intervals:
+          interval = interval._replace(window_title=self.canonical(interval.window_title))
+          if last is not None:
+              if interval[:2] == last[:2] and \
+                      last.end_time <= interval.start_time <= last.end_time + self.gap:
+                  last = last._replace(end_time=max(last.end_time, interval.end_time))
+                  continue
+              yield last
+          last = interval
+      if last is not None:
+          yield last
+          
+          
+def merge_intervals(streams):
+    '''
+    Merges streams of Intervals that are each in chronological order (such as
+    the cached intervals of several hosts) into one, yielding 
+    (stream index, Interval) pairs ordered by start_time. Only the next 
+    interval of each stream is held in memory, so however long the streams
+    are, memory use only grows with their number.
+    '''
+    heap = []
+    for i, stream in enumerate(streams):
+        stream = iter(stream)
+        for interval in stream:
+            heap.append((interval.start_time, i, interval, stream))
+            break
+    heapq.heapify(heap)
+    while heap:
+        start_time, i, interval, stream = heap[0]
+        yield i, interval
+        for interval in stream:
+            heapq.heapreplace(heap, (interval.start_time, i, interval, stream))
+            break
+        else:
+            heapq.heappop(heap)
+    
+    
+def parse_log(path, offset=0, state=None):
+    '''
+    Parses the log file at path starting at byte offset, with state being the
+    [start_time, exe_name, window_title] of the window that was open at 
+    offset (or None). Returns (intervals, offset, state, first_time, idle, 
+    errors), see LogReader.
+    '''
+    reader = LogReader(path, offset, state)
+    intervals = list(reader)
+    return intervals, reader.offset, reader.state, reader.first_time, reader.idle, \
+        reader.errors
+    
+    
+def _parse_task(task):
+    '''
+    multiprocessing.Pool entry point for parse_log; task is its arguments
+    '''
+    return parse_log(*task)
+
+
+class ActivityDB(object):
+  '''
+  SQLite database of the logged intervals (exe_name, window_title, 
+  start_time, end_time, date) and idle spans (start_time, end_time, date),
+  for queries over a time range or an exe name that shouldn't have to replay
+  every CSV file: both tables are indexed on start_time, and intervals on 
+  (exe_name, start_time) too. The database is in WAL mode, so the Logger 
+  can keep adding to it (see ActivityDBWriter) while it is being queried.
+  
+  Strings are stored as the bytes the Logger got from Windows and come back
+  as str. To start from the history that is already logged, use 
+  import_logs():
+  
+  >>> db = ActivityDB("data/watchme.db")
+  >>> db.import_logs("data")
+  >>> db.exe_time("chrome.exe", time.time() - 30 * 24 * 3600)
+  '''
+  SCHEMA = """
+    create table if not exists intervals (exe_name text, window_title text,
+        start_time real, end_time real, date text);
+    create index if not exists intervals_start on intervals (start_time);
+    create index if not exists intervals_exe on intervals (exe_name, start_time);
+    create table if not exists idle (start_time real, end_time real, date text);
+    create index if not exists idle_start on idle (start_time);
+    create table if not exists meta (key text primary key, value);
+  """
+  
+  def __init__(self, path):
+      self.path = path
+      self.conn = sqlite3.connect(path, timeout=30)
+      self.conn.text_factory = str
+      self.conn.execute("pragma journal_mode=wal")
+      self.conn.execute("pragma synchronous=normal")
+      self.conn.executescript(self.SCHEMA)
+      
+  def close(self):
+      self.conn.close()
+      
+  def _get(self, key, default=None):
+      row = self.conn.execute("select value from meta where key = ?", (key,)).fetchone()
+      return latin1(json.loads(row[0])) if row else default
+      
+  def _set(self, key, value):
+      self.conn.execute("insert or replace into meta values (?, ?)", 
+          (key, json.dumps(value, encoding="latin-1")))
+      
+  def add_rows(self, rows):
+      '''
+      Adds (fname, row) pairs, rows of log file fname as Logger writes them,
+      to the database and commits. Intervals are closed exactly as LogReader
+      and iter_intervals close them, including the window left open at the 
+      end of one log file; the window still open after the last row is kept
+      in the database for the next call.
+      '''
+      # [start_time, exe_name, window_title, fname] of the open window
+      state = self._get("state")
+      longest = self._get("longest", 0)
+      intervals = []
+      idle = []
+      for fname, row in rows:
+          if row[0] == "window_info":
+              t = float(row[3])
+          else:
+              t = float(row[1])
+          if state and state[3] != fname:
+              # First row of a new log file: see boundary_interval
+              boundary = boundary_interval(state[:3], t)
+              if boundary:
+                  intervals.append(boundary)
+              state = None
+              
+          if row[0] == "window_info":
+              if state:
+                  intervals.append(make_interval(state[1], state[2], state[0], t))
+              state = [t, row[1], row[2], fname]
+          else:
+              idle_start, idle_end = t, float(row[2])
+              if idle_end > idle_start:
+                  date = datetime.datetime.fromtimestamp(idle_start).strftime("%Y/%m/%d")
+                  idle.append((idle_start, idle_end, date))
+              if state and state[0] and idle_start >= state[0]:
+                  intervals.append(make_interval(state[1], state[2], state[0], idle_start))
+                  
+      with self.conn:
+          self.conn.executemany("insert into intervals values (?, ?, ?, ?, ?)", intervals)
+          self.conn.executemany("insert into idle values (?, ?, ?)", idle)
+          for interval in intervals:
+              longest = max(longest, interval.end_time - interval.start_time)
+          self._set("longest", longest)
+          self._set("state", state)
+          
+  def import_logs(self, directory):
+      '''
+      Replaces the contents of the database with the history logged to 
+      directory (the "YYYY-MM-DD windows.csv" files) and returns the number
+      of intervals imported
+      '''
+      with self.conn:
+          self.conn.execute("delete from intervals")
+          self.conn.execute("delete from idle")
+          self.conn.execute("delete from meta")
+          
+      def rows():
+          for log in log_files(directory):
+              with open_log(log.path) as fd:
+                  for offset, row in read_rows(fd):
+                      yield log.fname, row
+                      
+      # Commit a day's worth of rows or so at a time
+      rows = rows()
+      while True:
+          chunk = list(itertools.islice(rows, 10000))
+          if not chunk:
+              break
+          self.add_rows(chunk)
+      return self.conn.execute("select count(*) from intervals").fetchone()[0]
+      
+  def _range(self, start, end):
+      '''
+      Returns the bounds for a query over intervals that overlap [start, end)
+      (either may be None, for no bound). Intervals are found through the 
+      start_time index, which is why the lower bound on start_time is 
+      lowered by the longest interval in the database.
+      '''
+      start = float("-inf") if start is None else start
+      end = float("inf") if end is None else end
+      return {"start": start, "end": end, "from": start - self._get("longest", 0)}
+      
+  def intervals(self, start=None, end=None, exe_name=None):
+      '''
+      Yields the Intervals that overlap the time range [start, end) (in 
+      seconds since the epoch, either can be None), optionally only those of
+      exe_name, in order of start_time
+      '''
+      query = "select exe_name, window_title, start_time, end_time, date from intervals " \
+          "where start_time >= :from and start_time < :end and end_time > :start"
+      args = self._range(start, end)
+      if exe_name is not None:
+          query += " and exe_name = :exe_name"
+          args["exe_name"] = exe_name
+      for row in self.conn.execute(query + " order by start_time", args):
+          yield Interval(*row)
+          
+  def exe_times(self, start=None, end=None):
+      '''
+      Returns a dict mapping exe names to the seconds spent in them during 
+      [start, end)
+      '''
+      return dict(self.conn.execute("select exe_name, "
+          "sum(min(end_time, :end) - max(start_time, :start)) from intervals "
+          "where start_time >= :from and start_time < :end and end_time > :start "
+          "group by exe_name", self._range(start, end)))
+          
+  def exe_time(self, exe_name, start=None, end=None):
+      '''
+      Returns the seconds spent in exe_name during [start, end)
+      '''
+      args = self._range(start, end)
+      args["exe_name"] = exe_name
+      return self.conn.execute("select "
+          "total(min(end_time, :end) - max(start_time, :start)) from intervals "
+          "where exe_name = :exe_name and start_time >= :from and start_time < :end "
+          "and end_time > :start", args).fetchone()[0]
+          
+  def idle_time(self, start=None, end=None):
+      '''
+      Returns the idle seconds that started during [start, end)
+      '''
+      args = self._range(start, end)
+      return self.conn.execute("select total(end_time - start_time) from idle "
+          "where start_time >= :start and start_time < :end", args).fetchone()[0]
+          
+
+class ActivityDBWriter(LogWriter):
+  '''
+  LogWriter that also adds the rows it writes to the ActivityDB at path. 
+  Rows get to the database once they are on disk, so it never has rows the
+  CSV files don't. The database is opened on the first flush, in the thread
+  that writes (SQLite connections can't be shared between threads).
+  '''
+  def __init__(self, logdir, path, **kwargs):
+      LogWriter.__init__(self, logdir, **kwargs)
+      self.path = path
+      self.db = None
+      
+  def flush(self):
+      rows = list(self.rows)
+      LogWriter.flush(self)
+      written = rows[:len(rows) - len(self.rows)]
+      if not written:
+          return
+      try:
+          if self.db is None:
+              self.db = ActivityDB(self.path)
+          self.db.add_rows(written)
+      except sqlite3.Error as e:
+          # The CSV files have the rows; import_logs can catch up later
+          logging.error("database writing failed: " + str(e))
+          
+  def close(self):
+      LogWriter.close(self)
+      if self.db:
+          self.db.close()
+          self.db = None
+
+
+# The cache of one host's intervals (see Analyzer.update_hosts): its Manifest
+# and sorted log file names, and the tail update() returned for it
+HostCache = namedtuple("HostCache", ["host", "manifest", "fnames", "tail"])
+
+
+# >python -i -c "from watchme import Analyzer; import os; a = Analyzer(os.getcwd() + \"\\data\"); a.analyze()"
+class Analyzer(object):
+  '''
+  Used to Analyze log data. Aggregates log data from CSV files on disk, writes 
+  them to a javascript file, then launches an HTML file with the default 
+  browser that reads the javascript file and supplies a GUI for the user to 
+  analyze the data.
+  
+  Parsing is incremental: a Manifest in the "cache" subdirectory records how 
+  far each log file has been parsed, so only files that changed since the 
+  last run (usually just today's) are read again. Daily and hourly Rollups 
+  are written to rollups.js and a TokenIndex of window titles to index.js 
+  along with alldata.js.
+  
+  js_format selects how the data is written to alldata.js: "chunks" for a 
+  ChunkedJsFile (the default), "columns" for a ColumnarJsFile or "array" 
+  for the watchme_data object array written by JsArrayFile. When only new 
+  rows were logged, the array is appended to and only the latest chunk is 
+  written again; "columns" is always written in full. workers is the number of processes used to parse 
+  log files; the result is the same whatever the number. db is the path of
+  an ActivityDB to answer queries such as exe_time() from, if there is one.
+  
+  The time each phase of the analysis takes and the number of files and 
+  rows it handles are recorded in stats ("list", "parse", "export", "write",
+  "launch"), which are saved to stats_file (if given) after every run; a 
+  QueryServer records its refreshes there too. If profile is given, 
+  analyze() and the QueryServer's refreshes run under cProfile (see 
+  profiled) and the profile is dumped to that file.
+  
+  The logs of other hosts (e.g. VMs, or other machines running a Logger) 
+  are analyzed along with those in directory, which are this host's (named
+  after it; see host). hosts maps host names to the data directories their
+  logs are in; by default it is the subdirectories of directory's "hosts" 
+  subdirectory, so other machines' data directories can simply be copied 
+  or synced there. Each host's logs are cached separately (under 
+  cache/hosts), parsed in the same pool of workers, and merged by time; 
+  rollups.js then has the totals of each host as well as the combined ones.
+  
+  If title_rules (a TitleRules) is given, the intervals read back from the 
+  cache are coalesced with it before they are exported, so the cache keeps 
+  the titles as logged and changing the rules takes effect on the next run.
+  '''
+  def __init__(self, directory, js_format="chunks", workers=1, db=None,
+               stats_file=None, profile=None, hosts=None, title_rules=None):
+    if js_format not in ("chunks", "columns", "array"):
+        raise ValueError("unknown js_format: %s" % js_format)
+    self.directory = directory
+    self.js_format = js_format
+    self.workers = workers
+    self.exe_names = StringTable()
+    self.window_titles = StringTable()
+    self.cachedir = os.path.join(directory, "cache")
+    self.db = db
+    self.stats = Stats("analyzer")
+    self.stats_file = stats_file
+    self.profile = profile
+    self._profiler = None
+    self.host = platform.node() or "localhost"
+    self.other_hosts = hosts
+    self.title_rules = title_rules
+    
+  def hosts(self):
+    '''
+    Returns the (host name, log directory, cache directory) of each host 
+    whose logs are analyzed, starting with this one. A copy of this host's 
+    own logs in the "hosts" subdirectory is ignored.
+    '''
+    hosts = [(self.host, self.directory, self.cachedir)]
+    others = self.other_hosts
+    if others is None:
+        others = {}
+        hostdir = os.path.join(self.directory, "hosts")
+        if os.path.isdir(hostdir):
+            for name in os.listdir(hostdir):
+                if name != self.host and os.path.isdir(os.path.join(hostdir, name)):
+                    others[name] = os.path.join(hostdir, name)
+    for name in sorted(others):
+        hosts.append((name, others[name], os.path.join(self.cachedir, "hosts", name)))
+    return hosts
+    
+  def exe_time(self, exe_name, start=None, end=None):
+    '''
+    Returns the seconds spent in exe_name between times start and end 
+    (either can be None) on this host. With an ActivityDB this is an index 
+    lookup; otherwise it adds up the intervals() of the range.
+    '''
+    if self.db:
+        db = ActivityDB(self.db)
+        try:
+            return db.exe_time(exe_name, start, end)
+        finally:
+            db.close()
+    return sum(i.end_time - i.start_time for i in self.intervals(start, end, [exe_name]))
+    
+  def intervals(self, start=None, end=None, exe_names=None, host=None):
+    '''
+    Returns the Intervals of host (by default this one) that overlap the 
+    time range [start, end) (timestamps; either can be None), clipped to 
+    the range and in chronological order, starting with the one that was 
+    already in progress at start. If exe_names is given, only the intervals
+    of those exes are returned. Only the log files of the days in the range
+    are read, and the first of them only from the last LogIndex point 
+    before start, so asking what went on between two and four one 
+    afternoon takes about as long however much history there is.
+    
+    >>> for i in analyzer.intervals(time.mktime((2013, 3, 3, 14, 0, 0, 0, 0, -1)), 
+    ...                             time.mktime((2013, 3, 3, 16, 0, 0, 0, 0, -1))):
+    ...     print i.exe_name, i.window_title, i.end_time - i.start_time
+    '''
+    for name, directory, cachedir in self.hosts():
+        if name == (host or self.host):
+            break
+    else:
+        raise ValueError("unknown host: %s" % host)
+    start = float("-inf") if start is None else start
+    end = float("inf") if end is None else end
+    first = last = None
+    if start != float("-inf"):
+        first = datetime.date.fromtimestamp(start)
+    if end != float("inf"):
+        last = datetime.date.fromtimestamp(end)
+        
+    with self.stats.timed("intervals"):
+        logs = []
+        for log in log_files(directory):
+            try:
+                logs.append((datetime.datetime.strptime(log.fname[:10], "%Y-%m-%d").date(), log))
+            except ValueError:
+                continue
+        index = LogIndex(cachedir)
+        
+        # Start with the last log that has rows from before start (usually 
+        # start's day's), and take the window left open by the log before it
+        begin = 0
+        if first:
+            begin = bisect.bisect_right([day for day, log in logs], first) - 1
+            while begin > 0:
+                first_time = index.entry(logs[begin][1])["first_time"]
+                if first_time is not None and first_time <= start:
+                    break
+                begin -= 1
+            begin = max(begin, 0)
+        state = None
+        for day, log in reversed(logs[:begin]):
+            entry = index.entry(log)
+            if entry["first_time"] is not None:
+                state = entry["state"]
+                break
+                
+        def stream(state):
+            for n, (day, log) in enumerate(logs[begin:]):
+                point = index.seek(log, start) if n == 0 else None
+                if point:
+                    # Everything before the point ends before start
+                    reader = LogReader(log.path, *point)
+                    intervals = iter(reader)
+                else:
+                    reader = LogReader(log.path)
+                    intervals = iter(reader)
+                    first_interval = next(intervals, None)
+                    boundary = boundary_interval(state, reader.first_time)
+                    if boundary:
+                        yield boundary
+                    if last and day > last:
+                        return # only needed this log to close the last window
+                    if first_interval is not None:
+                        yield first_interval
+                for interval in intervals:
+                    yield interval
+                if reader.first_time is not None:
+                    state = reader.state
+                    
+        intervals = stream(state)
+        if self.title_rules:
+            intervals = self.title_rules.coalesce(intervals)
+        exe_names = set(exe_names) if exe_names is not None else None
+        results = []
+        for i in intervals:
+            if i.start_time >= end:
+                break
+            if i.end_time <= start or (exe_names is not None and i.exe_name not in exe_names):
+                continue
+            results.append(make_interval(i.exe_name, i.window_title, 
+                max(i.start_time, start), min(i.end_time, end)))
+        intervals.close()
+        index.save()
+    return results
+    
+  def update(self, manifest, directory=None):
+    '''
+    Brings the cached intervals in manifest up to date with the log files on 
+    disk (in directory, by default self.directory). Unchanged files are 
+    skipped, files that have only grown are parsed from their recorded 
+    offset and anything else is parsed from scratch, using self.workers 
+    processes if there is more than one.
+    Returns (fnames, tail): the sorted log file names and, if the only
+    changes were appends at the chronological end of the data, a dict mapping
+    the log files at the end to the cache offset at which their new items 
+    start (otherwise None, meaning alldata.js has to be rewritten).
+    '''
+    fnames, tail, tasks = self._plan(manifest, directory or self.directory)
+    self.stats.counters["files"] = len(fnames)
+    self._parse([(manifest, tasks)])
+    return fnames, tail
+    
+  def update_hosts(self):
+    '''
+    Brings the cached intervals of every host (see hosts) up to date, as 
+    update() does, parsing the log files of all of them in one pool of 
+    self.workers processes. Returns a HostCache for each host, in the order
+    hosts() lists them.
+    '''
+    caches = []
+    jobs = []
+    for host, directory, cachedir in self.hosts():
+        if not os.path.exists(cachedir):
+            os.makedirs(cachedir)
+        manifest = Manifest(cachedir)
+        fnames, tail, tasks = self._plan(manifest, directory)
+        caches.append(HostCache(host, manifest, fnames, tail))
+        jobs.append((manifest, tasks))
+    self.stats.counters["files"] = sum(len(cache.fnames) for cache in caches)
+    self.stats.counters["hosts"] = len(caches)
+    self._parse(jobs)
+    return caches
+    
+  def _plan(self, manifest, directory):
+    '''
+    Works out which of the log files in directory need to be parsed into 
+    manifest's cache, and from where. Returns (fnames, tail, tasks), where
+    fnames and tail are as update() returns them and tasks are for _parse.
+    '''
+    with self.stats.timed("list"):
+        logs = log_files(directory)
+    fnames = [log.fname for log in logs]
+    known = sorted(manifest.files)
+    
+    # New items can only be tacked onto the end of alldata.js if they come 
+    # after everything already in it. The last file we know about is always
+    # part of the tail, since its open window is closed by the next file.
+    tail = {}
+    if known and known[-1] in fnames and manifest.files[known[-1]]["first_time"] is not None:
+        tail[known[-1]] = manifest.files[known[-1]]["cache_size"]
+    elif known:
+        tail = None
+    
+    # Forget about log files that have been deleted
+    for fname in set(known) - set(fnames):
+        del manifest.files[fname]
+        if os.path.exists(manifest.cache_path(fname)):
+            os.remove(manifest.cache_path(fname))
+        tail = None
+        
+    # Work out which files need to be parsed, and from where
+    tasks = []
+    for fname, path, size, mtime in logs:
+        entry = manifest.files.get(fname)
+        if entry and (entry["size"], entry["mtime"]) == (size, mtime):
+            continue # unchanged since last run (or since it was archived)
+            
+        if entry and size > entry["size"] and os.path.exists(manifest.cache_path(fname)):
+            # The Logger only ever appends, so pick up where we left off
+            tasks.append((fname, (size, mtime), entry, (path, entry["offset"], entry["state"])))
+            if tail is not None and fname != known[-1]:
+                tail = None
+        else:
+            tasks.append((fname, (size, mtime), None, (path, 0, None)))
+            if tail is not None and not entry and (not known or fname > known[-1]):
+                tail[fname] = 0
+            else:
+                tail = None
+    return fnames, tail, tasks
+    
+  def _parse(self, jobs):
+    '''
+    Parses the log files of jobs, a list of (manifest, tasks) pairs from 
+    _plan, into the caches of their manifests, in parallel if we've been 
+    asked to. Log files are parsed independently of each other; intervals 
+    that span two files are resolved when the cached intervals are read 
+    back (see cached_items).
+    '''
+    parse_start = time.time()
+    tasks = [(manifest, task) for manifest, host_tasks in jobs for task in host_tasks]
+    args = [task[3] for manifest, task in tasks]
+    if self.workers > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(self.workers, len(tasks)))
+        results = pool.imap(_parse_task, args)
+    else:
+        pool = None
+        results = itertools.imap(_parse_task, args)
+        
+    fname = None
+    try:
+        for (manifest, (fname, (size, mtime), entry, _)), result in itertools.izip(tasks, results):
+            items, offset, state, first_time, idle, errors = result
+            if errors:
+                logging.warning("%s: skipped %d corrupt region(s) of the log: %s" % 
+                    (fname, len(errors), ", ".join("bytes %d-%d" % tuple(e) for e in errors)))
+                self.stats.count("corrupt_regions", len(errors))
+            with open(manifest.cache_path(fname), "r+b" if entry else "wb") as fd:
+                if entry:
+                    # Drop anything written after the manifest was last saved
+                    fd.seek(entry["cache_size"])
+                    fd.truncate()
+                    if entry["first_time"] is not None:
+                        first_time = entry["first_time"]
+                    for date, seconds in entry["idle"].iteritems():
+                        idle[date] = idle.get(date, 0) + seconds
+                    errors = entry.get("errors", []) + errors
+                csv.writer(fd).writerows(items)
+                cache_size = fd.tell()
+            manifest.files[fname] = {"size": size, "mtime": mtime,
+                "offset": offset, "state": state, "cache_size": cache_size,
+                "first_time": first_time, "idle": idle, "errors": errors,
+                "count": (entry["count"] if entry else 0) + len(items)}
+            self.stats.count("parsed_rows", len(items))
+    except Exception as e:
+        logging.error("error while processing file: %s" % fname)
+        raise e
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    self.stats.add("parse", time.time() - parse_start)
+    self.stats.count("parsed_files", len(tasks))
+    
+  def cached_items(self, manifest, fnames, offsets=None):
+    '''
+    Yields the cached Intervals of log files fnames in order, starting each
+    file's cache at offsets[fname] (default 0). As in iter_intervals, the 
+    window that was still open at the end of a log file is closed by the 
+    first row of the next one (see boundary_interval), so intervals that 
+    cross midnight aren't lost.
+    '''
+    last = None # window left open by the last log file that had any rows
+    for fname in fnames:
+        entry = manifest.files[fname]
+        if entry["first_time"] is not None:
+            boundary = boundary_interval(last, entry["first_time"])
+            if boundary:
+                yield boundary
+            last = entry["state"]
+                
+        with open(manifest.cache_path(fname), "rb") as fd:
+            fd.seek((offsets or {}).get(fname, 0))
+            for exe_name, window_title, start_time, end_time, date in csv.reader(fd):
+                yield Interval(exe_name, window_title, float(start_time), float(end_time), date)
+                
+  def host_items(self, caches):
+    '''
+    Yields (host index, Interval) for the cached intervals of HostCaches 
+    caches (see update_hosts), merged into chronological order, and 
+    coalesced with self.title_rules if there are any
+    '''
+    streams = [self.cached_items(cache.manifest, cache.fnames) for cache in caches]
+    if self.title_rules:
+        streams = [self.title_rules.coalesce(stream) for stream in streams]
+    return merge_intervals(streams)
+            
+  def encode(self, items):
+    '''
+    Dictionary encodes Intervals into 
+    [exe_code, window_title_code, start_time, end_time, date] items using 
+    the self.exe_names and self.window_titles StringTables.
+    '''
+    exe_code = self.exe_names.code
+    title_code = self.window_titles.code
+    for exe_name, window_title, start_time, end_time, date in items:
+        yield [exe_code(exe_name), title_code(window_title), start_time, end_time, date]
+    
+  def rollups(self, caches, host_rollups, arrays=None):
+    '''
+    Completes host_rollups, the Rollups of each of HostCaches caches, with 
+    the totals of the items of each host in arrays (if the items were 
+    collected in an IntervalArrays rather than added to the Rollups) and 
+    the idle time of each host. Returns the combined Rollups, which have 
+    the totals of each host too if there is more than one.
+    '''
+    if arrays is not None:
+        arrays.finish()
+    for host, (cache, totals) in enumerate(itertools.izip(caches, host_rollups)):
+        if arrays is not None:
+            if len(caches) > 1:
+                arrays.select(arrays.host_code == host).rollups(totals)
+            else:
+                arrays.rollups(totals)
+        totals.idle = cache.manifest.idle()
+    if len(caches) == 1:
+        return host_rollups[0]
+    rollups = Rollups()
+    for cache, totals in itertools.izip(caches, host_rollups):
+        rollups.merge(totals)
+        rollups.hosts[cache.host] = totals.to_dict()
+    return rollups
+    
+  def save_stats(self):
+    '''
+    Saves the stats to stats_file, if there is one
+    '''
+    if self.stats_file:
+        self.stats.save(self.stats_file)
+        
+  @contextlib.contextmanager
+  def profiled(self):
+    '''
+    Context manager that runs what is in it under cProfile if there is a 
+    profile file, then dumps the profile of everything run under it so far
+    to that file
+    '''
+    if not self.profile:
+        yield
+        return
+    if self._profiler is None:
+        self._profiler = cProfile.Profile()
+    self._profiler.enable()
+    try:
+        yield
+    finally:
+        self._profiler.dump_stats(self.profile) # this disables it
+        
+  def analyze(self):
+    '''
+    Parses CSV files created by logger and writes result to an HTML file as 
+    a javascript array (as a workaround to same-origin-policy security). 
+    There might be a better way...
+    '''
+    with self.profiled():
+        return self._analyze()
+        
+  def _analyze(self):
+    logging.info("Analyzer.analyze called, self.directory=%s" % self.directory)
+    if not os.path.exists(self.cachedir):
+        os.makedirs(self.cachedir)
+    js_filename = os.path.join(self.directory, "alldata.js")
+    self.exe_names = StringTable()
+    self.window_titles = StringTable()
+    
+    # Bring the cached intervals of every host up to date with their log 
+    # files; this host's manifest also records what alldata.js holds
+    try:
+        caches = self.update_hosts()
+    except Exception as e:
+        logging.error("error while gathering data: %s" % str(e))
+        raise e
+    manifest = caches[0].manifest
+    # An appended interval could need coalescing with one already written
+    tail = caches[0].tail if len(caches) == 1 and not self.title_rules else None
+        
+    # Write the Javascript file for aggregated log data, computing the 
+    # rollups (of each host) as we go: if only new data was added at the end
+    # of a watchme_data array or of the last chunk, append it to the 
+    # existing file (or rewrite just that chunk) and add it to the existing
+    # rollups; otherwise rebuild both from the cached intervals.
+    appending = tail is not None and manifest.js_count is not None and \
+        manifest.rollups is not None and os.path.exists(js_filename)
+    if appending and self.js_format == "chunks":
+        appending = bool(manifest.chunks)
+    elif appending:
+        appending = self.js_format == "array" and manifest.chunks is None
+    titles_written = len(manifest.titles) if appending else None
+    try:
+        if appending and self.js_format == "chunks":
+            # The last chunk is read back; if it is missing or was left 
+            # half written by an earlier run, rebuild them all instead
+            try:
+                js_array = ChunkedJsFile(js_filename, StringTable(manifest.exes), 
+                    StringTable(manifest.titles), manifest.chunks)
+            except (IOError, ValueError) as e:
+                logging.warning("rebuilding chunks: %s" % str(e))
+                appending = False
+        if appending:
+            # Keep the codes of the data already written, so the index (and
+            # the chunks) match the order strings appear in alldata.js
+            if self.js_format == "array":
+                self.window_titles = StringTable(manifest.titles)
+                js_array = JsArrayFile(js_filename, self.exe_names, 
+                    self.window_titles, manifest.js_count)
+            else:
+                self.exe_names = js_array.exe_names
+                self.window_titles = js_array.window_titles
+            host_rollups = [Rollups(manifest.rollups)]
+            items = ((0, i) for i in self.cached_items(manifest, sorted(tail), tail))
+        else:
+            if self.js_format == "array":
+                js_array = JsArrayFile(js_filename, self.exe_names, self.window_titles)
+            elif self.js_format == "columns":
+                js_array = ColumnarJsFile(js_filename, self.exe_names, self.window_titles)
+            else:
+                js_array = ChunkedJsFile(js_filename, self.exe_names, self.window_titles)
+            host_rollups = [Rollups() for cache in caches]
+            items = self.host_items(caches)
+        # With NumPy the rollups are computed in one go at the end
+        export_start = time.time()
+        exe_code = self.exe_names.code
+        title_code = self.window_titles.code
+        arrays = IntervalArrays(self.exe_names, self.window_titles) if numpy else None
+        count = 0
+        for host, (exe_name, window_title, start_time, end_time, date) in items:
+            item = [exe_code(exe_name), title_code(window_title), start_time, end_time, date]
+            js_array.append(item)
+            if arrays is not None:
+                arrays.append(item, host)
+            else:
+                host_rollups[host].add(exe_name, start_time, end_time, date)
+            count += 1
+        rollups = self.rollups(caches, host_rollups, arrays)
+        self.stats.add("export", time.time() - export_start)
+        self.stats.count("exported_rows", count)
+                        
+        # The watchme_data array and the chunks can be appended to next 
+        # time (the chunks once they are written; see below)
+        if self.js_format == "array":
+            manifest.js_count = js_array.i
+        else:
+            manifest.js_count = None
+        manifest.chunks = None
+        manifest.rollups = rollups.to_dict()
+        manifest.titles = self.window_titles.strings
+        manifest.exes = self.exe_names.strings
+    except Exception as e:
+        logging.error("error while writing JsArrayFile: %s" % str(e))
+        raise e
+      
+    # Close the Javascript Array file, which now contains all activity data,
+    # and write the rollups and search index next to it.
+    try:  
+        with self.stats.timed("write"):
+            js_array.finish()
+            if self.js_format == "chunks":
+                manifest.chunks = js_array.chunks
+                manifest.js_count = sum(chunk["count"] for chunk in js_array.chunks)
+            rollups.write(os.path.join(self.directory, "rollups.js"))
+            # The index only changes with the titles
+            index_filename = os.path.join(self.directory, "index.js")
+            if titles_written != len(self.window_titles) or not os.path.exists(index_filename):
+                TokenIndex(self.window_titles).write(index_filename)
+            for cache in caches:
+                cache.manifest.save()
+    except Exception as e:
+        logging.error("error while writing chart postlude: %s" % str(e))
+        raise e
+      
+    # Launch the analyzer page (which reads the Javascript array file) with the
+    # default browser.
+    try:
+        with self.stats.timed("launch"):
+            subprocess.Popen("chart.html", shell=True)
+    except Exception as e:
+        logging.error("error while launching chart viewer: %s" % str(e))
+        raise e
+    self.save_stats()
+ 
+
+def parse_query(query):
+    '''
+    Splits a search query into groups of lower case tokens, as chart.html 
+    does: tokens joined by AND form a group, and a string matches a group if
+    it contains all of its tokens. Other tokens (optionally separated by OR)
+    are groups of their own.
+    '''
+    groups = []
+    joined = False
+    for tok in query.split(" "):
+        if tok == "AND":
+            joined = len(groups) > 0
+        elif tok == "OR":
+            joined = False
+        elif tok != "":
+            if joined:
+                groups[-1].append(tok.lower())
+            else:
+                groups.append([tok.lower()])
+            joined = False
+    return groups
+    
+    
+def count_hits(strings, groups):
+    '''
+    Returns, for each of strings, the number of query groups it matches
+    '''
+    hits = []
+    for s in strings:
+        s = s.lower()
+        hits.append(sum(1 for group in groups if all(tok in s for tok in group)))
+    return hits
+
+
+class QueryData(object):
+  '''
+  In-memory copy of the intervals in an Analyzer's cache (of every host)
+  that QueryServer answers queries from: start_time, end_time, exe_code and title_code 
+  columns (in chronological order) with the exe_names and window_titles 
+  StringTables, plus the Rollups and, if NumPy is available, stats (an 
+  IntervalArrays). etag identifies the log data it was built from.
+  
+  caches are the HostCaches to build it from, as update_hosts() returns 
+  them (by default it is called). appended() gives an up to date copy 
+  without starting over when the logs have only been appended to.
+  '''
+  def __init__(self, analyzer, caches=None):
+      if caches is None:
+          caches = analyzer.update_hosts()
+      analyzer.exe_names = StringTable()
+      analyzer.window_titles = StringTable()
+      self.exe_names = analyzer.exe_names
+      self.window_titles = analyzer.window_titles
+      self.hosts = [cache.host for cache in caches]
+      self.start_time = array.array("d")
+      self.end_time = array.array("d")
+      self.exe_code = array.array("I")
+      self.title_code = array.array("I")
+      self.host_code = array.array("I")
+      self.last_rows = {} # host index -> row of its last interval
+      host_rollups = [Rollups() for cache in caches]
+      self.stats = IntervalArrays(self.exe_names, self.window_titles) if numpy else None
+      export_start = time.time()
+      # Range queries bisect start_time; the logs are all but sorted already
+      hosts, intervals = itertools.tee(analyzer.host_items(caches))
+      items = list(itertools.izip((host for host, interval in hosts), 
+          analyzer.encode(interval for host, interval in intervals)))
+      items.sort(key=lambda (host, item): item[2])
+      for host, item in items:
+          self._append(host, item)
+          if self.stats is not None:
+              self.stats.append(item, host)
+          else:
+              host_rollups[host].add(self.exe_names[item[0]], item[2], item[3], item[4])
+      # The totals of each host are kept for appended() to add to
+      self.rollups = analyzer.rollups(caches, host_rollups, self.stats)
+      self.host_rollups = host_rollups
+      analyzer.stats.add("export", time.time() - export_start)
+      self._saved(analyzer, caches)
+      
+  def _append(self, host, item):
+      self.exe_code.append(item[0])
+      self.title_code.append(item[1])
+      self.start_time.append(item[2])
+      self.end_time.append(item[3])
+      self.host_code.append(host)
+      self.last_rows[host] = len(self.start_time) - 1
+      
+  def _saved(self, analyzer, caches):
+      # The cache may have moved on from alldata.js, so make the next 
+      # analyze() rewrite it rather than append to it
+      caches[0].manifest.js_count = None
+      with analyzer.stats.timed("write"):
+          for cache in caches:
+              cache.manifest.save()
+      self.etag = '"%s"' % hashlib.sha1(json.dumps(sorted(
+          (cache.host, f, e["size"], e["mtime"]) for cache in caches 
+              for f, e in cache.manifest.files.iteritems()))).hexdigest()
+              
+  def appended(self, analyzer, caches):
+      '''
+      Returns a copy of this QueryData with the intervals that HostCaches 
+      caches (from update_hosts()) have gained at their tail added, or None
+      if they gained anything anywhere else (e.g. a log file was rewritten):
+      then the QueryData has to be built afresh. The new intervals are 
+      merged in by start_time, so another host's can come in a little 
+      behind ours. Apart from copying the columns (a memcpy), the work 
+      depends on what was logged, not on how much history there is; and 
+      queries can keep using this QueryData meanwhile.
+      '''
+      if [cache.host for cache in caches] != self.hosts or \
+              any(cache.tail is None for cache in caches):
+          return None
+      export_start = time.time()
+      streams = [analyzer.cached_items(cache.manifest, sorted(cache.tail), cache.tail) 
+          for cache in caches]
+      if analyzer.title_rules:
+          streams = [analyzer.title_rules.coalesce(stream) for stream in streams]
+      items = list(merge_intervals(streams))
+      
+      # With title rules, the first new interval of a host can continue its
+      # last one, as it would have had they been coalesced together
+      extend = {} # row -> new end_time
+      if analyzer.title_rules:
+          gap = analyzer.title_rules.gap
+          first = {}
+          for i, (host, interval) in enumerate(items):
+              first.setdefault(host, i)
+          for host, i in first.iteritems():
+              row = self.last_rows.get(host)
+              interval = items[i][1]
+              if row is not None and \
+                      self.exe_names[self.exe_code[row]] == interval.exe_name and \
+                      self.window_titles[self.title_code[row]] == interval.window_title and \
+                      self.end_time[row] <= interval.start_time <= self.end_time[row] + gap:
+                  extend[row] = max(self.end_time[row], interval.end_time)
+                  items[i] = None
+          items = [item for item in items if item is not None]
+          
+      # Encoded with our own StringTables: analyze() may have replaced the 
+      # analyzer's since
+      exe_code = self.exe_names.code
+      title_code = self.window_titles.code
+      items = [(host, [exe_code(i.exe_name), title_code(i.window_title), i.start_time, 
+          i.end_time, i.date]) for host, i in items]
+      host_rollups = copy.deepcopy(self.host_rollups)
+      for row, end_time in extend.iteritems():
+          host_rollups[self.host_code[row]].add(self.exe_names[self.exe_code[row]], 
+              self.end_time[row], end_time, datetime.datetime.fromtimestamp(
+                  self.start_time[row]).strftime("%Y/%m/%d"))
+      for host, item in items:
+          host_rollups[host].add(self.exe_names[item[0]], item[2], item[3], item[4])
+          
+      # Rows that start after the first new interval are merged with the new
+      # ones; the rows before it stay as they are
+      rows = len(self)
+      if items:
+          rows = bisect.bisect_right(self.start_time, min(item[2] for host, item in items))
+      moved = []
+      for row in xrange(rows, len(self)):
+          start_time = self.start_time[row]
+          moved.append((self.host_code[row], [self.exe_code[row], self.title_code[row],
+              start_time, extend.get(row, self.end_time[row]), 
+              datetime.datetime.fromtimestamp(start_time).strftime("%Y/%m/%d")]))
+      merged = sorted(moved + items, key=lambda (host, item): (item[2], host))
+      
+      data = copy.copy(self)
+      data.start_time = self.start_time[:rows]
+      data.end_time = self.end_time[:rows]
+      data.exe_code = self.exe_code[:rows]
+      data.title_code = self.title_code[:rows]
+      data.host_code = self.host_code[:rows]
+      data.last_rows = dict(self.last_rows)
+      for host, item in merged:
+          data._append(host, item)
+      if self.stats is not None:
+          data.stats = self.stats.spliced(rows, merged)
+      for row, end_time in extend.iteritems():
+          if row < rows: # the others were moved, end_time and all
+              data.end_time[row] = end_time
+              if data.stats is not None:
+                  data.stats.end_time[row] = end_time
+      data.rollups = analyzer.rollups(caches, host_rollups)
+      data.host_rollups = host_rollups
+      analyzer.stats.add("export", time.time() - export_start)
+      data._saved(analyzer, caches)
+      return data
+      
+  def __len__(self):
+      return len(self.start_time)
+      
+  def rows(self, start=None, end=None):
+      '''
+      Returns the xrange of rows whose start_time is in [start, end) (either
+      may be None, for no bound)
+      '''
+      lo = 0 if start is None else bisect.bisect_left(self.start_time, start)
+      hi = len(self) if end is None else bisect.bisect_left(self.start_time, end)
+      return xrange(lo, max(lo, hi))
+      
+  def hits(self, field, groups):
+      '''
+      Returns (codes, hits): the column of codes for field ("exe_name" or 
+      "window_title") and the number of query groups each code's string 
+      matches (every code matches once if there are no groups)
+      '''
+      if field == "exe_name":
+          codes, table = self.exe_code, self.exe_names
+      elif field == "window_title":
+          codes, table = self.title_code, self.window_titles
+      else:
+          raise ValueError("unknown field: %s" % field)
+      if not groups:
+          return codes, [1] * len(table)
+      return codes, count_hits(table.strings, groups)
+      
+  def exes(self, start=None, end=None):
+      '''
+      Returns [exe_name, seconds] pairs for the intervals starting in 
+      [start, end), most used first
+      '''
+      if start is None and end is None:
+          totals = {}
+          for day in self.rollups.days.itervalues():
+              for exe_name, seconds in day.iteritems():
+                  totals[exe_name] = totals.get(exe_name, 0) + seconds
+      else:
+          seconds = [0] * len(self.exe_names)
+          for row in self.rows(start, end):
+              seconds[self.exe_code[row]] += self.end_time[row] - self.start_time[row]
+          totals = dict((self.exe_names[code], s) for code, s in enumerate(seconds) if s)
+      return sorted(totals.items(), key=lambda item: -item[1])
+      
+  def days(self, field, query, start=None, end=None):
+      '''
+      Returns the seconds per day ("YYYY/MM/DD") spent in the intervals 
+      starting in [start, end) whose field matches query, counted once per 
+      matching query group, as the chart in chart.html shows them
+      '''
+      groups = parse_query(query)
+      days = {}
+      if field == "exe_name" and start is None and end is None:
+          # The per-day totals are enough
+          for date, totals in self.rollups.days.iteritems():
+              names = totals.keys()
+              delta = sum(totals[exe_name] * hits for exe_name, hits 
+                  in zip(names, count_hits(names, groups)))
+              if delta:
+                  days[date] = delta
+          return days
+      codes, hits = self.hits(field, groups)
+      for row in self.rows(start, end):
+          row_hits = hits[codes[row]]
+          if row_hits:
+              date = datetime.datetime.fromtimestamp(self.start_time[row]).strftime("%Y/%m/%d")
+              days[date] = days.get(date, 0) + \
+                  (self.end_time[row] - self.start_time[row]) * row_hits
+      return days
+      
+  def intervals(self, field, query, start=None, end=None, offset=0, limit=100):
+      '''
+      Returns (total, items): the number of intervals starting in 
+      [start, end) whose field matches query and the [exe_name, window_title,
+      start_time, end_time] of limit of them, from the offset'th on
+      '''
+      codes, hits = self.hits(field, parse_query(query))
+      total = 0
+      items = []
+      for row in self.rows(start, end):
+          if hits[codes[row]]:
+              if offset <= total < offset + limit:
+                  items.append([self.exe_names[self.exe_code[row]], 
+                      self.window_titles[self.title_code[row]],
+                      self.start_time[row], self.end_time[row]])
+              total += 1
+      return total, items
+
+
+class QueryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  '''
+  Serves chart.html (and the scripts, styles and images it uses) and JSON 
+  query results for it from the QueryServer's QueryData. All query 
+  parameters are optional:
+  
+    /api/exes?start=&end=
+      {"exes": [[exe_name, seconds], ...]}, most used first
+    /api/days?field=&q=&start=&end=
+      {"days": {"YYYY/MM/DD": seconds, ...}} for the intervals whose field 
+      ("exe_name", the default, or "window_title") matches search query q
+    /api/intervals?field=&q=&start=&end=&offset=&limit=
+      {"total": count, "offset": offset, "items": [[exe_name, window_title, 
+      start_time, end_time], ...]}, a page of (at most 1000) matching 
+      intervals in chronological order
+    /api/rollups
+      the Rollups (days, hours and idle)
+    /api/stats?top=&gap=
+      {"top_titles": [[window_title, seconds], ...], "switch_rates": 
+      {"YYYY/MM/DD": switches per hour, ...}, "sessions": [[start_time, 
+      end_time], ...]}: the top (10) window titles, and sessions of use 
+      separated by more than gap (300) seconds; needs NumPy (see 
+      IntervalArrays)
+    /api/status
+      {"refreshing": bool, "updated": time}: whether the data is stale and 
+      being refreshed in the background (see AnalysisWorker), and when it 
+      was last brought up to date (null if it never was)
+      
+  start and end are times in seconds since the epoch; only intervals that 
+  start in [start, end) are counted. Strings are decoded as latin-1 (see 
+  latin1()). Responses carry an ETag that changes when the logs do, so a 
+  browser that already has a result gets a 304 instead of the data again.
+  
+  Requests whose Host header isn't the server's own address (127.0.0.1 or
+  localhost, with its port) are refused, so that a page that has pointed 
+  its own domain name at 127.0.0.1 (DNS rebinding) can't read the data.
+  '''
+  STATIC = ("chart.html", "js/", "css/", "resources/")
+  
+  def do_GET(self):
+      if self.headers.getheader("Host") not in self.server.hosts:
+          self.send_error(403, "unexpected Host header")
+          return
+      try:
+          url = urlparse.urlparse(self.path)
+          path = urlparse.unquote(url.path).lstrip("/") or "chart.html"
+          if path.startswith("api/"):
+              self.send_query(path[4:], urlparse.parse_qs(url.query))
+          else:
+              self.send_static(path)
+      except ValueError as e:
+          self.send_error(400, str(e))
+      except Exception as e:
+          logging.exception("error while serving %s: %s" % (self.path, str(e)))
+          self.send_error(500)
+          
+  def send_query(self, name, params):
+      def param(key, default=None, convert=str):
+          if key not in params:
+              return default
+          return convert(params[key][0])
+      # Queries come in as UTF-8; match them against the latin-1 log data
+      def text(value):
+          return value.decode("utf-8", "replace").encode("latin-1", "replace")
+          
+      if name == "status":
+          # Answered right away, even while the data is being refreshed
+          body = json.dumps(self.server.status())
+          self.send_body(body, "application/json", '"%s"' % hashlib.sha1(body).hexdigest())
+          return
+      data = self.server.data()
+      if self.not_modified(data.etag):
+          return
+      start, end = param("start", None, float), param("end", None, float)
+      field = param("field", "exe_name")
+      query = param("q", "", text)
+      if name == "exes":
+          result = {"exes": data.exes(start, end)}
+      elif name == "days":
+          result = {"days": data.days(field, query, start, end)}
+      elif name == "intervals":
+          offset = max(0, param("offset", 0, int))
+          limit = min(1000, max(0, param("limit", 100, int)))
+          total, items = data.intervals(field, query, start, end, offset, limit)
+          result = {"total": total, "offset": offset, "items": items}
+      elif name == "rollups":
+          result = data.rollups.to_dict()
+      elif name == "stats":
+          if data.stats is None:
+              self.send_error(501, "statistics need NumPy")
+              return
+          starts, ends = data.stats.sessions(param("gap", 300, float))
+          result = {"top_titles": data.stats.top_titles(param("top", 10, int)),
+              "switch_rates": data.stats.switch_rates(),
+              "sessions": zip(starts.tolist(), ends.tolist())}
+      else:
+          self.send_error(404)
+          return
+      self.send_body(json.dumps(result, encoding="latin-1"), "application/json", data.etag)
+      
+  def send_static(self, path):
+      # Only serve what the page needs: never the logs next to it
+      root = os.path.realpath(self.server.root)
+      filename = os.path.realpath(os.path.join(root, path))
+      path = os.path.relpath(filename, root).replace(os.sep, "/")
+      if not any(path == p or (p.endswith("/") and path.startswith(p)) for p in self.STATIC) or \
+              not os.path.isfile(filename):
+          self.send_error(404)
+          return
+      st = os.stat(filename)
+      etag = '"%x-%x"' % (st.st_size, int(st.st_mtime))
+      if self.not_modified(etag):
+          return
+      with open(filename, "rb") as fd:
+          body = fd.read()
+      self.send_body(body, mimetypes.guess_type(filename)[0] or "application/octet-stream", etag)
+      
+  def not_modified(self, etag):
+      '''
+      Sends a 304 and returns True if the browser already has version etag
+      '''
+      if self.headers.getheader("If-None-Match") != etag:
+          return False
+      self.send_response(304)
+      self.send_header("ETag", etag)
+      self.end_headers()
+      return True
+      
+  def send_body(self, body, content_type, etag):
+      self.send_response(200)
+      self.send_header("Content-Type", content_type)
+      self.send_header("Content-Length", str(len(body)))
+      self.send_header("ETag", etag)
+      self.send_header("Cache-Control", "no-cache") # revalidate with the ETag
+      self.end_headers()
+      self.wfile.write(body)
+      
+  def log_message(self, format, *args):
+      logging.debug("QueryServer: " + format % args)
+
+
+class QueryServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  '''
+  HTTP server on localhost that serves chart.html from root (the directory 
+  watchme.py is in, by default) along with queries over the data analyzer 
+  has cached (see QueryHandler), as an alternative to writing out 
+  everything to alldata.js. The data is brought up to date with the log 
+  files when a query comes in and they have changed since the last one, 
+  unless an AnalysisWorker (worker) keeps it up to date in the background:
+  then queries are answered from the data there is, however stale, and only
+  the first one waits for it. Without a worker the log files are checked 
+  at most every max_age seconds, not on every query. port 0 picks a free 
+  port; url is the address of the chart.
+  
+  >>> server = QueryServer(Analyzer("data"))
+  >>> threading.Thread(target=server.serve_forever).start()
+  >>> webbrowser.open(server.url)
+  '''
+  daemon_threads = True
+  max_age = 5 # seconds
+  
+  def __init__(self, analyzer, port=0, root=None):
+      BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", port), QueryHandler)
+      self.analyzer = analyzer
+      self.root = root or os.path.dirname(os.path.realpath(__file__))
+      self.url = "http://127.0.0.1:%d/chart.html" % self.server_address[1]
+      # The Host headers we answer to (see QueryHandler)
+      self.hosts = ("127.0.0.1:%d" % self.server_address[1], 
+          "localhost:%d" % self.server_address[1])
+      self.worker = None # set by an AnalysisWorker
+      self.lock = threading.Lock() # held while the data is rebuilt
+      self.refreshing = False
+      self.updated = None # when the data was last brought up to date
+      self._data = None
+      self._signature = None
+      
+  def refresh(self):
+      '''
+      Brings the QueryData up to date if the log files changed since it last
+      was: rows appended to the logs are just added to it (see 
+      QueryData.appended), anything else has it rebuilt. Queries are answered
+      from the data there is in the meantime.
+      '''
+      with self.lock:
+          signature = [log_files(directory) for host, directory, cachedir in self.analyzer.hosts()]
+          if signature != self._signature:
+              self.refreshing = True
+              try:
+                  if not os.path.exists(self.analyzer.cachedir):
+                      os.makedirs(self.analyzer.cachedir)
+                  with self.analyzer.profiled(), self.analyzer.stats.timed("query_data"):
+                      caches = self.analyzer.update_hosts()
+                      data = self._data and self._data.appended(self.analyzer, caches)
+                      if data is None:
+                          data = QueryData(self.analyzer, caches)
+                          self.analyzer.stats.count("query_data_builds")
+                      self._data = data
+                  self.analyzer.save_stats()
+                  self._signature = signature
+              finally:
+                  self.refreshing = False
+          self.updated = time.time()
+          
+  def data(self):
+      '''
+      Returns the QueryData: brought up to date first if the log files 
+      changed and it is more than max_age seconds old, or with a worker, as
+      the worker last left it
+      '''
+      if self._data is None or (self.worker is None and 
+              time.time() - self.updated > self.max_age):
+          self.refresh()
+      return self._data
+      
+  def status(self):
+      '''
+      Returns whether the data is being refreshed and when it last was
+      '''
+      return {"refreshing": self.refreshing or self._data is None, 
+          "updated": self.updated}
+
+
+class AnalysisWorker(threading.Thread):
+  '''
+  Keeps the data of QueryServer server up to date in the background, so 
+  that the analyzer page opens without waiting for the logs to be parsed:
+  refreshes it when started, every interval seconds and whenever refresh()
+  is called. When the Logger starts on a new day's log file it calls 
+  rotated(), which also has the logs of the days before archived.
+  '''
+  def __init__(self, server, interval=600):
+      threading.Thread.__init__(self)
+      self.daemon = True
+      self.server = server
+      self.interval = interval
+      self._run = True
+      self._archive = False
+      self._wake = threading.Event()
+      server.worker = self
+      
+  def refresh(self):
+      '''
+      Asks for the data to be refreshed as soon as possible
+      '''
+      self._wake.set()
+      
+  def rotated(self, fname=None):
+      '''
+      Asks for the logs of past days to be archived (see archive_logs) and 
+      the data refreshed. The Logger has closed the last day's log by the 
+      time it moves on to fname, so the tray can run for weeks and still 
+      keep its logs compacted.
+      '''
+      self._archive = True
+      self._wake.set()
+      
+  def stop(self):
+      '''
+      Stops the worker, waiting for a refresh that is under way to finish
+      '''
+      self._run = False
+      self._wake.set()
+      if self.is_alive() and threading.current_thread() is not self:
+          self.join()
+          
+  def run(self):
+      while self._run:
+          self._wake.clear()
+          if self._archive:
+              self._archive = False
+              try:
+                  archive_logs(self.server.analyzer.directory)
+              except Exception as e:
+                  logging.exception("error while archiving logs: %s" % str(e))
+          try:
+              self.server.refresh()
+          except Exception as e:
+              logging.exception("error while refreshing analysis: %s" % str(e))
+          self._wake.wait(self.interval)
+
+
+class Watcher(SysTrayIcon):
+    '''
+    Watches window activity and supplies a UI to the user via a system tray
+    widget.
+    '''
+    def __init__(self, path):
+        '''
+        Starts the logger and sets up the system tray widget.
+        '''
+        if SysTrayIcon is object:
+            raise RuntimeError("Watcher requires pywin32 (systrayicon)")
+        if not os.path.exists(path):
+          os.makedirs(path)
+        
+        # Finish any write a crash cut short, then compress the logs of the 
+        # days gone by before we start logging
+        try:
+            Journal(os.path.join(path, Journal.FILENAME)).recover(path)
+            archive_logs(path)
+        except Exception as e:
+            logging.error("error while archiving logs: %s" % str(e))
+          
+        # Both write their timings to stats.json; setting WATCHME_PROFILE 
+        # also has them dump cProfile stats next to it
+        stats_file = os.path.join(path, "stats.json")
+        profile = os.environ.get("WATCHME_PROFILE")
+        
+        # Title canonicalization rules, if the user has set any up
+        title_rules = None
+        if os.path.exists(os.path.join(path, "titles.json")):
+            try:
+                title_rules = TitleRules.load(os.path.join(path, "titles.json"))
+            except Exception as e:
+                logging.error("error while loading title rules: %s" % str(e))
+        self.analyzer = Analyzer(path, stats_file=stats_file, 
+            profile=os.path.join(path, "analyzer.prof") if profile else None,
+            title_rules=title_rules)
+        
+        # The analyzer page is served by a QueryServer whose data a worker 
+        # keeps up to date in the background, refreshing it right away when
+        # the logger starts a new day's log
+        self.server = QueryServer(self.analyzer)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        logging.debug("QueryServer started; url=%s" % self.server.url)
+        self.worker = AnalysisWorker(self.server)
+        self.worker.start()
+        
+        self.logger = Logger(path, stats_file=stats_file, 
+            profile=os.path.join(path, "logger.prof") if profile else None,
+            on_rotate=self.worker.rotated,
+            title_rules=title_rules if title_rules and title_rules.log else None)
         self.logger.start()
         logging.debug("Logger started; path=%s" % path)
         SysTrayIcon.__init__(self, 
@@ -336,10 +3708,16 @@ class Watcher(SysTrayIcon):
         # Tells the logger to stop
         self.logger.stop()
         logging.debug("logger.stop called")
+        self.worker.stop()
+        self.server.shutdown()
       
     def analyze(self, trayicon):
-        # Runs the analysis script
-        self.analyzer.analyze()
+        # Opens the analyzer page right away, with the data as the worker 
+        # last left it; the page says so while the worker catches up with 
+        # the latest log rows
+        self.worker.refresh()
+        with self.analyzer.stats.timed("launch"):
+            webbrowser.open(self.server.url)
 
 
 if __name__=="__main__":